@@ -2,14 +2,24 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 from django.contrib import admin
+from django.db import transaction
 from guardian.admin import GuardedModelAdmin
 
-from .models import Cluster
+from .models import (Cluster, ClusterStatusRollup, ClusterStatusTransition,
+                     QueuedLaunch, StandbyCluster)
 
 
 def terminate(modeladmin, request, queryset):
-    for cluster in queryset:
-        cluster.terminate()
+    # imported here since the tasks module loads the Celery app
+    from .tasks import deactivate_cluster
+
+    for cluster in queryset.active():
+        # show the cluster as terminating right away and
+        # actually shut it down in the background
+        cluster.mark_terminating()
+        transaction.on_commit(
+            lambda cluster_id=cluster.pk: deactivate_cluster.delay(cluster_id)
+        )
 
 
 @admin.register(Cluster)
@@ -17,6 +27,7 @@ class ClusterAdmin(GuardedModelAdmin):
     list_display = [
         'identifier',
         'size',
+        'max_size',
         'created_by',
         'start_date',
         'end_date',
@@ -33,3 +44,78 @@ class ClusterAdmin(GuardedModelAdmin):
     ]
     search_fields = ['identifier', 'jobflow_id', 'created_by__email']
     actions = [terminate]
+
+
+@admin.register(StandbyCluster)
+class StandbyClusterAdmin(admin.ModelAdmin):
+    list_display = [
+        'jobflow_id',
+        'emr_release',
+        'size',
+        'most_recent_status',
+        'created_at',
+        'cluster',
+        'claimed_at',
+    ]
+    list_filter = [
+        'most_recent_status',
+        'emr_release',
+        'size',
+    ]
+    search_fields = ['jobflow_id']
+    readonly_fields = list_display
+
+
+@admin.register(QueuedLaunch)
+class QueuedLaunchAdmin(admin.ModelAdmin):
+    list_display = [
+        'task',
+        'object_id',
+        'user',
+        'size',
+        'priority',
+        'created_at',
+    ]
+    list_filter = [
+        'task',
+        'priority',
+    ]
+    search_fields = ['user__email']
+
+
+@admin.register(ClusterStatusTransition)
+class ClusterStatusTransitionAdmin(admin.ModelAdmin):
+    list_display = [
+        'jobflow_id',
+        'status',
+        'emr_release',
+        'size',
+        'created_at',
+    ]
+    list_filter = [
+        'status',
+        'emr_release',
+        'size',
+        'created_at',
+    ]
+    search_fields = ['jobflow_id']
+    readonly_fields = list_display
+
+
+@admin.register(ClusterStatusRollup)
+class ClusterStatusRollupAdmin(admin.ModelAdmin):
+    list_display = [
+        'emr_release',
+        'size',
+        'status',
+        'count',
+        'p50',
+        'p95',
+        'computed_at',
+    ]
+    list_filter = [
+        'status',
+        'emr_release',
+        'size',
+    ]
+    readonly_fields = list_display
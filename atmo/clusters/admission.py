@@ -0,0 +1,219 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Admission control for cluster and Spark job launches, to stay within the
+global and per-user budgets of EMR nodes that may be active at a time.
+
+Launches that don't fit the budgets are queued and released by priority
+as soon as enough nodes are available again.
+"""
+import logging
+from collections import Counter
+
+import constance
+from django.db import IntegrityError, transaction
+from django.db.models.functions import Coalesce
+
+from ..celery import celery
+from ..jobs.models import RESERVED_STATUS, SparkJob, SparkJobRun
+from .models import Cluster, QueuedLaunch, StandbyCluster
+
+logger = logging.getLogger(__name__)
+
+
+class NodeUsage:
+    """
+    The number of nodes of the active clusters, job runs and standby
+    clusters, in total and per user, counting auto-scaling clusters with
+    their maximum size.
+
+    Pending clusters that were admitted but weren't spawned yet count
+    with their requested size, the ones still in the launch queue don't.
+    """
+    def __init__(self, per_user, total):
+        self.per_user = per_user
+        self.total = total
+
+    @classmethod
+    def current(cls, cluster_id=None):
+        """
+        Returns the current node usage, without the pending cluster with
+        the given ID, e.g. while it's being admitted.
+        """
+        per_user = Counter()
+        total = 0
+        unadmitted_ids = list(QueuedLaunch.objects.filter(
+            task=QueuedLaunch.TASK_PROVISION_CLUSTER,
+        ).values_list('object_id', flat=True))
+        if cluster_id is not None:
+            unadmitted_ids.append(cluster_id)
+        clusters = Cluster.objects.active().exclude(
+            jobflow_id__isnull=True,
+            pk__in=unadmitted_ids,
+        ).annotate(
+            peak_size=Coalesce('max_size', 'size'),
+        ).values_list('created_by_id', 'peak_size')
+        for user_id, size in clusters:
+            per_user[user_id] += size
+            total += size
+
+        packed_sizes = {}
+        runs = SparkJobRun.objects.filter(
+            status__in=Cluster.ACTIVE_STATUS_LIST + (RESERVED_STATUS,),
+        ).annotate(
+            peak_size=Coalesce('spark_job__max_size', 'spark_job__size'),
+        ).values_list('spark_job__created_by_id', 'peak_size', 'jobflow_id', 'step_id')
+        for user_id, size, jobflow_id, step_id in runs:
+            if step_id:
+                # packed runs share a cluster that isn't owned by any user
+                packed_sizes[jobflow_id] = max(packed_sizes.get(jobflow_id, 0), size)
+                continue
+            per_user[user_id] += size
+            total += size
+        total += sum(packed_sizes.values())
+
+        standby_sizes = StandbyCluster.objects.available().values_list('size', flat=True)
+        total += sum(standby_sizes)
+        return cls(per_user=per_user, total=total)
+
+    def fits_user(self, user_id, size):
+        """
+        Whether the given number of nodes fit the budget of the user with
+        the given ID, always true if the user has nothing running.
+        """
+        budget = constance.config.NODE_BUDGET_PER_USER
+        if not budget or user_id is None or not self.per_user[user_id]:
+            return True
+        return self.per_user[user_id] + size <= budget
+
+    def fits_total(self, size):
+        """
+        Whether the given number of nodes fit the global budget, always
+        true if nothing is running.
+        """
+        budget = constance.config.NODE_BUDGET_TOTAL
+        if not budget or not self.total:
+            return True
+        return self.total + size <= budget
+
+    def fits(self, user_id, size):
+        return self.fits_user(user_id, size) and self.fits_total(size)
+
+    def add(self, user_id, size):
+        if user_id is not None:
+            self.per_user[user_id] += size
+        self.total += size
+
+
+def admit(task, object_id, user, size, priority):
+    """
+    Whether the launch of the given size can happen right away, otherwise
+    it's queued to be released by the given task later.
+
+    Launches also wait if a launch with the same or a higher priority is
+    already waiting for nodes to be available.
+    """
+    user_id = None if user is None else user.pk
+    if QueuedLaunch.objects.filter(task=task, object_id=object_id).exists():
+        return False
+    if task == QueuedLaunch.TASK_PROVISION_CLUSTER:
+        usage = NodeUsage.current(cluster_id=object_id)
+    else:
+        usage = NodeUsage.current()
+    if usage.fits(user_id, size):
+        # only the queued launches that aren't held back by their user's
+        # budget are waiting for the nodes this launch would take
+        waiting = [
+            launch for launch in QueuedLaunch.objects.filter(priority__lte=priority)
+            if usage.fits_user(launch.user_id, launch.size)
+        ]
+        if not waiting:
+            return True
+    try:
+        with transaction.atomic():
+            QueuedLaunch.objects.create(
+                task=task,
+                object_id=object_id,
+                user_id=user_id,
+                size=size,
+                priority=priority,
+            )
+    except IntegrityError:
+        # queued by another process in the meantime
+        pass
+    logger.info('Queued launch %s(%s) of %s nodes', task, object_id, size)
+    return False
+
+
+def has_capacity(size, user=None):
+    """
+    Whether the given number of nodes of the given user, or not owned by a
+    user, fit right away without overtaking any queued launch.
+    """
+    user_id = None if user is None else user.pk
+    return (
+        not QueuedLaunch.objects.exists() and
+        NodeUsage.current().fits(user_id, size)
+    )
+
+
+def discard_stale():
+    """
+    Delete the queued launches of the clusters and Spark jobs that were
+    deleted in the meantime, or of the clusters that aren't pending
+    anymore, so they don't hold back the launches queued after them.
+
+    Returns the number of deleted launches.
+    """
+    pending_clusters = Cluster.objects.filter(
+        most_recent_status=Cluster.STATUS_PENDING,
+        jobflow_id__isnull=True,
+    )
+    stale = QueuedLaunch.objects.filter(
+        task=QueuedLaunch.TASK_PROVISION_CLUSTER,
+    ).exclude(
+        object_id__in=pending_clusters.values('pk'),
+    ) | QueuedLaunch.objects.filter(
+        task=QueuedLaunch.TASK_LAUNCH_SPARK_JOB,
+    ).exclude(
+        object_id__in=SparkJob.objects.values('pk'),
+    )
+    deleted, _ = stale.delete()
+    if deleted:
+        logger.info('Discarded %s stale queued launches', deleted)
+    return deleted
+
+
+def release():
+    """
+    Queue the tasks of the queued launches that fit the node budgets now,
+    in the order of their priority.
+
+    Launches that are held back by their user's budget are skipped, but
+    the first launch that doesn't fit the global budget keeps the launches
+    after it waiting, so large launches don't starve. The stale launches
+    are discarded first, see `discard_stale`.
+
+    Returns the released launches.
+    """
+    discard_stale()
+    usage = NodeUsage.current()
+    released = []
+    for launch in QueuedLaunch.objects.all():
+        if not usage.fits_user(launch.user_id, launch.size):
+            continue
+        if not usage.fits_total(launch.size):
+            break
+        deleted, _ = QueuedLaunch.objects.filter(pk=launch.pk).delete()
+        if not deleted:
+            # released by another process in the meantime
+            continue
+        usage.add(launch.user_id, launch.size)
+        celery.send_task(
+            launch.task,
+            args=[launch.object_id],
+            kwargs={'admitted': True},
+        )
+        released.append(launch)
+    return released
@@ -0,0 +1,362 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Consuming the EMR cluster state change events that CloudWatch sends to a
+queue, to update the cluster and job run statuses without polling EMR.
+
+See https://docs.aws.amazon.com/emr/latest/ManagementGuide/emr-manage-cloudwatch-events.html
+"""
+import json
+import logging
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from itertools import count
+from urllib.parse import urlparse
+
+import boto3
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from ..jobs.models import SparkJobRun
+from .models import Cluster, ClusterStatusTransition
+from .tasks import update_master_address
+
+logger = logging.getLogger(__name__)
+
+EVENT_DETAIL_TYPE = 'EMR Cluster State Change'
+# how often a message is received before it's dead-lettered
+MAX_RECEIVE_COUNT = 5
+# the delay before a failed message is received again, doubled each time
+RELEASE_DELAY_SECONDS = 30
+
+
+class EventQueue(ABC):
+    """
+    The interface of the queues the events are consumed from, modeled after
+    SQS: received messages need to be deleted once they were processed, or
+    released to be received again after a delay.
+    """
+    @abstractmethod
+    def send(self, body):
+        pass
+
+    @abstractmethod
+    def receive(self, max_messages=10, wait_seconds=20):
+        """
+        Returns a list of (receipt, body, receive count) tuples of up to the
+        given number of messages, waiting up to the given seconds for any to
+        arrive. The receive count includes the current receive.
+        """
+
+    @abstractmethod
+    def delete(self, receipt):
+        pass
+
+    @abstractmethod
+    def release(self, receipt, delay_seconds=0):
+        """
+        Make the message with the given receipt visible again after the
+        given seconds, so it's received again by a later call.
+        """
+
+    @abstractmethod
+    def dead_letter(self, receipt):
+        """
+        Remove the message with the given receipt from the queue since it
+        can't be processed, keeping it for inspection where possible.
+        """
+
+
+class SQSEventQueue(EventQueue):
+    """
+    The messages of the SQS queue are dead-lettered by the redrive policy
+    of the queue if there is one.
+    """
+    def __init__(self, url):
+        self.url = url
+        self.sqs = boto3.client(
+            'sqs',
+            region_name=settings.AWS_CONFIG['AWS_REGION'],
+        )
+
+    def send(self, body):
+        self.sqs.send_message(QueueUrl=self.url, MessageBody=body)
+
+    def receive(self, max_messages=10, wait_seconds=20):
+        response = self.sqs.receive_message(
+            QueueUrl=self.url,
+            MaxNumberOfMessages=max_messages,
+            WaitTimeSeconds=wait_seconds,
+            AttributeNames=['ApproximateReceiveCount'],
+        )
+        return [
+            (
+                message['ReceiptHandle'],
+                message['Body'],
+                int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1)),
+            )
+            for message in response.get('Messages', [])
+        ]
+
+    def delete(self, receipt):
+        self.sqs.delete_message(QueueUrl=self.url, ReceiptHandle=receipt)
+
+    def release(self, receipt, delay_seconds=0):
+        self.sqs.change_message_visibility(
+            QueueUrl=self.url,
+            ReceiptHandle=receipt,
+            VisibilityTimeout=delay_seconds,
+        )
+
+    def dead_letter(self, receipt):
+        self.delete(receipt)
+
+
+class RedisEventQueue(EventQueue):
+    """
+    A stand-in for development using a Redis list, messages are moved to
+    a second list while being processed and to a sorted set by the time
+    they're visible again when they were released.
+    """
+    key = 'atmo:emr-events'
+    processing_key = key + ':processing'
+    delayed_key = key + ':delayed'
+    receive_counts_key = key + ':receive-counts'
+    dead_key = key + ':dead'
+
+    def __init__(self, url):
+        self.redis = redis.StrictRedis.from_url(url)
+
+    def send(self, body):
+        self.redis.lpush(self.key, body)
+
+    def requeue_delayed(self):
+        """Move the released messages back whose delay passed."""
+        for body in self.redis.zrangebyscore(self.delayed_key, 0, time.time()):
+            # another consumer may have moved it already
+            if self.redis.zrem(self.delayed_key, body):
+                self.redis.lpush(self.key, body)
+
+    def receive(self, max_messages=10, wait_seconds=20):
+        self.requeue_delayed()
+        if wait_seconds:
+            body = self.redis.brpoplpush(self.key, self.processing_key, wait_seconds)
+        else:
+            body = self.redis.rpoplpush(self.key, self.processing_key)
+        if body is None:
+            return []
+        bodies = [body]
+        while len(bodies) < max_messages:
+            body = self.redis.rpoplpush(self.key, self.processing_key)
+            if body is None:
+                break
+            bodies.append(body)
+        return [
+            (body, body.decode('utf-8'), self.redis.hincrby(self.receive_counts_key, body, 1))
+            for body in bodies
+        ]
+
+    def delete(self, receipt):
+        pipeline = self.redis.pipeline()
+        pipeline.lrem(self.processing_key, 1, receipt)
+        pipeline.hdel(self.receive_counts_key, receipt)
+        pipeline.execute()
+
+    def release(self, receipt, delay_seconds=0):
+        pipeline = self.redis.pipeline()
+        pipeline.lrem(self.processing_key, 1, receipt)
+        if delay_seconds:
+            pipeline.zadd(self.delayed_key, time.time() + delay_seconds, receipt)
+        else:
+            pipeline.lpush(self.key, receipt)
+        pipeline.execute()
+
+    def dead_letter(self, receipt):
+        pipeline = self.redis.pipeline()
+        pipeline.lrem(self.processing_key, 1, receipt)
+        pipeline.hdel(self.receive_counts_key, receipt)
+        pipeline.lpush(self.dead_key, receipt)
+        pipeline.execute()
+
+
+class MemoryEventQueue(EventQueue):
+    """
+    A stand-in for development and tests that keeps the messages in memory.
+    """
+    def __init__(self):
+        # (body, receive count) tuples
+        self.messages = deque()
+        self.in_flight = OrderedDict()
+        # (visible at, body, receive count) tuples
+        self.delayed = []
+        self.dead = []
+        self.receipts = count()
+
+    def send(self, body):
+        self.messages.append((body, 0))
+
+    def receive(self, max_messages=10, wait_seconds=20):
+        now = time.time()
+        for delayed in [delayed for delayed in self.delayed if delayed[0] <= now]:
+            self.delayed.remove(delayed)
+            self.messages.append(delayed[1:])
+        received = []
+        while self.messages and len(received) < max_messages:
+            receipt = next(self.receipts)
+            body, receive_count = self.messages.popleft()
+            self.in_flight[receipt] = (body, receive_count + 1)
+            received.append((receipt,) + self.in_flight[receipt])
+        return received
+
+    def delete(self, receipt):
+        self.in_flight.pop(receipt, None)
+
+    def release(self, receipt, delay_seconds=0):
+        if receipt in self.in_flight:
+            message = self.in_flight.pop(receipt)
+            if delay_seconds:
+                self.delayed.append((time.time() + delay_seconds,) + message)
+            else:
+                self.messages.append(message)
+
+    def dead_letter(self, receipt):
+        if receipt in self.in_flight:
+            self.dead.append(self.in_flight.pop(receipt)[0])
+
+
+_memory_queue = MemoryEventQueue()
+
+
+def get_event_queue(url=None):
+    """
+    Returns the event queue for the given URL, defaulting to the
+    EMR_EVENTS_QUEUE_URL setting, or None if no queue is configured.
+    """
+    if url is None:
+        url = settings.EMR_EVENTS_QUEUE_URL
+    if not url:
+        return None
+    scheme = urlparse(url).scheme
+    if scheme == 'memory':
+        return _memory_queue
+    elif scheme in ('redis', 'rediss', 'unix'):
+        return RedisEventQueue(url)
+    return SQSEventQueue(url)
+
+
+def parse_event(body):
+    """
+    Returns the jobflow ID and the cluster info for the given message body
+    of a CloudWatch event, or None if it's not a cluster state change event.
+
+    The cluster info has the same fields as the cluster provisioner returns,
+    except the public DNS name which isn't part of the event.
+    """
+    event = json.loads(body)
+    if event.get('detail-type') != EVENT_DETAIL_TYPE:
+        return None
+    detail = event['detail']
+    # the state change reason is a JSON encoded object
+    try:
+        state_change_reason = json.loads(detail.get('stateChangeReason') or '{}')
+    except ValueError:
+        state_change_reason = {}
+    return detail['clusterId'], {
+        'state': detail['state'],
+        'state_change_reason_code': state_change_reason.get('code'),
+        'state_change_reason_message': state_change_reason.get('message'),
+    }
+
+
+def apply_event(jobflow_id, info, transitions=None):
+    """
+    Update the statuses of the cluster and job run with the given jobflow ID
+    with the given cluster info, using the same code as when polling.
+
+    The status transitions are appended to the given list to be stored in
+    bulk by the caller if one is given.
+
+    Returns the number of updated clusters and job runs.
+    """
+    updated = 0
+    now = timezone.now()
+    for cluster in Cluster.objects.filter(jobflow_id=jobflow_id):
+        # events may arrive out of order, a final status stays final and
+        # late events don't move the cluster back to an earlier status
+        if (not cluster.is_active or
+                not Cluster.is_status_change(cluster.most_recent_status, info['state'])):
+            continue
+        previous_status = cluster.most_recent_status
+        cluster.update_status(info)
+        with transaction.atomic():
+            next_poll_date = now + cluster.get_poll_interval(cluster.most_recent_status)
+            if not cluster.save_status(previous_status, next_poll_date=next_poll_date,
+                                       transitions=transitions):
+                continue
+            updated += 1
+            if (not cluster.master_address and
+                    cluster.most_recent_status in cluster.READY_STATUS_LIST):
+                transaction.on_commit(
+                    lambda cluster_id=cluster.id: update_master_address.delay(cluster_id)
+                )
+
+    for run in SparkJobRun.objects.filter(jobflow_id=jobflow_id):
+        if run.status in Cluster.FINAL_STATUS_LIST:
+            continue
+        if run.is_packed:
+            # the cluster is shared, the run's status is the one of its step
+            run_info = run.get_info()
+        else:
+            run_info = info
+        if not Cluster.is_status_change(run.status, run_info['state']):
+            continue
+        with transaction.atomic():
+            run.update_status(run_info, transitions=transitions)
+        updated += 1
+    return updated
+
+
+def consume_events(queue, max_messages=10, wait_seconds=20):
+    """
+    Receive a batch of messages from the given queue and apply the cluster
+    state change events, returns the number of processed messages, e.g.
+    not counting the ones that failed.
+
+    Messages are only deleted once they were applied, they are released
+    to be received again with an increasing delay if applying them failed,
+    and dead-lettered once they were received MAX_RECEIVE_COUNT times.
+    """
+    processed = 0
+    transitions = []
+    messages = queue.receive(max_messages=max_messages, wait_seconds=wait_seconds)
+    for receipt, body, receive_count in messages:
+        try:
+            event = parse_event(body)
+        except (ValueError, KeyError):
+            logger.warning('Ignoring malformed EMR event %s', body)
+            event = None
+        if event is not None:
+            try:
+                logger.debug('Applying state change event %s', event)
+                apply_event(*event, transitions=transitions)
+            except Exception:
+                logger.exception('Failed to apply EMR event %s', body)
+                if receive_count >= MAX_RECEIVE_COUNT:
+                    logger.error(
+                        'Giving up on EMR event %s after %s attempts', body, receive_count,
+                    )
+                    queue.dead_letter(receipt)
+                else:
+                    queue.release(
+                        receipt,
+                        delay_seconds=RELEASE_DELAY_SECONDS * 2 ** (receive_count - 1),
+                    )
+                continue
+        queue.delete(receipt)
+        processed += 1
+    ClusterStatusTransition.objects.bulk_create(transitions)
+    return processed
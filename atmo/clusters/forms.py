@@ -6,12 +6,13 @@ from django.conf import settings
 from django.core.urlresolvers import reverse
 
 from . import models
-from ..forms.mixins import AutoClassFormMixin, CreatedByModelFormMixin
+from ..forms.mixins import (AutoClassFormMixin, CreatedByModelFormMixin,
+                            MaxSizeModelFormMixin)
 from ..keys.models import SSHKey
 
 
 class NewClusterForm(AutoClassFormMixin, CreatedByModelFormMixin,
-                     forms.ModelForm):
+                     MaxSizeModelFormMixin, forms.ModelForm):
     prefix = 'new'
 
     identifier = forms.RegexField(
@@ -52,7 +53,7 @@ class NewClusterForm(AutoClassFormMixin, CreatedByModelFormMixin,
 
     class Meta:
         model = models.Cluster
-        fields = ['identifier', 'size', 'ssh_key', 'emr_release']
+        fields = ['identifier', 'size', 'max_size', 'ssh_key', 'emr_release']
         widgets = {
             'emr_release': forms.RadioSelect(attrs={
                 'required': 'required',
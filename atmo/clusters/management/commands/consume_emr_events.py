@@ -0,0 +1,30 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+from django.core.management.base import BaseCommand, CommandError
+
+from ...events import consume_events, get_event_queue
+
+
+class Command(BaseCommand):
+    help = 'Consume EMR cluster state change events and update the statuses'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Only consume the events that are currently queued.',
+        )
+
+    def handle(self, *args, **options):
+        queue = get_event_queue()
+        if queue is None:
+            raise CommandError('The EMR_EVENTS_QUEUE_URL setting is not set.')
+        self.stdout.write('Consuming EMR events...')
+        while True:
+            consumed = consume_events(queue, wait_seconds=0 if options['once'] else 20)
+            if consumed:
+                self.stdout.write('Consumed %s events.' % consumed)
+            elif options['once']:
+                break
+        self.stdout.write('done.')
@@ -0,0 +1,37 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ...models import ClusterStatusRollup
+
+
+class Command(BaseCommand):
+    help = 'Compute the p50/p95 time clusters spent in each status'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=30,
+            help='Only use the status transitions of the last given days.',
+        )
+
+    def handle(self, *args, **options):
+        since = timezone.now() - timedelta(days=options['days'])
+        rollups = ClusterStatusRollup.compute(since=since)
+        self.stdout.write('%-12s %5s %-24s %6s %10s %10s' % (
+            'EMR release', 'size', 'status', 'count', 'p50', 'p95',
+        ))
+        for rollup in rollups:
+            self.stdout.write('%-12s %5s %-24s %6s %10s %10s' % (
+                rollup.emr_release,
+                rollup.size,
+                rollup.status,
+                rollup.count,
+                rollup.p50,
+                rollup.p95,
+            ))
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.12 on 2026-10-19 03:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clusters', '0019_auto_20170314_1216'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cluster',
+            name='next_poll_date',
+            field=models.DateTimeField(blank=True, help_text='Date/time that the cluster status should be polled again, or null if it should be polled right away.', null=True),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.12 on 2026-10-19 03:33
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clusters', '0020_cluster_next_poll_date'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClusterStatusRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('emr_release', models.CharField(max_length=50, verbose_name='EMR release')),
+                ('size', models.IntegerField()),
+                ('status', models.CharField(max_length=50)),
+                ('count', models.IntegerField(help_text='Number of status transitions the percentiles are based on.')),
+                ('p50', models.DurationField(help_text='Median time in the status.', verbose_name='p50')),
+                ('p95', models.DurationField(help_text='95th percentile of the time in the status.', verbose_name='p95')),
+                ('computed_at', models.DateTimeField(default=django.utils.timezone.now, help_text='Date/time that the percentiles were computed.')),
+            ],
+            options={
+                'ordering': ['emr_release', 'size', 'status'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ClusterStatusTransition',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('jobflow_id', models.CharField(help_text='AWS cluster/jobflow ID of the cluster.', max_length=50)),
+                ('emr_release', models.CharField(help_text='EMR release of the cluster.', max_length=50, verbose_name='EMR release')),
+                ('size', models.IntegerField(help_text='Number of computers used in the cluster.')),
+                ('status', models.CharField(help_text='The status the cluster changed to.', max_length=50)),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, help_text='Date/time that the status changed.')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='clusterstatustransition',
+            index_together=set([('jobflow_id', 'created_at')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='clusterstatusrollup',
+            unique_together=set([('emr_release', 'size', 'status')]),
+        ),
+    ]
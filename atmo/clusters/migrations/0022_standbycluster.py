@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.12 on 2026-10-19 03:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clusters', '0021_status_transitions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StandbyCluster',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('jobflow_id', models.CharField(help_text='AWS cluster/jobflow ID of the standby cluster.', max_length=50, unique=True)),
+                ('emr_release', models.CharField(help_text='EMR release of the standby cluster.', max_length=50, verbose_name='EMR release')),
+                ('size', models.IntegerField(help_text='Number of computers used in the standby cluster.')),
+                ('most_recent_status', models.CharField(default='STARTING', help_text='Most recently retrieved AWS status for the standby cluster.', max_length=50)),
+                ('claimed_at', models.DateTimeField(blank=True, help_text='Date/time that the standby cluster was claimed.', null=True)),
+                ('cluster', models.OneToOneField(blank=True, help_text='The cluster the standby cluster was claimed for, if any.', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='standby', to='clusters.Cluster')),
+            ],
+            options={
+                'ordering': ('-modified_at', '-created_at'),
+                'get_latest_by': 'modified_at',
+                'abstract': False,
+            },
+        ),
+    ]
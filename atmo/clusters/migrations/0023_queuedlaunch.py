@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.12 on 2026-10-19 03:43
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('clusters', '0022_standbycluster'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedLaunch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task', models.CharField(help_text='Name of the task to queue when the launch is released.', max_length=100)),
+                ('object_id', models.IntegerField(help_text='ID of the cluster or Spark job to launch.')),
+                ('size', models.IntegerField(help_text='Number of computers the launch needs.')),
+                ('priority', models.IntegerField(help_text='Launches with lower values are released first.')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, help_text='Date/time that the launch was queued.')),
+                ('user', models.ForeignKey(blank=True, help_text='User whose node budget the launch counts against, if any.', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='queued_launches', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['priority', 'created_at', 'pk'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='queuedlaunch',
+            unique_together=set([('task', 'object_id')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.12 on 2026-10-19 04:01
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clusters', '0023_queuedlaunch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cluster',
+            name='max_size',
+            field=models.IntegerField(blank=True, help_text="Maximum number of computers the cluster auto-scales to, or null if it doesn't auto-scale.", null=True),
+        ),
+    ]
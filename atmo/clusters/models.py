@@ -1,15 +1,17 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
+from collections import defaultdict
 from datetime import timedelta
 from urllib.parse import urljoin
 
 from django.conf import settings
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 
-from ..models import CreatedByModel, EditedAtModel, EMRReleaseModel
+from ..models import (CreatedByModel, EditedAtModel, EMRReleaseModel,
+                      percentile)
 from .provisioners import ClusterProvisioner
 
 
@@ -30,8 +32,22 @@ class ClusterQuerySet(models.QuerySet):
             most_recent_status__in=Cluster.FAILED_STATUS_LIST,
         )
 
+    def due_for_poll(self, now=None):
+        """
+        The active clusters that were spawned and whose status should be
+        polled again, depending on the lifecycle phase they are in.
+        """
+        if now is None:
+            now = timezone.now()
+        return self.active().filter(
+            models.Q(next_poll_date__isnull=True) | models.Q(next_poll_date__lte=now),
+            jobflow_id__isnull=False,
+        )
+
 
 class Cluster(EMRReleaseModel, CreatedByModel, EditedAtModel):
+    # internal status of a cluster that wasn't spawned on EMR yet
+    STATUS_PENDING = 'PENDING'
     STATUS_STARTING = 'STARTING'
     STATUS_BOOTSTRAPPING = 'BOOTSTRAPPING'
     STATUS_RUNNING = 'RUNNING'
@@ -41,6 +57,7 @@ class Cluster(EMRReleaseModel, CreatedByModel, EditedAtModel):
     STATUS_TERMINATED_WITH_ERRORS = 'TERMINATED_WITH_ERRORS'
 
     ACTIVE_STATUS_LIST = (
+        STATUS_PENDING,
         STATUS_STARTING,
         STATUS_BOOTSTRAPPING,
         STATUS_RUNNING,
@@ -58,6 +75,30 @@ class Cluster(EMRReleaseModel, CreatedByModel, EditedAtModel):
         STATUS_TERMINATED_WITH_ERRORS,
     )
     FINAL_STATUS_LIST = TERMINATED_STATUS_LIST + FAILED_STATUS_LIST
+    # statuses that usually change within minutes
+    TRANSITIONAL_STATUS_LIST = (
+        STATUS_STARTING,
+        STATUS_BOOTSTRAPPING,
+        STATUS_TERMINATING,
+    )
+    # the order of the lifecycle phases, clusters go back and forth between
+    # running and waiting only
+    STATUS_PHASES = {
+        STATUS_PENDING: 0,
+        STATUS_STARTING: 1,
+        STATUS_BOOTSTRAPPING: 2,
+        STATUS_RUNNING: 3,
+        STATUS_WAITING: 3,
+        STATUS_TERMINATING: 4,
+        STATUS_TERMINATED: 5,
+        STATUS_TERMINATED_WITH_ERRORS: 5,
+    }
+    # how long to wait until polling the status of a cluster again
+    POLL_INTERVAL_TRANSITIONAL = timedelta(seconds=30)
+    POLL_INTERVAL_STEADY = timedelta(minutes=10)
+    POLL_INTERVAL_FALLBACK = timedelta(minutes=15)
+    # clusters expire a day after they were spawned
+    LIFETIME = timedelta(days=1)
 
     STATE_CHANGE_REASON_INTERNAL_ERROR = 'INTERNAL_ERROR'
     STATE_CHANGE_REASON_VALIDATION_ERROR = 'VALIDATION_ERROR'
@@ -87,6 +128,12 @@ class Cluster(EMRReleaseModel, CreatedByModel, EditedAtModel):
     size = models.IntegerField(
         help_text="Number of computers  used in the cluster."
     )
+    max_size = models.IntegerField(
+        blank=True,
+        null=True,
+        help_text="Maximum number of computers the cluster auto-scales to, "
+                  "or null if it doesn't auto-scale."
+    )
     ssh_key = models.ForeignKey(
         'keys.SSHKey',
         on_delete=models.SET_NULL,
@@ -128,6 +175,12 @@ class Cluster(EMRReleaseModel, CreatedByModel, EditedAtModel):
         default=False,
         help_text="Whether the expiration mail were sent."
     )
+    next_poll_date = models.DateTimeField(
+        blank=True,
+        null=True,
+        help_text="Date/time that the cluster status should be polled again, "
+                  "or null if it should be polled right away."
+    )
 
     objects = ClusterQuerySet.as_manager()
 
@@ -142,6 +195,15 @@ class Cluster(EMRReleaseModel, CreatedByModel, EditedAtModel):
     def __repr__(self):
         return "<Cluster {} of size {}>".format(self.identifier, self.size)
 
+    @property
+    def is_pending(self):
+        return self.most_recent_status == self.STATUS_PENDING
+
+    @property
+    def peak_size(self):
+        """The number of computers the cluster may use at most."""
+        return self.max_size or self.size
+
     @property
     def is_active(self):
         return self.most_recent_status in self.ACTIVE_STATUS_LIST
@@ -171,6 +233,31 @@ class Cluster(EMRReleaseModel, CreatedByModel, EditedAtModel):
     def provisioner(self):
         return ClusterProvisioner()
 
+    @classmethod
+    def is_status_change(cls, status, new_status):
+        """
+        Whether the given new status is different from the given status
+        and not from an earlier lifecycle phase, e.g. a late event.
+        """
+        return (
+            new_status != status and
+            cls.STATUS_PHASES.get(new_status, 0) >= cls.STATUS_PHASES.get(status, 0)
+        )
+
+    @classmethod
+    def get_poll_interval(cls, status):
+        """
+        How long to wait until polling the status of a cluster with the
+        given status again, short for transitional statuses.
+
+        Polling is only a fallback if the state change events are consumed.
+        """
+        if settings.EMR_EVENTS_QUEUE_URL:
+            return cls.POLL_INTERVAL_FALLBACK
+        if status in cls.TRANSITIONAL_STATUS_LIST:
+            return cls.POLL_INTERVAL_TRANSITIONAL
+        return cls.POLL_INTERVAL_STEADY
+
     def get_absolute_url(self):
         return reverse('clusters-detail', kwargs={'id': self.id})
 
@@ -180,40 +267,477 @@ class Cluster(EMRReleaseModel, CreatedByModel, EditedAtModel):
     def get_info(self):
         return self.provisioner.info(self.jobflow_id)
 
-    def update_status(self):
-        """Should be called to update latest cluster status in `self.most_recent_status`."""
-        info = self.get_info()
+    def update_status(self, info=None):
+        """
+        Should be called to update latest cluster status in `self.most_recent_status`,
+        fetches the cluster info from AWS if not given, e.g. by a state change event.
+        """
+        if info is None:
+            info = self.get_info()
         self.most_recent_status = info['state']
-        self.master_address = info.get('public_dns') or ''
+        # state change events don't contain the master address
+        if 'public_dns' in info:
+            self.master_address = info['public_dns'] or ''
+
+    def save_status(self, previous_status, next_poll_date=None, transitions=None):
+        """
+        Store the current status and master address, unless another
+        process changed the status since it was `previous_status`,
+        in which case the stored values are loaded instead.
+
+        The status will be polled again on the next status update
+        unless a later date for the next poll is given.
+
+        The status transition is logged right away, or appended to the
+        given list of transitions to be stored in bulk by the caller.
+        """
+        self.next_poll_date = next_poll_date
+        saved = self.compare_and_save(
+            ['most_recent_status', 'master_address', 'next_poll_date'],
+            most_recent_status=previous_status,
+        )
+        if not saved:
+            self.refresh_from_db()
+        elif self.jobflow_id is not None and self.most_recent_status != previous_status:
+            if transitions is None:
+                self.status_transition().save()
+            else:
+                transitions.append(self.status_transition())
+        return saved
+
+    def queued_launches(self):
+        return QueuedLaunch.objects.filter(
+            task=QueuedLaunch.TASK_PROVISION_CLUSTER,
+            object_id=self.pk,
+        )
+
+    @property
+    def is_queued(self):
+        """Whether the cluster is waiting for enough nodes to be available."""
+        return self.is_pending and self.queued_launches().exists()
+
+    def status_transition(self):
+        """An unsaved status transition log entry for the current status."""
+        return ClusterStatusTransition(
+            jobflow_id=self.jobflow_id,
+            emr_release=self.emr_release,
+            size=self.size,
+            status=self.most_recent_status,
+        )
 
     def save(self, *args, **kwargs):
         """
-        Insert the cluster into the database or update it if already present,
-        spawning the cluster if it's not already spawned.
+        Insert the cluster into the database or update it if already present.
+
+        New clusters are stored as pending, they are spawned in the
+        background with the `atmo.clusters.tasks.provision_cluster` task.
         """
-        # actually start the cluster
-        if self.jobflow_id is None:
+        if self._state.adding and self.jobflow_id is None:
+            self.most_recent_status = self.STATUS_PENDING
+
+        # set the dates
+        now = timezone.now()
+        if not self.start_date:
+            self.start_date = now
+        if not self.end_date:
+            # reset once the cluster is actually spawned
+            self.end_date = now + self.LIFETIME
+
+        return super().save(*args, **kwargs)
+
+    def provision(self):
+        """
+        Actually spawn the pending cluster and store its jobflow ID, or
+        claim a matching standby cluster from the pool if there is one.
+
+        The cluster's lifetime starts now, e.g. not when it was queued.
+        A claimed cluster's start date is when the standby cluster was
+        spawned, so that it's included when listing the clusters in AWS.
+
+        Returns whether the cluster was spawned, the just spawned cluster is
+        stopped again if the cluster was terminated in the meantime.
+        """
+        standby = StandbyCluster.objects.claim(self)
+        if standby is not None:
+            self.provisioner.claim(
+                jobflow_id=standby.jobflow_id,
+                user_email=self.created_by.email,
+                identifier=self.identifier,
+                public_key=self.ssh_key.key,
+            )
+            self.jobflow_id = standby.jobflow_id
+            self.start_date = standby.created_at
+        else:
             self.jobflow_id = self.provisioner.start(
                 user_email=self.created_by.email,
                 identifier=self.identifier,
                 emr_release=self.emr_release,
                 size=self.size,
                 public_key=self.ssh_key.key,
+                max_size=self.max_size,
             )
+        self.end_date = timezone.now() + self.LIFETIME
+        saved = self.compare_and_save(
+            ['jobflow_id', 'start_date', 'end_date'],
+            jobflow_id__isnull=True,
+            most_recent_status=self.STATUS_PENDING,
+        )
+        if not saved:
+            self.provisioner.stop(self.jobflow_id)
+            self.refresh_from_db()
+        return saved
+
+    def mark_terminating(self):
+        """
+        Store the terminating status right away, e.g. before the cluster
+        is actually shutdown in the background.
+        """
+        previous_status = self.most_recent_status
+        self.most_recent_status = self.STATUS_TERMINATING
+        return self.save_status(previous_status)
+
+    def deactivate(self, transitions=None):
+        """
+        Shutdown the cluster and update its status accordingly, see
+        `save_status` for the list of transitions.
+        """
+        previous_status = self.most_recent_status
+        if self.jobflow_id is None:
+            # the cluster wasn't spawned yet, make sure it won't be anymore
+            self.most_recent_status = self.STATUS_TERMINATED
+            self.queued_launches().delete()
+        else:
+            self.provisioner.stop(self.jobflow_id)
             self.update_status()
+        self.save_status(previous_status, transitions=transitions)
 
-        # set the dates
-        now = timezone.now()
-        if not self.start_date:
-            self.start_date = now
-        if not self.end_date:
-            # clusters should expire after 1 day
-            self.end_date = now + timedelta(days=1)
 
-        return super().save(*args, **kwargs)
+class StandbyClusterQuerySet(models.QuerySet):
+
+    def active(self):
+        return self.filter(
+            most_recent_status__in=StandbyCluster.AVAILABLE_STATUS_LIST,
+        )
+
+    def available(self):
+        return self.active().filter(cluster__isnull=True)
+
+    def claim(self, cluster):
+        """
+        Claim an available standby cluster matching the EMR release and size
+        of the given cluster, preferring the ones that are ready already.
+
+        Returns the claimed standby cluster or None if there was none, e.g.
+        always for auto-scaling clusters since standby clusters don't.
+        """
+        if cluster.max_size:
+            return None
+        candidates = self.available().filter(
+            emr_release=cluster.emr_release,
+            size=cluster.size,
+            # about to be retired, see StandbyCluster.MAX_AGE
+            created_at__gt=timezone.now() - StandbyCluster.MAX_AGE,
+        ).annotate(
+            is_ready=models.Case(
+                models.When(most_recent_status=Cluster.STATUS_WAITING, then=0),
+                default=1,
+                output_field=models.IntegerField(),
+            ),
+        ).order_by('is_ready', 'created_at')
+        for standby in candidates:
+            standby.cluster = cluster
+            standby.claimed_at = timezone.now()
+            # another process may have claimed it in the meantime
+            if standby.compare_and_save(['cluster', 'claimed_at'], cluster__isnull=True):
+                return standby
+        return None
+
 
-    def deactivate(self):
-        """Shutdown the cluster and update its status accordingly"""
-        self.provisioner.stop(self.jobflow_id)
-        self.update_status()
-        self.save()
+class StandbyCluster(EditedAtModel):
+    """
+    A cluster that was spawned ahead of time for the pool of clusters
+    that are handed over to users launching a cluster of the same EMR
+    release and size, to skip waiting for the cluster to bootstrap.
+    """
+    # the statuses in which a standby cluster can be claimed
+    AVAILABLE_STATUS_LIST = (
+        Cluster.STATUS_STARTING,
+        Cluster.STATUS_BOOTSTRAPPING,
+        Cluster.STATUS_RUNNING,
+        Cluster.STATUS_WAITING,
+    )
+    IDENTIFIER = 'standby-cluster'
+    # unclaimed standby clusters are replaced after a while to not keep
+    # clusters with e.g. outdated bootstrap scripts around forever
+    MAX_AGE = timedelta(hours=12)
+
+    jobflow_id = models.CharField(
+        max_length=50,
+        unique=True,
+        help_text="AWS cluster/jobflow ID of the standby cluster.",
+    )
+    emr_release = models.CharField(
+        max_length=50,
+        verbose_name='EMR release',
+        help_text="EMR release of the standby cluster.",
+    )
+    size = models.IntegerField(
+        help_text="Number of computers used in the standby cluster.",
+    )
+    most_recent_status = models.CharField(
+        max_length=50,
+        default=Cluster.STATUS_STARTING,
+        help_text="Most recently retrieved AWS status for the standby cluster.",
+    )
+    cluster = models.OneToOneField(
+        Cluster,
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+        related_name='standby',
+        help_text="The cluster the standby cluster was claimed for, if any.",
+    )
+    claimed_at = models.DateTimeField(
+        blank=True,
+        null=True,
+        help_text="Date/time that the standby cluster was claimed.",
+    )
+
+    objects = StandbyClusterQuerySet.as_manager()
+
+    def __str__(self):
+        return self.jobflow_id
+
+    def __repr__(self):
+        return '<StandbyCluster {} of size {}>'.format(self.jobflow_id, self.size)
+
+    @classmethod
+    def pool_sizes(cls):
+        """
+        Returns a mapping of (EMR release, size) to the number of standby
+        clusters to keep around, from the CLUSTER_POOL setting.
+        """
+        sizes = {}
+        for key, count in settings.CLUSTER_POOL.items():
+            emr_release, size = key.rsplit(':', 1)
+            sizes[(emr_release, int(size))] = int(count)
+        return sizes
+
+    @property
+    def provisioner(self):
+        return ClusterProvisioner()
+
+    @classmethod
+    def spawn(cls, emr_release, size):
+        """Spawn a new standby cluster with the given EMR release and size."""
+        jobflow_id = ClusterProvisioner().start_standby(
+            identifier=cls.IDENTIFIER,
+            emr_release=emr_release,
+            size=size,
+        )
+        return cls.objects.create(
+            jobflow_id=jobflow_id,
+            emr_release=emr_release,
+            size=size,
+        )
+
+    def update_status(self, info=None):
+        """Fetch and store the status of the standby cluster."""
+        if info is None:
+            info = self.provisioner.info(self.jobflow_id)
+        if info['state'] != self.most_recent_status:
+            self.most_recent_status = info['state']
+            self.compare_and_save(['most_recent_status'])
+
+    @property
+    def is_expired(self):
+        return self.created_at <= timezone.now() - self.MAX_AGE
+
+    def retire(self):
+        """Shutdown the standby cluster unless it was claimed meanwhile."""
+        self.most_recent_status = Cluster.STATUS_TERMINATING
+        if self.compare_and_save(['most_recent_status'], cluster__isnull=True):
+            self.provisioner.stop(self.jobflow_id)
+            return True
+        return False
+
+
+class QueuedLaunch(models.Model):
+    """
+    A cluster or Spark job launch that is waiting for enough EMR nodes to
+    be available within the node budgets, see `atmo.clusters.admission`.
+    """
+    TASK_PROVISION_CLUSTER = 'atmo.clusters.tasks.provision_cluster'
+    TASK_LAUNCH_SPARK_JOB = 'atmo.jobs.tasks.launch_spark_job'
+
+    # the launches with the lowest priority value are released first
+    PRIORITY_CLUSTER = 10
+    PRIORITY_MANUAL_SPARK_JOB = 20
+    PRIORITY_SCHEDULED_SPARK_JOB = 30
+
+    task = models.CharField(
+        max_length=100,
+        help_text="Name of the task to queue when the launch is released.",
+    )
+    object_id = models.IntegerField(
+        help_text="ID of the cluster or Spark job to launch.",
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        blank=True,
+        null=True,
+        related_name='queued_launches',
+        help_text="User whose node budget the launch counts against, if any.",
+    )
+    size = models.IntegerField(
+        help_text="Number of computers the launch needs.",
+    )
+    priority = models.IntegerField(
+        help_text="Launches with lower values are released first.",
+    )
+    created_at = models.DateTimeField(
+        default=timezone.now,
+        help_text="Date/time that the launch was queued.",
+    )
+
+    class Meta:
+        ordering = ['priority', 'created_at', 'pk']
+        unique_together = [
+            ['task', 'object_id'],
+        ]
+
+    def __str__(self):
+        return '%s(%s)' % (self.task, self.object_id)
+
+    def __repr__(self):
+        return '<QueuedLaunch {} of size {}>'.format(self, self.size)
+
+
+class ClusterStatusTransitionQuerySet(models.QuerySet):
+
+    def durations(self):
+        """
+        Returns a mapping of (EMR release, size, status) to the list of
+        durations the clusters were in that status, based on the time to
+        the next transition of the same cluster.
+        """
+        durations = defaultdict(list)
+        previous = None
+        transitions = self.order_by('jobflow_id', 'created_at', 'pk').values_list(
+            'jobflow_id', 'emr_release', 'size', 'status', 'created_at',
+        )
+        for transition in transitions.iterator():
+            jobflow_id, emr_release, size, status, created_at = transition
+            if previous is not None and previous[0] == jobflow_id:
+                key = tuple(previous[1:4])
+                durations[key].append(created_at - previous[4])
+            previous = transition
+        return durations
+
+
+class ClusterStatusTransition(models.Model):
+    """
+    An append-only log of the status changes of clusters, including the
+    clusters of Spark job runs.
+    """
+    jobflow_id = models.CharField(
+        max_length=50,
+        help_text="AWS cluster/jobflow ID of the cluster.",
+    )
+    emr_release = models.CharField(
+        max_length=50,
+        verbose_name='EMR release',
+        help_text="EMR release of the cluster.",
+    )
+    size = models.IntegerField(
+        help_text="Number of computers used in the cluster.",
+    )
+    status = models.CharField(
+        max_length=50,
+        help_text="The status the cluster changed to.",
+    )
+    created_at = models.DateTimeField(
+        default=timezone.now,
+        db_index=True,
+        help_text="Date/time that the status changed.",
+    )
+
+    objects = ClusterStatusTransitionQuerySet.as_manager()
+
+    class Meta:
+        index_together = [
+            ['jobflow_id', 'created_at'],
+        ]
+
+    def __str__(self):
+        return '%s %s' % (self.jobflow_id, self.status)
+
+    def __repr__(self):
+        return '<ClusterStatusTransition {} to {}>'.format(self.jobflow_id, self.status)
+
+
+class ClusterStatusRollup(models.Model):
+    """
+    The precomputed percentiles of how long clusters stayed in a status,
+    per EMR release and cluster size.
+    """
+    emr_release = models.CharField(
+        max_length=50,
+        verbose_name='EMR release',
+    )
+    size = models.IntegerField()
+    status = models.CharField(
+        max_length=50,
+    )
+    count = models.IntegerField(
+        help_text="Number of status transitions the percentiles are based on.",
+    )
+    p50 = models.DurationField(
+        verbose_name='p50',
+        help_text="Median time in the status.",
+    )
+    p95 = models.DurationField(
+        verbose_name='p95',
+        help_text="95th percentile of the time in the status.",
+    )
+    computed_at = models.DateTimeField(
+        default=timezone.now,
+        help_text="Date/time that the percentiles were computed.",
+    )
+
+    class Meta:
+        unique_together = [
+            ['emr_release', 'size', 'status'],
+        ]
+        ordering = ['emr_release', 'size', 'status']
+
+    def __str__(self):
+        return '%s %s %s' % (self.emr_release, self.size, self.status)
+
+    @classmethod
+    def compute(cls, since=None):
+        """
+        Replace the rollups with the ones of the status transitions since
+        the given date/time, or all transitions, and return them.
+        """
+        transitions = ClusterStatusTransition.objects.all()
+        if since is not None:
+            transitions = transitions.filter(created_at__gte=since)
+        now = timezone.now()
+        rollups = []
+        for (emr_release, size, status), durations in sorted(transitions.durations().items()):
+            durations.sort()
+            rollups.append(cls(
+                emr_release=emr_release,
+                size=size,
+                status=status,
+                count=len(durations),
+                p50=percentile(durations, 50),
+                p95=percentile(durations, 95),
+                computed_at=now,
+            ))
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(rollups)
+        return rollups
@@ -5,6 +5,10 @@ import constance
 
 from ..provisioners import Provisioner
 
+# installs the user's public key (the first argument) on the master node,
+# the standby clusters are bootstrapped without one
+CLAIM_COMMAND = 'echo "$0" >> /home/hadoop/.ssh/authorized_keys'
+
 
 class ClusterProvisioner(Provisioner):
     log_dir = 'clusters'
@@ -27,16 +31,48 @@ class ClusterProvisioner(Provisioner):
         })
         return params
 
-    def start(self, user_email, identifier, emr_release, size, public_key):
+    def start(self, user_email, identifier, emr_release, size, public_key,
+              max_size=None):
         """
         Given the parameters spawns a cluster with the desired properties and
         returns the jobflow ID.
         """
+        return self.run_job_flow(
+            user_email=user_email,
+            identifier=identifier,
+            emr_release=emr_release,
+            size=size,
+            max_size=max_size,
+            bootstrap_args=[
+                '--public-key', public_key,
+                '--email', user_email,
+                '--efs-dns', constance.config.AWS_EFS_DNS,
+            ],
+        )
+
+    def start_standby(self, identifier, emr_release, size):
+        """
+        Spawns a cluster that isn't set up for any user yet, to be claimed
+        by a user later, and returns the jobflow ID.
+        """
+        return self.run_job_flow(
+            user_email=self.config['EMAIL_SOURCE'],
+            identifier=identifier,
+            emr_release=emr_release,
+            size=size,
+            bootstrap_args=[
+                '--efs-dns', constance.config.AWS_EFS_DNS,
+            ],
+        )
+
+    def run_job_flow(self, user_email, identifier, emr_release, size, bootstrap_args,
+                     max_size=None):
         job_flow_params = self.job_flow_params(
             user_email=user_email,
             identifier=identifier,
             emr_release=emr_release,
             size=size,
+            max_size=max_size,
         )
 
         job_flow_params.update({
@@ -44,11 +80,7 @@ class ClusterProvisioner(Provisioner):
                 'Name': 'setup-telemetry-cluster',
                 'ScriptBootstrapAction': {
                     'Path': self.script_uri,
-                    'Args': [
-                        '--public-key', public_key,
-                        '--email', user_email,
-                        '--efs-dns', constance.config.AWS_EFS_DNS,
-                    ]
+                    'Args': bootstrap_args,
                 }
             }],
             'Steps': [{
@@ -65,6 +97,31 @@ class ClusterProvisioner(Provisioner):
         cluster = self.emr.run_job_flow(**job_flow_params)
         return cluster['JobFlowId']
 
+    def claim(self, jobflow_id, user_email, identifier, public_key):
+        """
+        Hands over the standby cluster with the given jobflow ID to a user
+        by tagging it for the user and installing the user's public key
+        with a step, see CLAIM_COMMAND.
+        """
+        self.emr.add_tags(
+            ResourceId=jobflow_id,
+            Tags=[
+                {'Key': 'Owner', 'Value': user_email},
+                {'Key': 'Name', 'Value': identifier},
+            ],
+        )
+        self.emr.add_job_flow_steps(
+            JobFlowId=jobflow_id,
+            Steps=[{
+                'Name': 'claim-cluster',
+                'ActionOnFailure': 'TERMINATE_JOB_FLOW',
+                'HadoopJarStep': {
+                    'Jar': 'command-runner.jar',
+                    'Args': ['bash', '-c', CLAIM_COMMAND, public_key],
+                }
+            }],
+        )
+
     def info(self, jobflow_id):
         """
         Returns the cluster info for the cluster with the given Jobflow ID
@@ -73,6 +130,18 @@ class ClusterProvisioner(Provisioner):
         cluster = self.emr.describe_cluster(ClusterId=jobflow_id)['Cluster']
         return self.format_info(cluster)
 
+    def node_count(self, jobflow_id):
+        """
+        Returns the number of running worker instances of the cluster with
+        the given jobflow ID, e.g. to track auto-scaling.
+        """
+        response = self.emr.list_instance_groups(ClusterId=jobflow_id)
+        return sum(
+            group['RunningInstanceCount']
+            for group in response['InstanceGroups']
+            if group['InstanceGroupType'] != 'MASTER'
+        )
+
     def format_info(self, cluster):
         status = cluster['Status']
         timeline = status['Timeline']
@@ -1,55 +1,174 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
+from collections import defaultdict
 from datetime import timedelta
 
 from django.conf import settings
 from django.db import transaction
+from django.db.models import Case, CharField, F, Value, When
 from django.template.loader import render_to_string
 from django.utils import timezone
 
 from .. import email
 from ..celery import celery
-from .models import Cluster
+from . import admission
+from .models import (Cluster, ClusterStatusRollup, ClusterStatusTransition,
+                     QueuedLaunch, StandbyCluster)
 from .provisioners import ClusterProvisioner
 
 
+@celery.autoretry_task(bind=True, max_retries=5)
+def provision_cluster(task, cluster_id, admitted=False):
+    """
+    Spawn the pending cluster with the given ID and fetch its first status,
+    retrying in case of AWS hiccups.
+
+    The cluster waits in the launch queue if spawning it would exceed the
+    node budgets, unless it was admitted from the launch queue already.
+
+    The cluster is marked as failed if it couldn't be spawned at all,
+    otherwise it's shut down at the end date set when it was spawned.
+    """
+    cluster = Cluster.objects.get(id=cluster_id)
+    try:
+        if cluster.jobflow_id is None:
+            # quick way out in case the cluster was terminated before
+            if not cluster.is_pending:
+                return
+            if not admitted and not admission.admit(
+                    task=QueuedLaunch.TASK_PROVISION_CLUSTER,
+                    object_id=cluster.pk,
+                    user=cluster.created_by,
+                    size=cluster.peak_size,
+                    priority=QueuedLaunch.PRIORITY_CLUSTER):
+                return
+            if not cluster.provision():
+                return
+            schedule_deadlines(cluster)
+        previous_status = cluster.most_recent_status
+        cluster.update_status()
+        cluster.save_status(previous_status)
+    except Exception:
+        if cluster.jobflow_id is None and task.request.retries >= task.max_retries:
+            cluster.most_recent_status = cluster.STATUS_TERMINATED_WITH_ERRORS
+            cluster.save_status(cluster.STATUS_PENDING)
+        raise
+
+
+@celery.autoretry_task()
+def deactivate_cluster(cluster_id):
+    """
+    Shutdown the cluster with the given ID and update its status,
+    which is safe to be retried since stopping a cluster is idempotent.
+    """
+    cluster = Cluster.objects.get(id=cluster_id)
+    if cluster.is_terminated or cluster.is_failed:
+        return
+    cluster.deactivate()
+
+
+def schedule_deadlines(cluster):
+    """
+    Queue the expiration mail to be sent an hour before the given cluster's
+    end date and the cluster to be deactivated at its end date.
+    """
+    send_expiration_mail.apply_async(
+        args=[cluster.id],
+        eta=cluster.end_date - timedelta(hours=1),
+    )
+    expire_cluster.apply_async(
+        args=[cluster.id],
+        eta=cluster.end_date,
+    )
+
+
+@celery.autoretry_task()
+def expire_cluster(cluster_id):
+    """
+    Deactivate the cluster with the given ID if it reached its end date,
+    queued to run at the end date when the cluster was spawned.
+    """
+    cluster = Cluster.objects.get(id=cluster_id)
+    if not cluster.is_active or cluster.end_date > timezone.now():
+        return
+    cluster.deactivate()
+
+
 @celery.task
 def deactivate_clusters():
+    """
+    Deactivate the expired clusters that weren't deactivated at their
+    end date already, to be used periodically as a safety net.
+    """
     now = timezone.now()
     deactivated_clusters = []
+    transitions = []
     for cluster in Cluster.objects.active().filter(end_date__lte=now):
         with transaction.atomic():
             deactivated_clusters.append([cluster.identifier, cluster.pk])
             # The cluster is expired
-            cluster.deactivate()
+            cluster.deactivate(transitions=transitions)
+    ClusterStatusTransition.objects.bulk_create(transitions)
     return deactivated_clusters
 
 
+def mail_expiring_cluster(cluster):
+    """
+    Send the expiration mail for the given cluster unless it was already
+    sent, returns whether the mail was sent.
+    """
+    with transaction.atomic():
+        # mark the mail as sent first so it's only sent once even if
+        # another worker picked up the same cluster in the meantime,
+        # the transaction is rolled back if sending the mail fails
+        cluster.expiration_mail_sent = True
+        if not cluster.compare_and_save(['expiration_mail_sent'],
+                                        expiration_mail_sent=False):
+            return False
+        subject = '[ATMO] Cluster %s is expiring soon!' % cluster.identifier
+        body = render_to_string(
+            'atmo/clusters/mails/expiration_body.txt', {
+                'cluster': cluster,
+                'deadline': cluster.end_date,
+                'site_url': settings.SITE_URL,
+            }
+        )
+        email.send_email(
+            to=cluster.created_by.email,
+            subject=subject,
+            body=body
+        )
+    return True
+
+
+@celery.task
+def send_expiration_mail(cluster_id):
+    """
+    Send the expiration mail for the cluster with the given ID, queued to
+    run an hour before the cluster's end date when the cluster was spawned.
+    """
+    cluster = Cluster.objects.get(id=cluster_id)
+    if (not cluster.is_active or
+            cluster.expiration_mail_sent or
+            not cluster.is_expiring_soon):
+        return False
+    return mail_expiring_cluster(cluster)
+
+
 @celery.task
 def send_expiration_mails():
+    """
+    Send the expiration mails for the clusters expiring soon that weren't
+    sent already, to be used periodically as a safety net.
+    """
     deadline = timezone.now() + timedelta(hours=1)
     soon_expired = Cluster.objects.active().filter(
         end_date__lte=deadline,
         expiration_mail_sent=False,
     )
     for cluster in soon_expired:
-        with transaction.atomic():
-            subject = '[ATMO] Cluster %s is expiring soon!' % cluster.identifier
-            body = render_to_string(
-                'atmo/clusters/mails/expiration_body.txt', {
-                    'cluster': cluster,
-                    'deadline': deadline,
-                    'site_url': settings.SITE_URL,
-                }
-            )
-            email.send_email(
-                to=cluster.created_by.email,
-                subject=subject,
-                body=body
-            )
-            cluster.expiration_mail_sent = True
-            cluster.save()
+        mail_expiring_cluster(cluster)
 
 
 @celery.autoretry_task()
@@ -67,7 +186,7 @@ def update_master_address(cluster_id, force=False):
     # then store the public IP of the cluster if found in response
     if master_address:
         cluster.master_address = master_address
-        cluster.save()
+        cluster.compare_and_save(['master_address'])
 
 
 @celery.autoretry_task()
@@ -77,11 +196,14 @@ def update_clusters():
     clusters.
 
     - To be used periodically.
+    - Only polls clusters in transitional states (e.g. bootstrapping)
+      on every run, clusters in steady states (e.g. waiting) less often.
     - Won't update state if not needed.
     - Will queue updating the Cluster's public IP address if needed.
     """
-    # only update the cluster info for clusters that are pending
-    active_clusters = Cluster.objects.active()
+    # only update the cluster info for clusters that are due to be polled
+    now = timezone.now()
+    active_clusters = Cluster.objects.due_for_poll(now)
 
     # Short-circuit for no active clusters (e.g. on weekends)
     if not active_clusters.exists():
@@ -98,32 +220,143 @@ def update_clusters():
     for cluster_info in provisioner.list(oldest_start_date[0]):
         cluster_mapping[cluster_info['jobflow_id']] = cluster_info
 
-    # go through pending clusters and update the state if needed
+    # go through pending clusters and collect the states that need updating
+    updated_states = {}
+    updated_cluster_map = {}
     updated_clusters = []
+    master_address_cluster_ids = []
+    # the IDs of the polled clusters per time to wait until the next poll
+    next_poll_cluster_ids = defaultdict(list)
     for cluster in active_clusters:
+        info = cluster_mapping.get(cluster.jobflow_id)
+        state = cluster.most_recent_status if info is None else info['state']
+        next_poll_cluster_ids[cluster.get_poll_interval(state)].append(cluster.pk)
+        # ignore if no info was found for some reason,
+        # the cluster was deleted in AWS but it wasn't deleted here yet
+        if info is None:
+            continue
+
+        # don't update the state if it's equal to the already stored state
+        if info['state'] == cluster.most_recent_status:
+            continue
+
+        updated_states[cluster.pk] = (cluster.most_recent_status, info['state'])
+        updated_cluster_map[cluster.pk] = cluster
+        updated_clusters.append(cluster.identifier)
+
+        # if not given enqueue a job to update the public IP address
+        # but only if the cluster is running or waiting, so the
+        # API call isn't wasted
+        if (not cluster.master_address and
+                info['state'] in cluster.READY_STATUS_LIST):
+            master_address_cluster_ids.append(cluster.pk)
+
+    # only the poll bookkeeping, so it doesn't update the modification date
+    for poll_interval, cluster_ids in next_poll_cluster_ids.items():
+        Cluster.objects.filter(pk__in=cluster_ids).update(
+            next_poll_date=now + poll_interval,
+        )
+
+    if updated_states:
         with transaction.atomic():
-            info = cluster_mapping.get(cluster.jobflow_id)
-            # ignore if no info was found for some reason,
-            # the cluster was deleted in AWS but it wasn't deleted here yet
-            if info is None:
-                continue
-
-            # don't update the state if it's equal to the already stored state
-            if info['state'] == cluster.most_recent_status:
-                continue
-
-            # run an UPDATE query for the cluster
-            cluster.most_recent_status = info['state']
-            cluster.save()
-
-            updated_clusters.append(cluster.identifier)
-
-            # if not given enqueue a job to update the public IP address
-            # but only if the cluster is running or waiting, so the
-            # API call isn't wasted
-            if (not cluster.master_address and
-                    cluster.most_recent_status in cluster.READY_STATUS_LIST):
-                transaction.on_commit(
-                    lambda: update_master_address.delay(cluster.id)
-                )
+            # run a single UPDATE query for all changed clusters, but only
+            # change the status if it's still the one we compared against,
+            # e.g. in case the cluster was terminated in the meantime
+            Cluster.objects.filter(pk__in=updated_states).update(
+                most_recent_status=Case(
+                    *[When(pk=pk, most_recent_status=previous_state, then=Value(state))
+                      for pk, (previous_state, state) in updated_states.items()],
+                    default=F('most_recent_status'),
+                    output_field=CharField(),
+                ),
+                modified_at=now,
+            )
+            # log the transitions of the clusters whose status was changed
+            transitions = []
+            changed = Cluster.objects.filter(pk__in=updated_states).values_list(
+                'pk', 'most_recent_status',
+            )
+            for pk, state in changed:
+                if state != updated_states[pk][1]:
+                    continue
+                cluster = updated_cluster_map[pk]
+                cluster.most_recent_status = state
+                transitions.append(cluster.status_transition())
+            ClusterStatusTransition.objects.bulk_create(transitions)
+
+            def queue_master_address_updates():
+                for cluster_id in master_address_cluster_ids:
+                    update_master_address.delay(cluster_id)
+            transaction.on_commit(queue_master_address_updates)
     return updated_clusters
+
+
+@celery.task
+def rollup_cluster_statuses():
+    """
+    Recompute the percentiles of the time clusters spent in each status
+    based on the status transitions of the last 30 days.
+    """
+    since = timezone.now() - timedelta(days=30)
+    return len(ClusterStatusRollup.compute(since=since))
+
+
+@celery.autoretry_task()
+def refill_cluster_pool():
+    """
+    Keep the number of standby clusters per EMR release and size that is
+    configured in the CLUSTER_POOL setting around, to be claimed when
+    users launch a cluster.
+
+    - To be used periodically.
+    - Updates the statuses of the unclaimed standby clusters first.
+    - Shuts down the standby clusters older than `StandbyCluster.MAX_AGE`.
+    - Spawns the missing standby clusters and shuts down the surplus ones.
+    """
+    standby_clusters = StandbyCluster.objects.available()
+    created_at = standby_clusters.datetimes('created_at', 'day')
+    if created_at:
+        provisioner = ClusterProvisioner()
+        cluster_mapping = {
+            cluster_info['jobflow_id']: cluster_info
+            for cluster_info in provisioner.list(created_at[0])
+        }
+        for standby in standby_clusters:
+            info = cluster_mapping.get(standby.jobflow_id)
+            if info is not None:
+                standby.update_status(info)
+
+    # retired before counting them, to be replaced right away
+    for standby in StandbyCluster.objects.available():
+        if standby.is_expired:
+            standby.retire()
+
+    # the oldest standby clusters first, they're more likely to be ready
+    available = defaultdict(list)
+    for standby in StandbyCluster.objects.available().order_by('created_at'):
+        available[(standby.emr_release, standby.size)].append(standby)
+
+    pool_sizes = StandbyCluster.pool_sizes()
+    spawned = []
+    for (emr_release, size), count in pool_sizes.items():
+        for _ in range(count - len(available[(emr_release, size)])):
+            # don't take nodes away from the actual launches
+            if not admission.has_capacity(size):
+                break
+            standby = StandbyCluster.spawn(emr_release=emr_release, size=size)
+            spawned.append(standby.jobflow_id)
+
+    # e.g. after the pool was shrunk or an EMR release was dropped
+    for key, standby_clusters in available.items():
+        for standby in standby_clusters[pool_sizes.get(key, 0):]:
+            standby.retire()
+    return spawned
+
+
+@celery.autoretry_task()
+def release_queued_launches():
+    """
+    Release the queued cluster and Spark job launches that fit the node
+    budgets now, to be used periodically.
+    """
+    return [str(launch) for launch in admission.release()]
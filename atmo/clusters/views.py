@@ -4,6 +4,7 @@
 from allauth.account.utils import user_display
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
+from django.db import transaction
 from django.shortcuts import redirect, render
 from django.template.response import TemplateResponse
 from django.utils.safestring import mark_safe
@@ -12,6 +13,7 @@ from ..decorators import (delete_permission_required, modified_date,
                           view_permission_required)
 from .forms import NewClusterForm
 from .models import Cluster
+from .tasks import deactivate_cluster, provision_cluster
 
 
 @login_required
@@ -48,7 +50,10 @@ def new_cluster(request):
             initial=initial,
         )
         if form.is_valid():
-            cluster = form.save()  # this will also magically spawn the cluster for us
+            cluster = form.save()  # this will store the pending cluster
+            # and spawn it in the background to not block the request,
+            # it's shut down at its end date once it was spawned
+            transaction.on_commit(lambda: provision_cluster.delay(cluster.id))
             return redirect(cluster)
     context = {
         'form': form,
@@ -58,13 +63,15 @@ def new_cluster(request):
 
 @login_required
 @delete_permission_required(Cluster)
-def terminate_cluster(request, id):
-    cluster = Cluster.objects.get(id=id)
+def terminate_cluster(request, cluster):
     if not cluster.is_active:
         return redirect(cluster)
 
     if request.method == 'POST':
-        cluster.deactivate()
+        # show the cluster as terminating right away and
+        # actually shut it down in the background
+        cluster.mark_terminating()
+        transaction.on_commit(lambda: deactivate_cluster.delay(cluster.id))
         return redirect(cluster)
 
     context = {
@@ -76,8 +83,7 @@ def terminate_cluster(request, id):
 @login_required
 @view_permission_required(Cluster)
 @modified_date
-def detail_cluster(request, id):
-    cluster = Cluster.objects.get(id=id)
+def detail_cluster(request, cluster):
     context = {
         'cluster': cluster,
         'modified_date': cluster.modified_at,
@@ -14,18 +14,24 @@ def permission_required(perm, klass, **params):
     view parameters isn't found or if the request user doesn't have
     the given permission for the object.
 
+    The found object is passed to the view as the second positional
+    argument instead of the view parameters used to look it up, so the
+    view doesn't have to query the database for it again.
+    Pass a list of related fields as ``select_related`` to fetch them
+    in the same query.
+
     E.g. for checking if the request user is allowed to change a user
     with the given username::
 
         @permission_required('auth.change_user', User)
-        def change_user(request, username):
-            # can use get() directly since get_object_or_404 was already called
-            # in the decorator and would have raised a Http404 if not found
-            user = User.objects.get(username=username)
+        def change_user(request, user):
+            # the user object was already fetched with get_object_or_404
+            # in the decorator which would have raised a Http404 if not found
             return render(request, 'change_user.html', context={'user': user})
 
     """
     ignore = params.pop('ignore', [])
+    select_related = params.pop('select_related', [])
 
     def decorator(view_func):
         @wraps(view_func, assigned=available_attrs(view_func))
@@ -34,8 +40,11 @@ def permission_required(perm, klass, **params):
             for kwarg, kwvalue in list(kwargs.items()):
                 if kwarg in ignore:
                     continue
-                filters[kwarg] = kwvalue
-            obj = get_object_or_404(klass, **filters)
+                filters[kwarg] = kwargs.pop(kwarg)
+            queryset = klass._default_manager.all()
+            if select_related:
+                queryset = queryset.select_related(*select_related)
+            obj = get_object_or_404(queryset, **filters)
             response = get_403_or_None(
                 request,
                 perms=[perm],
@@ -44,7 +53,7 @@ def permission_required(perm, klass, **params):
             )
             if response:
                 return response
-            return view_func(request, *args, **kwargs)
+            return view_func(request, obj, *args, **kwargs)
         return _wrapped_view
     return decorator
 
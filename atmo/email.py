@@ -4,7 +4,13 @@
 import boto3
 from django.conf import settings
 
-ses = boto3.client('ses', region_name=settings.AWS_CONFIG['AWS_REGION'])
+from .fake_aws import get_fake_aws
+
+fake_aws = get_fake_aws()
+if fake_aws is None:
+    ses = boto3.client('ses', region_name=settings.AWS_CONFIG['AWS_REGION'])
+else:
+    ses = fake_aws.client('ses')
 
 
 def send_email(to, subject, body, cc=None):
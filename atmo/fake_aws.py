@@ -0,0 +1,635 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+A fake of the parts of EMR, S3 and SES the provisioners use, to run and
+load-test the scheduler and the dashboard without AWS, e.g. with
+thousands of clusters on a laptop.
+
+It's enabled with the FAKE_AWS_URL setting, a memory:// URL to keep the
+state in the process or a redis:// URL to share it between the web and
+worker processes. The simulation is configured with query parameters,
+e.g. "redis://localhost:6379/2?bootstrapping=30&failure_rate=0.05":
+
+- starting, bootstrapping, step, terminating: the seconds clusters spend
+  starting and bootstrapping, running each step and terminating
+- latency: the seconds each API call takes
+- throttle_rate: the share of API calls that fail with a throttling error
+- failure_rate: the share of clusters failing to bootstrap and of steps
+  failing
+- seed: the seed of the random failures, to repeat a load test
+
+The cluster states aren't advanced in the background, they are computed
+from the creation date and the requested changes whenever they are read.
+"""
+import base64
+import io
+import json
+import logging
+import random
+import time
+from datetime import datetime
+from urllib.parse import parse_qs, urlparse, urlunparse
+from uuid import uuid4
+
+import redis
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OPTIONS = {
+    'starting': 60.0,
+    'bootstrapping': 240.0,
+    'step': 600.0,
+    'terminating': 60.0,
+    'latency': 0.0,
+    'throttle_rate': 0.0,
+    'failure_rate': 0.0,
+    'seed': None,
+}
+
+# how long auto-scaling clusters take to add another worker
+SCALING_INTERVAL = 300
+
+LIST_CLUSTERS_PAGE_SIZE = 50
+LIST_STEPS_PAGE_SIZE = 50
+LIST_OBJECTS_PAGE_SIZE = 1000
+
+TERMINATE_ACTIONS = ('TERMINATE_JOB_FLOW', 'TERMINATE_CLUSTER')
+
+STATE_CHANGE_REASONS = {
+    'ALL_STEPS_COMPLETED': 'Steps completed',
+    'USER_REQUEST': 'Terminated by user request',
+    'BOOTSTRAP_FAILURE': 'Bootstrap action failed (simulated)',
+    'STEP_FAILURE': 'Shut down as step failed (simulated)',
+}
+ERROR_REASONS = ('BOOTSTRAP_FAILURE', 'STEP_FAILURE')
+
+
+def to_datetime(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc)
+
+
+def to_timestamp(value):
+    return value.timestamp() if isinstance(value, datetime) else value
+
+
+def error(operation_name, code, message):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation_name)
+
+
+class MemoryStore:
+    """Keeps the fake resources in memory, e.g. for a single process."""
+
+    def __init__(self):
+        self.kinds = {}
+
+    def get(self, kind, key):
+        value = self.kinds.get(kind, {}).get(key)
+        return None if value is None else json.loads(value)
+
+    def put(self, kind, key, value):
+        self.kinds.setdefault(kind, {})[key] = json.dumps(value)
+
+    def delete(self, kind, key):
+        self.kinds.get(kind, {}).pop(key, None)
+
+    def values(self, kind):
+        return [json.loads(value) for value in self.kinds.get(kind, {}).values()]
+
+
+class RedisStore(MemoryStore):
+    """Keeps the fake resources in a Redis hash per kind."""
+    prefix = 'atmo:fake-aws:'
+
+    def __init__(self, url):
+        self.redis = redis.StrictRedis.from_url(url)
+
+    def get(self, kind, key):
+        value = self.redis.hget(self.prefix + kind, key)
+        return None if value is None else json.loads(value.decode('utf-8'))
+
+    def put(self, kind, key, value):
+        self.redis.hset(self.prefix + kind, key, json.dumps(value))
+
+    def delete(self, kind, key):
+        self.redis.hdel(self.prefix + kind, key)
+
+    def values(self, kind):
+        return [
+            json.loads(value.decode('utf-8'))
+            for value in self.redis.hvals(self.prefix + kind)
+        ]
+
+
+class FakeAWS:
+    """
+    The simulation of the AWS services, see the module docstring for the
+    options.
+    """
+    def __init__(self, store, **options):
+        self.store = store
+        self.options = dict(DEFAULT_OPTIONS, **options)
+        self.random = random.Random(self.options['seed'])
+
+    @classmethod
+    def from_url(cls, url):
+        parsed = urlparse(url)
+        options = {}
+        for name, values in parse_qs(parsed.query).items():
+            if name not in DEFAULT_OPTIONS:
+                raise ValueError('Unknown fake AWS option %r' % name)
+            options[name] = int(values[-1]) if name == 'seed' else float(values[-1])
+        if parsed.scheme == 'memory':
+            store = MemoryStore()
+        elif parsed.scheme in ('redis', 'rediss', 'unix'):
+            store = RedisStore(urlunparse(parsed._replace(query='')))
+        else:
+            raise ValueError('Unsupported fake AWS URL %r' % url)
+        return cls(store, **options)
+
+    def client(self, service_name):
+        clients = {
+            'emr': FakeEMR,
+            's3': FakeS3,
+            'ses': FakeSES,
+        }
+        if service_name not in clients:
+            raise ValueError('There is no fake %s client' % service_name)
+        return clients[service_name](self)
+
+    def session(self):
+        return FakeSession()
+
+    def call(self, operation_name):
+        """
+        Simulate the latency and throttling of a call of the API operation
+        with the given name.
+        """
+        if self.options['latency']:
+            time.sleep(self.options['latency'])
+        if self.random.random() < self.options['throttle_rate']:
+            raise error(operation_name, 'ThrottlingException', 'Rate exceeded')
+
+    def now(self):
+        return time.time()
+
+    def fails(self):
+        return self.random.random() < self.options['failure_rate']
+
+    def simulate(self, cluster, now):
+        """
+        Returns the state of the given fake cluster at the given time, a
+        dict with the cluster state, the state change reason code, the
+        ready and end timestamps and the states of the steps.
+        """
+        options = self.options
+        ready_at = cluster['created_at'] + options['starting'] + options['bootstrapping']
+
+        # first let's find out when the cluster would end on its own
+        end_at = end_reason = None
+        timings = []
+        if cluster['fails']:
+            end_at, end_reason = ready_at, 'BOOTSTRAP_FAILURE'
+        else:
+            clock = ready_at
+            for step in cluster['steps']:
+                start = max(clock, step['added_at'])
+                if step['cancelled_at'] is not None and step['cancelled_at'] <= start:
+                    timings.append(None)
+                    continue
+                clock = start + options['step']
+                timings.append((start, clock))
+                if step['fails'] and step['action_on_failure'] in TERMINATE_ACTIONS:
+                    end_at, end_reason = clock, 'STEP_FAILURE'
+                    break
+            if end_at is None and not cluster['keep_alive']:
+                end_at, end_reason = clock, 'ALL_STEPS_COMPLETED'
+        terminate_at = cluster['terminate_at']
+        if terminate_at is not None and (end_at is None or terminate_at < end_at):
+            end_at, end_reason = terminate_at, 'USER_REQUEST'
+
+        steps = []
+        for index, step in enumerate(cluster['steps']):
+            timing = timings[index] if index < len(timings) else None
+            if timing is not None and end_at is not None and end_at <= timing[0]:
+                # the cluster ended before the step started
+                timing = None
+            ended = end_at is not None and now >= end_at
+            if timing is None:
+                cancelled = step['cancelled_at'] is not None or ended
+                state = 'CANCELLED' if cancelled else 'PENDING'
+            elif now < timing[0]:
+                state = 'CANCELLED' if ended else 'PENDING'
+            elif now < timing[1] or (end_at is not None and end_at < timing[1]):
+                state = 'INTERRUPTED' if ended else 'RUNNING'
+            else:
+                state = 'FAILED' if step['fails'] else 'COMPLETED'
+            steps.append(dict(step, state=state, timing=timing))
+
+        reason = None
+        if end_at is not None and now >= end_at:
+            reason = end_reason
+            if now < end_at + options['terminating']:
+                state = 'TERMINATING'
+            elif end_reason in ERROR_REASONS:
+                state = 'TERMINATED_WITH_ERRORS'
+            else:
+                state = 'TERMINATED'
+        elif now < cluster['created_at'] + options['starting']:
+            state = 'STARTING'
+        elif now < ready_at:
+            state = 'BOOTSTRAPPING'
+        elif any(step['state'] == 'RUNNING' for step in steps):
+            state = 'RUNNING'
+        else:
+            state = 'WAITING'
+        is_ready = (
+            not cluster['fails'] and now >= ready_at and
+            (end_at is None or end_at > ready_at)
+        )
+        return {
+            'state': state,
+            'reason': reason,
+            'ready_at': ready_at if is_ready else None,
+            'end_at': end_at + options['terminating'] if state.startswith('TERMINATED') else None,
+            'steps': steps,
+        }
+
+
+class FakePaginator:
+
+    def __init__(self, method):
+        self.method = method
+
+    def paginate(self, **params):
+        while True:
+            page = self.method(**params)
+            yield page
+            marker = page.get('Marker', page.get('NextContinuationToken'))
+            if not marker:
+                break
+            if 'NextContinuationToken' in page:
+                params['ContinuationToken'] = marker
+            else:
+                params['Marker'] = marker
+
+
+class FakeClient:
+
+    def __init__(self, aws):
+        self.aws = aws
+        self.store = aws.store
+
+    def get_paginator(self, operation_name):
+        return FakePaginator(getattr(self, operation_name))
+
+
+class FakeEMR(FakeClient):
+
+    def get_cluster(self, operation_name, cluster_id):
+        cluster = self.store.get('clusters', cluster_id)
+        if cluster is None:
+            raise error(operation_name, 'InvalidRequestException',
+                        'Cluster id %r is not valid.' % cluster_id)
+        return cluster
+
+    def add_steps(self, cluster, steps, now):
+        step_ids = []
+        for step in steps:
+            step_id = 's-%s' % uuid4().hex[:13].upper()
+            cluster['steps'].append({
+                'id': step_id,
+                'name': step['Name'],
+                'action_on_failure': step.get('ActionOnFailure', 'TERMINATE_CLUSTER'),
+                'args': step['HadoopJarStep'].get('Args', []),
+                'added_at': now,
+                'cancelled_at': None,
+                'fails': self.aws.fails(),
+            })
+            step_ids.append(step_id)
+        return step_ids
+
+    def status(self, simulation, created_at):
+        status = {
+            'State': simulation['state'],
+            'Timeline': {'CreationDateTime': to_datetime(created_at)},
+        }
+        if simulation['ready_at'] is not None:
+            status['Timeline']['ReadyDateTime'] = to_datetime(simulation['ready_at'])
+        if simulation['end_at'] is not None:
+            status['Timeline']['EndDateTime'] = to_datetime(simulation['end_at'])
+        if simulation['reason'] is not None:
+            status['StateChangeReason'] = {
+                'Code': simulation['reason'],
+                'Message': STATE_CHANGE_REASONS[simulation['reason']],
+            }
+        return status
+
+    def run_job_flow(self, **params):
+        self.aws.call('RunJobFlow')
+        now = self.aws.now()
+        instances = params['Instances']
+        size = 0
+        max_size = None
+        for group in instances.get('InstanceGroups', []):
+            if group['InstanceRole'] == 'CORE':
+                size = group['InstanceCount']
+                policy = group.get('AutoScalingPolicy')
+                if policy is not None:
+                    max_size = policy['Constraints']['MaxCapacity']
+        for fleet in instances.get('InstanceFleets', []):
+            if fleet['InstanceFleetType'] == 'CORE':
+                size = fleet.get('TargetSpotCapacity', 0) + fleet.get('TargetOnDemandCapacity', 0)
+        cluster = {
+            'id': 'j-%s' % uuid4().hex[:13].upper(),
+            'name': params['Name'],
+            'created_at': now,
+            'keep_alive': instances.get('KeepJobFlowAliveWhenNoSteps', False),
+            'size': size,
+            'max_size': max_size,
+            'tags': params.get('Tags', []),
+            'fails': self.aws.fails(),
+            'terminate_at': None,
+            'steps': [],
+        }
+        self.add_steps(cluster, params.get('Steps', []), now)
+        self.store.put('clusters', cluster['id'], cluster)
+        return {'JobFlowId': cluster['id']}
+
+    def add_tags(self, ResourceId, Tags):
+        self.aws.call('AddTags')
+        cluster = self.get_cluster('AddTags', ResourceId)
+        keys = {tag['Key'] for tag in Tags}
+        cluster['tags'] = [tag for tag in cluster['tags'] if tag['Key'] not in keys] + Tags
+        self.store.put('clusters', cluster['id'], cluster)
+        return {}
+
+    def add_job_flow_steps(self, JobFlowId, Steps):
+        self.aws.call('AddJobFlowSteps')
+        cluster = self.get_cluster('AddJobFlowSteps', JobFlowId)
+        step_ids = self.add_steps(cluster, Steps, self.aws.now())
+        self.store.put('clusters', cluster['id'], cluster)
+        return {'StepIds': step_ids}
+
+    def describe_cluster(self, ClusterId):
+        self.aws.call('DescribeCluster')
+        cluster = self.get_cluster('DescribeCluster', ClusterId)
+        simulation = self.aws.simulate(cluster, self.aws.now())
+        description = {
+            'Id': cluster['id'],
+            'Name': cluster['name'],
+            'Status': self.status(simulation, cluster['created_at']),
+            'Tags': cluster['tags'],
+        }
+        if simulation['ready_at'] is not None:
+            description['MasterPublicDnsName'] = (
+                'ec2-%s.compute.internal' % cluster['id'].lower()
+            )
+        return {'Cluster': description}
+
+    def list_clusters(self, CreatedAfter=None, CreatedBefore=None, ClusterStates=None,
+                      Marker=None):
+        self.aws.call('ListClusters')
+        now = self.aws.now()
+        created_after = to_timestamp(CreatedAfter)
+        created_before = to_timestamp(CreatedBefore)
+        summaries = []
+        # like EMR, the newest clusters come first
+        clusters = sorted(
+            self.store.values('clusters'),
+            key=lambda cluster: cluster['created_at'],
+            reverse=True,
+        )
+        for cluster in clusters:
+            if created_after is not None and cluster['created_at'] < created_after:
+                continue
+            if created_before is not None and cluster['created_at'] > created_before:
+                continue
+            simulation = self.aws.simulate(cluster, now)
+            if ClusterStates and simulation['state'] not in ClusterStates:
+                continue
+            summaries.append({
+                'Id': cluster['id'],
+                'Name': cluster['name'],
+                'Status': self.status(simulation, cluster['created_at']),
+            })
+        start = int(Marker or 0)
+        end = start + LIST_CLUSTERS_PAGE_SIZE
+        page = {'Clusters': summaries[start:end]}
+        if end < len(summaries):
+            page['Marker'] = str(end)
+        return page
+
+    def list_instance_groups(self, ClusterId):
+        self.aws.call('ListInstanceGroups')
+        now = self.aws.now()
+        cluster = self.get_cluster('ListInstanceGroups', ClusterId)
+        simulation = self.aws.simulate(cluster, now)
+        if simulation['state'] in ('WAITING', 'RUNNING'):
+            master_count, core_count = 1, cluster['size']
+            if cluster['max_size'] and simulation['state'] == 'RUNNING':
+                # auto-scaling clusters grow while running steps
+                added = int((now - simulation['ready_at']) // SCALING_INTERVAL)
+                core_count = min(core_count + added, cluster['max_size'])
+        else:
+            master_count = core_count = 0
+        groups = [('MASTER', master_count)]
+        if cluster['size']:
+            groups.append(('CORE', core_count))
+        return {
+            'InstanceGroups': [
+                {
+                    'Id': 'ig-%s-%s' % (cluster['id'][2:], group_type),
+                    'InstanceGroupType': group_type,
+                    'RunningInstanceCount': count,
+                }
+                for group_type, count in groups
+            ],
+        }
+
+    def terminate_job_flows(self, JobFlowIds):
+        self.aws.call('TerminateJobFlows')
+        now = self.aws.now()
+        for jobflow_id in JobFlowIds:
+            cluster = self.get_cluster('TerminateJobFlows', jobflow_id)
+            if cluster['terminate_at'] is None:
+                cluster['terminate_at'] = now
+                self.store.put('clusters', cluster['id'], cluster)
+        return {}
+
+    def format_step(self, step):
+        status = {'State': step['state']}
+        if step['state'] == 'FAILED':
+            status['FailureDetails'] = {'Message': 'Step failed (simulated)'}
+        return {
+            'Id': step['id'],
+            'Name': step['name'],
+            'ActionOnFailure': step['action_on_failure'],
+            'Config': {'Args': step['args']},
+            'Status': status,
+        }
+
+    def describe_step(self, ClusterId, StepId):
+        self.aws.call('DescribeStep')
+        cluster = self.get_cluster('DescribeStep', ClusterId)
+        for step in self.aws.simulate(cluster, self.aws.now())['steps']:
+            if step['id'] == StepId:
+                return {'Step': self.format_step(step)}
+        raise error('DescribeStep', 'InvalidRequestException',
+                    'Step id %r is not valid.' % StepId)
+
+    def list_steps(self, ClusterId, Marker=None):
+        self.aws.call('ListSteps')
+        cluster = self.get_cluster('ListSteps', ClusterId)
+        # like EMR, the latest steps come first
+        steps = list(reversed(self.aws.simulate(cluster, self.aws.now())['steps']))
+        start = int(Marker or 0)
+        end = start + LIST_STEPS_PAGE_SIZE
+        page = {'Steps': [self.format_step(step) for step in steps[start:end]]}
+        if end < len(steps):
+            page['Marker'] = str(end)
+        return page
+
+    def cancel_steps(self, ClusterId, StepIds):
+        self.aws.call('CancelSteps')
+        now = self.aws.now()
+        cluster = self.get_cluster('CancelSteps', ClusterId)
+        states = {
+            step['id']: step['state']
+            for step in self.aws.simulate(cluster, now)['steps']
+        }
+        infos = []
+        for step in cluster['steps']:
+            if step['id'] not in StepIds:
+                continue
+            # only pending steps can be cancelled
+            if states[step['id']] == 'PENDING':
+                step['cancelled_at'] = now
+                infos.append({'StepId': step['id'], 'Status': 'SUBMITTED'})
+            else:
+                infos.append({
+                    'StepId': step['id'],
+                    'Status': 'FAILED',
+                    'Reason': 'Step is %s' % states[step['id']],
+                })
+        self.store.put('clusters', cluster['id'], cluster)
+        return {'CancelStepsInfoList': infos}
+
+
+class FakeS3(FakeClient):
+
+    def object_key(self, bucket, key):
+        return '%s/%s' % (bucket, key)
+
+    def put_object(self, Bucket, Key, Body=b''):
+        self.aws.call('PutObject')
+        if hasattr(Body, 'read'):
+            Body = Body.read()
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        self.store.put('objects', self.object_key(Bucket, Key), {
+            'bucket': Bucket,
+            'key': Key,
+            'body': base64.b64encode(Body).decode('ascii'),
+            'modified_at': self.aws.now(),
+        })
+        return {}
+
+    def get_object(self, Bucket, Key):
+        self.aws.call('GetObject')
+        item = self.store.get('objects', self.object_key(Bucket, Key))
+        if item is None:
+            raise error('GetObject', 'NoSuchKey', 'The specified key does not exist.')
+        body = base64.b64decode(item['body'])
+        return {
+            'Body': io.BytesIO(body),
+            'ContentLength': len(body),
+            'LastModified': to_datetime(item['modified_at']),
+        }
+
+    def delete_object(self, Bucket, Key):
+        self.aws.call('DeleteObject')
+        self.store.delete('objects', self.object_key(Bucket, Key))
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', ContinuationToken=None):
+        self.aws.call('ListObjectsV2')
+        items = sorted(
+            (
+                item for item in self.store.values('objects')
+                if item['bucket'] == Bucket and item['key'].startswith(Prefix)
+            ),
+            key=lambda item: item['key'],
+        )
+        start = int(ContinuationToken or 0)
+        end = start + LIST_OBJECTS_PAGE_SIZE
+        page = {
+            'KeyCount': len(items[start:end]),
+            'Contents': [
+                {
+                    'Key': item['key'],
+                    'Size': len(base64.b64decode(item['body'])),
+                    'LastModified': to_datetime(item['modified_at']),
+                }
+                for item in items[start:end]
+            ],
+        }
+        if end < len(items):
+            page['NextContinuationToken'] = str(end)
+        return page
+
+
+class FakeSES(FakeClient):
+
+    def send_email(self, Source, Destination, Message):
+        self.aws.call('SendEmail')
+        message_id = str(uuid4())
+        logger.info(
+            'Fake email %s from %s to %s: %s', message_id, Source,
+            ', '.join(Destination.get('ToAddresses', [])),
+            Message['Subject']['Data'],
+        )
+        return {'MessageId': message_id}
+
+
+class FakeResponse:
+
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class FakeSession:
+    """
+    A stand-in for the requests session fetching the Spark EMR
+    configuration, which is empty.
+    """
+    def get(self, url, **kwargs):
+        return FakeResponse([])
+
+
+_fake_aws = {}
+
+
+def get_fake_aws(url=None):
+    """
+    Returns the fake AWS for the given URL, defaulting to the FAKE_AWS_URL
+    setting, or None if AWS isn't faked.
+    """
+    if url is None:
+        url = settings.FAKE_AWS_URL
+    if not url:
+        return None
+    if url not in _fake_aws:
+        _fake_aws[url] = FakeAWS.from_url(url)
+    return _fake_aws[url]
@@ -5,6 +5,7 @@ import uuid
 from collections import OrderedDict
 
 from django import forms
+from django.conf import settings
 
 from .cache import CachedFileCache
 from .fields import CachedFileField
@@ -70,6 +71,40 @@ class CreatedByModelFormMixin(forms.ModelForm):
             )
 
 
+class MaxSizeModelFormMixin(forms.ModelForm):
+    """
+    A model form mixin that adds the optional maximum size the cluster may
+    auto-scale to, which needs to be larger than the 'size' field.
+    """
+    max_size = forms.IntegerField(
+        label='Maximum cluster size',
+        required=False,
+        min_value=2,
+        max_value=settings.AWS_CONFIG['MAX_CLUSTER_SIZE'],
+        widget=forms.NumberInput(attrs={
+            'min': '2',
+            'max': str(settings.AWS_CONFIG['MAX_CLUSTER_SIZE']),
+        }),
+        help_text='Number of workers the cluster may auto-scale to when it '
+                  'runs out of memory, starting with the size above. '
+                  '(Leave empty to keep the cluster at its size.)'
+    )
+
+    def clean_max_size(self):
+        size = self.cleaned_data.get('size')
+        max_size = self.cleaned_data['max_size']
+        if max_size and size == 1:
+            raise forms.ValidationError(
+                'Clusters with a single node run everything on the master '
+                'node and can\'t auto-scale.'
+            )
+        if size and max_size and max_size <= size:
+            raise forms.ValidationError(
+                'The maximum cluster size needs to be larger than the cluster size.'
+            )
+        return max_size
+
+
 class CachedFileModelFormMixin(forms.ModelForm):
     """
     A model form mixin that automatically adds additional hidden form fields
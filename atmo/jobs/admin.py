@@ -8,8 +8,14 @@ from .models import SparkJob, SparkJobRun, SparkJobRunAlert
 
 
 def run_now(modeladmin, request, queryset):
-    for job in queryset:
-        job.run()
+    # imported here since the tasks module loads the Celery app
+    from .tasks import queue_launch
+
+    queued = [job.identifier for job in queryset if queue_launch(job)]
+    modeladmin.message_user(
+        request,
+        'Queued %s Spark job(s) to run: %s' % (len(queued), ', '.join(queued)),
+    )
 
 
 class SparkJobRunInline(admin.TabularInline):
@@ -18,13 +24,21 @@ class SparkJobRunInline(admin.TabularInline):
     extra = 0
     fields = [
         'jobflow_id',
+        'step_id',
+        'logical_date',
+        'attempt',
         'scheduled_date',
         'status',
+        'peak_node_count',
     ]
     readonly_fields = [
         'jobflow_id',
+        'step_id',
+        'logical_date',
+        'attempt',
         'scheduled_date',
         'status',
+        'peak_node_count',
     ]
 
 
@@ -35,6 +49,7 @@ class SparkJobAdmin(GuardedModelAdmin):
     list_display = [
         'identifier',
         'size',
+        'max_size',
         'created_by',
         'start_date',
         'end_date',
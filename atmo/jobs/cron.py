@@ -0,0 +1,70 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Cron-style schedules of Spark jobs, using the same syntax and semantics
+as Celery's crontab, e.g. "15 2 * * mon-fri" for 02:15 every weekday.
+"""
+from datetime import datetime, timedelta
+
+from celery.schedules import ParseException, crontab
+from django.utils import timezone
+
+# how far to look ahead for fire times, to cover e.g. every February 29th
+MAX_LOOKAHEAD_DAYS = 366 * 5
+
+
+def parse(expression):
+    """
+    Returns the crontab for the given expression of the five fields
+    minute, hour, day of month, month and day of week, in UTC.
+
+    Raises ValueError if the expression is invalid.
+    """
+    fields = expression.split()
+    if len(fields) != 5:
+        raise ValueError(
+            'A schedule needs five fields: minute, hour, day of month, '
+            'month and day of week.'
+        )
+    minute, hour, day_of_month, month_of_year, day_of_week = fields
+    try:
+        return crontab(
+            minute=minute,
+            hour=hour,
+            day_of_month=day_of_month,
+            month_of_year=month_of_year,
+            day_of_week=day_of_week,
+        )
+    except (ParseException, ValueError) as exc:
+        raise ValueError('Invalid schedule: %s' % exc)
+
+
+def fire_times(schedule, after, count):
+    """
+    Returns up to the given number of the next fire times of the given
+    crontab strictly after the given date/time.
+    """
+    after = after.astimezone(timezone.utc)
+    times = sorted(
+        (hour, minute)
+        for hour in schedule.hour
+        for minute in schedule.minute
+    )
+    result = []
+    day = after.date()
+    for _ in range(MAX_LOOKAHEAD_DAYS):
+        # Celery uses 0 for Sunday
+        if (day.month in schedule.month_of_year and
+                day.day in schedule.day_of_month and
+                day.isoweekday() % 7 in schedule.day_of_week):
+            for hour, minute in times:
+                fire_at = datetime(day.year, day.month, day.day, hour, minute,
+                                   tzinfo=timezone.utc)
+                if fire_at <= after:
+                    continue
+                result.append(fire_at)
+                if len(result) >= count:
+                    return result
+        day += timedelta(days=1)
+    return result
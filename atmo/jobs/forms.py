@@ -6,15 +6,17 @@ from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.utils import dateformat, timezone
 from django.utils.safestring import mark_safe
+from guardian.shortcuts import get_objects_for_user
 
-from . import models
+from . import cron, models
 from ..forms.fields import CachedFileField
 from ..forms.mixins import (AutoClassFormMixin, CachedFileModelFormMixin,
-                            CreatedByModelFormMixin)
+                            CreatedByModelFormMixin, MaxSizeModelFormMixin)
 
 
 class BaseSparkJobForm(AutoClassFormMixin, CachedFileModelFormMixin,
-                       CreatedByModelFormMixin, forms.ModelForm):
+                       CreatedByModelFormMixin, MaxSizeModelFormMixin,
+                       forms.ModelForm):
     identifier = forms.RegexField(
         required=True,
         label='Identifier',
@@ -72,6 +74,25 @@ class BaseSparkJobForm(AutoClassFormMixin, CachedFileModelFormMixin,
         label='Run interval',
         help_text='Interval at which the Spark job should be run.',
     )
+    schedule = forms.CharField(
+        required=False,
+        strip=True,
+        label='Schedule',
+        widget=forms.TextInput(attrs={
+            'placeholder': '15 2 * * mon-fri',
+        }),
+        help_text='Optional cron-style schedule in UTC (minute, hour, day of '
+                  'month, month and day of week), e.g. "15 2 * * mon-fri" for '
+                  '02:15 every weekday. Overrides the run interval.',
+    )
+    upstream_jobs = forms.ModelMultipleChoiceField(
+        queryset=models.SparkJob.objects.none(),
+        required=False,
+        label='Upstream jobs',
+        help_text='Optional jobs whose output this job consumes. The job runs '
+                  'as soon as all of them completed successfully instead of at '
+                  'its run interval.',
+    )
     job_timeout = forms.IntegerField(
         required=True,
         min_value=1,
@@ -117,6 +138,14 @@ class BaseSparkJobForm(AutoClassFormMixin, CachedFileModelFormMixin,
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        # only the jobs the user can see can be upstream jobs
+        self.fields['upstream_jobs'].queryset = get_objects_for_user(
+            self.created_by,
+            'jobs.view_sparkjob',
+            models.SparkJob.objects.exclude(pk=self.instance.pk).order_by('identifier'),
+            use_groups=False,
+            with_superuser=False,
+        )
         now = dateformat.format(timezone.now(), settings.DATETIME_FORMAT)
         self.fields['start_date'].label = mark_safe(
             '%s <span class="optional-label">(UTC) Currently: %s</span>' %
@@ -131,7 +160,8 @@ class BaseSparkJobForm(AutoClassFormMixin, CachedFileModelFormMixin,
         model = models.SparkJob
         fields = [
             'identifier', 'description', 'result_visibility', 'size',
-            'interval_in_hours', 'job_timeout', 'start_date', 'end_date'
+            'max_size', 'interval_in_hours', 'schedule', 'upstream_jobs', 'job_timeout',
+            'start_date', 'end_date',
         ]
 
     @property
@@ -151,6 +181,38 @@ class BaseSparkJobForm(AutoClassFormMixin, CachedFileModelFormMixin,
                                         'allowed to be uploaded')
         return notebook_file
 
+    def clean_schedule(self):
+        schedule = self.cleaned_data['schedule']
+        if not schedule:
+            return schedule
+        try:
+            crontab = cron.parse(schedule)
+        except ValueError as exc:
+            raise forms.ValidationError(str(exc))
+        if not cron.fire_times(crontab, after=timezone.now(), count=1):
+            raise forms.ValidationError('The schedule never fires.')
+        return ' '.join(schedule.split())
+
+    def clean_upstream_jobs(self):
+        upstream_jobs = self.cleaned_data['upstream_jobs']
+        if self.instance.pk is not None:
+            for upstream_job in upstream_jobs:
+                if self.instance.pk in upstream_job.all_upstream_job_ids():
+                    raise forms.ValidationError(
+                        'The job %s already depends on this job.' %
+                        upstream_job.identifier
+                    )
+        return upstream_jobs
+
+    def clean(self):
+        super().clean()
+        if self.cleaned_data.get('schedule') and self.cleaned_data.get('upstream_jobs'):
+            self.add_error(
+                'schedule',
+                'Jobs with upstream jobs run when those completed, '
+                'they can\'t have a schedule.',
+            )
+
     def save(self, commit=True):
         # create the model without committing, since we haven't
         # set the required created_by field yet
@@ -165,6 +227,9 @@ class BaseSparkJobForm(AutoClassFormMixin, CachedFileModelFormMixin,
         if commit:
             # actually save the scheduled Spark job, and return the model object
             spark_job.save()
+            self.save_m2m()
+            # the fire times depend on the schedule and start date
+            spark_job.update_fire_times(reset=True)
         return spark_job
 
 
@@ -211,6 +276,22 @@ class EditSparkJobForm(BaseSparkJobForm):
             'Changing this field will reset the job schedule. '
             'Only future dates are allowed.'
         )
+        stats = self.instance.runtime_stats
+        if stats is not None and stats.has_recommendations:
+            based_on = (
+                'Based on the last %s successful runs (median %s, p95 %s) '
+                'we recommend' %
+                (stats.run_count, stats.median_duration, stats.p95_duration)
+            )
+            self.fields['job_timeout'].help_text += (
+                '<br />%s a timeout of <strong>%s hours</strong>.' %
+                (based_on, stats.recommended_timeout)
+            )
+            if stats.recommended_size < self.instance.size:
+                self.fields['size'].help_text += (
+                    '<br />%s a cluster size of <strong>%s</strong>.' %
+                    (based_on, stats.recommended_size)
+                )
 
     def clean_start_date(self):
         if ('start_date' in self.changed_data and
@@ -219,5 +300,74 @@ class EditSparkJobForm(BaseSparkJobForm):
         return self.cleaned_data['start_date']
 
 
+class BackfillSparkJobForm(AutoClassFormMixin, forms.ModelForm):
+    prefix = 'backfill'
+    start_date = forms.DateTimeField(
+        required=True,
+        widget=forms.DateTimeInput(attrs={
+            'required': 'required',
+            'class': 'datetimepicker',
+        }),
+        label='Start date',
+        help_text='Logical date and time of the first period to run.',
+    )
+    end_date = forms.DateTimeField(
+        required=True,
+        widget=forms.DateTimeInput(attrs={
+            'required': 'required',
+            'class': 'datetimepicker',
+        }),
+        label='End date',
+        help_text='Logical date and time up to which the periods are run.',
+    )
+    concurrency = forms.IntegerField(
+        required=True,
+        min_value=1,
+        max_value=10,
+        label='Concurrency',
+        widget=forms.NumberInput(attrs={
+            'required': 'required',
+            'min': '1',
+            'max': '10',
+        }),
+        help_text='Maximum number of runs that are active at a time.',
+    )
+
+    def __init__(self, spark_job, *args, **kwargs):
+        self.spark_job = spark_job
+        super().__init__(*args, **kwargs)
+
+    class Meta:
+        model = models.SparkJobBackfill
+        fields = ['start_date', 'end_date', 'concurrency']
+
+    def clean(self):
+        super().clean()
+        start_date = self.cleaned_data.get('start_date')
+        end_date = self.cleaned_data.get('end_date')
+        if start_date is None or end_date is None:
+            return
+        if end_date < start_date:
+            self.add_error('end_date', 'The end date has to be after the start date.')
+        elif end_date > timezone.now():
+            self.add_error('end_date', 'Only past periods can be backfilled.')
+        else:
+            dates = self.spark_job.get_backfill_dates(start_date, end_date)
+            if not dates:
+                self.add_error('end_date', 'The date range contains no period to run.')
+            elif len(dates) > models.MAX_BACKFILL_RUNS:
+                self.add_error(
+                    'end_date',
+                    'A backfill can run at most %s periods.' % models.MAX_BACKFILL_RUNS,
+                )
+
+    def save(self, commit=True):
+        return self.spark_job.backfill(
+            start_date=self.cleaned_data['start_date'],
+            end_date=self.cleaned_data['end_date'],
+            concurrency=self.cleaned_data['concurrency'],
+        )
+
+
 class SparkJobAvailableForm(forms.Form):
     identifier = forms.CharField(required=True)
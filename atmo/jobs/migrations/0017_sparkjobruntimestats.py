@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.12 on 2026-10-19 03:35
+from __future__ import unicode_literals
+
+import atmo.models
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0016_auto_20170320_0943'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SparkJobRuntimeStats',
+            fields=[
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('spark_job', atmo.models.ForgivingOneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='runtime_stats', serialize=False, to='jobs.SparkJob')),
+                ('run_count', models.IntegerField(help_text='Number of runs the statistics are based on.')),
+                ('median_duration', models.DurationField(help_text='Median duration of the runs.')),
+                ('p95_duration', models.DurationField(help_text='95th percentile of the duration of the runs.')),
+                ('trend', models.FloatField(default=1.0, help_text='Median duration of the newer half of the runs relative to the older half, e.g. 1.2 if they took 20% longer.')),
+            ],
+            options={
+                'ordering': ('-modified_at', '-created_at'),
+                'get_latest_by': 'modified_at',
+                'abstract': False,
+            },
+        ),
+    ]
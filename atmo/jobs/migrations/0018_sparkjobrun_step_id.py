@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.12 on 2026-10-19 03:38
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0017_sparkjobruntimestats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sparkjobrun',
+            name='step_id',
+            field=models.CharField(blank=True, help_text='ID of the EMR step if the run shares its cluster with other runs.', max_length=50, null=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.12 on 2026-10-19 03:45
+from __future__ import unicode_literals
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0018_sparkjobrun_step_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sparkjob',
+            name='start_offset',
+            field=models.DurationField(default=datetime.timedelta(0), help_text='Delay of the scheduled runs to spread the launches of jobs scheduled at the same time.'),
+        ),
+        migrations.AddField(
+            model_name='sparkjobrun',
+            name='start_offset',
+            field=models.DurationField(default=datetime.timedelta(0), help_text='Start offset of the job at the time the run was scheduled.'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.12 on 2026-10-19 03:48
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0019_start_offset'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SparkJobFireTime',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fire_at', models.DateTimeField(db_index=True, help_text='Date/time that the job is due to run.')),
+            ],
+            options={
+                'ordering': ['fire_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='sparkjob',
+            name='schedule',
+            field=models.CharField(blank=True, default='', help_text="Cron-style schedule in UTC, e.g. '15 2 * * mon-fri', the job runs at the given interval if empty.", max_length=100),
+        ),
+        migrations.AddField(
+            model_name='sparkjobfiretime',
+            name='spark_job',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fire_times', related_query_name='fire_times', to='jobs.SparkJob'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='sparkjobfiretime',
+            unique_together=set([('spark_job', 'fire_at')]),
+        ),
+    ]
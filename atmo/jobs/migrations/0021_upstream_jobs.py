@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.12 on 2026-10-19 03:51
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0020_cron_schedules'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sparkjob',
+            name='upstream_jobs',
+            field=models.ManyToManyField(blank=True, help_text='Jobs whose successful runs this job waits for, it runs as soon as all of them completed instead of at its interval.', related_name='downstream_jobs', related_query_name='downstream_jobs', to='jobs.SparkJob'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.12 on 2026-10-19 03:54
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0021_upstream_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SparkJobBackfill',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('start_date', models.DateTimeField(help_text='Logical date/time of the first period to run.')),
+                ('end_date', models.DateTimeField(help_text='Logical date/time up to which the periods are run.')),
+                ('concurrency', models.PositiveIntegerField(default=2, help_text='Maximum number of runs that are active at a time.')),
+                ('spark_job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='backfills', related_query_name='backfills', to='jobs.SparkJob')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='sparkjobrun',
+            name='logical_date',
+            field=models.DateTimeField(blank=True, help_text='Date/time of the period a backfill run is for.', null=True),
+        ),
+        migrations.AddField(
+            model_name='sparkjobrun',
+            name='backfill',
+            field=models.ForeignKey(blank=True, help_text='Backfill the run is part of, if any.', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='runs', related_query_name='runs', to='jobs.SparkJobBackfill'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.12 on 2026-10-19 03:57
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0022_backfills'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sparkjobrun',
+            name='attempt',
+            field=models.PositiveIntegerField(default=1, help_text='Number of the attempt, retries after instance failures run on on-demand instances.'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.12 on 2026-10-19 04:01
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0023_run_attempts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SparkJobRunNodeCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recorded_at', models.DateTimeField(help_text='Date/time that the node count was recorded.')),
+                ('node_count', models.IntegerField(help_text='Number of running worker nodes.')),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='node_counts', related_query_name='node_counts', to='jobs.SparkJobRun')),
+            ],
+            options={
+                'ordering': ['recorded_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='sparkjob',
+            name='max_size',
+            field=models.IntegerField(blank=True, help_text="Maximum number of computers the job's cluster auto-scales to, or null if it doesn't auto-scale.", null=True),
+        ),
+    ]
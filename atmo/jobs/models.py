@@ -1,33 +1,65 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
+import math
+from collections import OrderedDict
 from datetime import timedelta
 from urllib.parse import urljoin
 
+import constance
 from django.conf import settings
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 from django.utils.functional import cached_property
 
 from atmo.clusters.provisioners import ClusterProvisioner
 
-from ..clusters.models import Cluster
+from ..clusters.models import Cluster, ClusterStatusTransition, QueuedLaunch
 from ..models import (CreatedByModel, EditedAtModel, EMRReleaseModel,
-                      ForgivingOneToOneField)
+                      ForgivingOneToOneField, percentile)
+from . import cron
 from .provisioners import SparkJobProvisioner
 
 DEFAULT_STATUS = ''
+# a run that was reserved but whose cluster wasn't confirmed to be launched yet
+RESERVED_STATUS = 'RESERVED'
+# a run whose cluster couldn't be launched
+LAUNCH_FAILED_STATUS = 'LAUNCH_FAILED'
+# the time after which a reserved run without a cluster is considered failed
+RESERVATION_TIMEOUT = timedelta(minutes=15)
+# the number of latest successful runs the runtime statistics are based on
+RUNTIME_STATS_RUN_COUNT = 20
+# the identifier of the clusters packed job runs share
+PACKED_IDENTIFIER = 'packed-spark-jobs'
+# the number of upcoming fire times to keep for jobs with a cron schedule
+FIRE_TIME_COUNT = 10
+# the maximum number of runs of a backfill
+MAX_BACKFILL_RUNS = 100
 
 
 class SparkJobQuerySet(models.QuerySet):
 
+    def due_candidates(self, now=None):
+        """
+        The jobs that may be due, the interval based ones and the ones
+        with a cron schedule that have a fire time that passed.
+        """
+        if now is None:
+            now = timezone.now()
+        return self.filter(
+            models.Q(schedule='') |
+            models.Q(fire_times__fire_at__lte=now)
+        ).distinct()
+
     def with_runs(self):
         return self.filter(runs__isnull=False)
 
     def active(self):
+        # the runs of backfills are tracked separately
         return self.filter(
-            runs__status__in=Cluster.ACTIVE_STATUS_LIST,
+            runs__status__in=Cluster.ACTIVE_STATUS_LIST + (RESERVED_STATUS,),
+            runs__backfill__isnull=True,
         )
 
     def terminated(self):
@@ -79,6 +111,12 @@ class SparkJob(EMRReleaseModel, CreatedByModel):
     size = models.IntegerField(
         help_text="Number of computers to use to run the job."
     )
+    max_size = models.IntegerField(
+        blank=True,
+        null=True,
+        help_text="Maximum number of computers the job's cluster auto-scales "
+                  "to, or null if it doesn't auto-scale."
+    )
     interval_in_hours = models.IntegerField(
         help_text="Interval at which the job should run, in hours.",
         choices=INTERVAL_CHOICES,
@@ -99,6 +137,27 @@ class SparkJob(EMRReleaseModel, CreatedByModel):
         default=True,
         help_text="Whether the job should run or not."
     )
+    start_offset = models.DurationField(
+        default=timedelta(0),
+        help_text="Delay of the scheduled runs to spread the launches of "
+                  "jobs scheduled at the same time.",
+    )
+    schedule = models.CharField(
+        max_length=100,
+        blank=True,
+        default='',
+        help_text="Cron-style schedule in UTC, e.g. '15 2 * * mon-fri', "
+                  "the job runs at the given interval if empty.",
+    )
+    upstream_jobs = models.ManyToManyField(
+        'self',
+        symmetrical=False,
+        blank=True,
+        related_name='downstream_jobs',
+        related_query_name='downstream_jobs',
+        help_text="Jobs whose successful runs this job waits for, it runs as "
+                  "soon as all of them completed instead of at its interval.",
+    )
 
     objects = SparkJobQuerySet.as_manager()
 
@@ -138,7 +197,8 @@ class SparkJob(EMRReleaseModel, CreatedByModel):
     def has_finished(self):
         """Whether the job's cluster is terminated or failed"""
         return (self.latest_run and
-                self.latest_run.status in Cluster.FINAL_STATUS_LIST)
+                self.latest_run.status in
+                Cluster.FINAL_STATUS_LIST + (LAUNCH_FAILED_STATUS,))
 
     @property
     def is_runnable(self):
@@ -153,25 +213,73 @@ class SparkJob(EMRReleaseModel, CreatedByModel):
         if self.has_never_run:
             # Job isn't even running at the moment and never ran before
             return False
-        max_run_time = (self.latest_run.scheduled_date +
-                        timedelta(hours=self.job_timeout))
+        run = self.latest_run
+        if run.is_packed:
+            # packed runs wait for the steps before them, so their time
+            # only starts with their own step
+            if run.run_date is None:
+                return False
+            started = run.run_date
+        else:
+            started = run.scheduled_date
+        max_run_time = started + timedelta(hours=self.job_timeout)
         return not self.is_runnable and timezone.now() >= max_run_time
 
     @property
     def is_public(self):
         return self.result_visibility == self.RESULT_PUBLIC
 
+    @property
+    def peak_size(self):
+        """The number of computers the job's cluster may use at most."""
+        return self.max_size or self.size
+
+    @property
+    def is_packable(self):
+        """
+        Whether the job is small and quick enough to be run as a step on a
+        cluster shared with other jobs, when packing is enabled. Shared
+        clusters don't auto-scale.
+        """
+        if not constance.config.SPARK_JOB_PACKING_ENABLED:
+            return False
+        if self.max_size:
+            return False
+        if self.size > constance.config.SPARK_JOB_PACKING_MAX_SIZE:
+            return False
+        # only jobs that are known to be quick
+        stats = self.runtime_stats
+        max_duration = timedelta(minutes=constance.config.SPARK_JOB_PACKING_MAX_DURATION)
+        return (
+            stats is not None and
+            stats.has_recommendations and
+            stats.p95_duration <= max_duration
+        )
+
+    @property
+    def packing_key(self):
+        """The jobs with the same packing key can share a cluster."""
+        return (self.emr_release, self.result_visibility)
+
     @property
     def notebook_name(self):
         return self.notebook_s3_key.rsplit('/', 1)[-1]
 
     def get_latest_run(self):
         try:
-            return self.runs.latest()
+            # the runs of backfills don't affect the schedule
+            return self.runs.filter(backfill__isnull=True).latest()
         except SparkJobRun.DoesNotExist:
             return None
     latest_run = cached_property(get_latest_run, name='latest_run')
 
+    def clear_latest_run(self):
+        """Remove the cached latest run so this object will requery it."""
+        try:
+            delattr(self, 'latest_run')
+        except AttributeError:
+            pass  # It didn't have a `latest_run` and that's ok.
+
     @cached_property
     def notebook_s3_object(self):
         return self.provisioner.get(self.notebook_s3_key)
@@ -182,27 +290,183 @@ class SparkJob(EMRReleaseModel, CreatedByModel):
     def get_full_url(self):
         return urljoin(settings.SITE_URL, self.get_absolute_url())
 
+    @property
+    def staggered_start_date(self):
+        return self.start_date + self.start_offset
+
+    @property
+    def has_cron_schedule(self):
+        return bool(self.schedule)
+
+    @property
+    def crontab(self):
+        return cron.parse(self.schedule)
+
+    def update_fire_times(self, reset=False, now=None):
+        """
+        Make sure the next fire times of the job's cron schedule are stored,
+        or that none are stored if the job runs at an interval.
+
+        Pass reset=True to replace the fire times after the schedule or the
+        start date was changed.
+        """
+        if reset or not self.has_cron_schedule:
+            self.fire_times.all().delete()
+        if not self.has_cron_schedule:
+            return
+        if now is None:
+            now = timezone.now()
+        existing = list(self.fire_times.values_list('fire_at', flat=True))
+        missing = FIRE_TIME_COUNT - len(existing)
+        if missing <= 0:
+            return
+        # the job doesn't fire before its start date
+        after = max([now, self.start_date - timedelta(seconds=1)] + existing)
+        SparkJobFireTime.objects.bulk_create([
+            SparkJobFireTime(spark_job=self, fire_at=fire_at)
+            for fire_at in cron.fire_times(self.crontab, after=after, count=missing)
+        ])
+
+    def consume_fire_times(self, now=None):
+        """
+        Remove the fire times of the job's cron schedule that passed,
+        when the job was run or skipped because it was still running,
+        and store the next ones.
+        """
+        if not self.has_cron_schedule:
+            return
+        if now is None:
+            now = timezone.now()
+        self.fire_times.filter(fire_at__lte=now).delete()
+        self.update_fire_times(now=now)
+
+    @property
+    def has_upstream_jobs(self):
+        return self.pk is not None and self.upstream_jobs.exists()
+
+    def all_upstream_job_ids(self):
+        """
+        The IDs of the job's upstream jobs and of their upstream jobs,
+        all the way up.
+        """
+        through = SparkJob.upstream_jobs.through
+        upstream_ids = set()
+        pending = set(self.upstream_jobs.values_list('pk', flat=True))
+        while pending:
+            upstream_ids |= pending
+            pending = set(
+                through.objects.filter(
+                    from_sparkjob_id__in=pending,
+                ).values_list('to_sparkjob_id', flat=True)
+            ) - upstream_ids
+        return upstream_ids
+
+    def get_upstream_due_date(self):
+        """
+        The date/time the last of the upstream jobs completed a successful
+        run since the latest run of this job, or since its start date if it
+        never ran, or None if any upstream job didn't complete one yet.
+        """
+        latest_run = self.latest_run
+        if (latest_run and
+                latest_run.scheduled_date is not None and
+                latest_run.status != LAUNCH_FAILED_STATUS):
+            since = latest_run.scheduled_date
+        else:
+            since = self.start_date
+        due_date = None
+        for upstream_job in self.upstream_jobs.all():
+            completed = upstream_job.runs.filter(
+                backfill__isnull=True,
+                status=Cluster.STATUS_TERMINATED,
+                terminated_date__gt=since,
+            ).aggregate(
+                completed=models.Min('terminated_date'),
+            )['completed']
+            if completed is None:
+                return None
+            due_date = completed if due_date is None else max(due_date, completed)
+        return due_date
+
+    def dispatch_downstream_jobs(self):
+        """
+        Queue the runs of the downstream jobs that are due now that a run
+        of this job completed successfully.
+        """
+        # imported here since the tasks module loads the Celery app
+        from .tasks import run_job
+
+        for downstream_job in self.downstream_jobs.filter(is_enabled=True):
+            if downstream_job.should_run():
+                transaction.on_commit(
+                    lambda spark_job_id=downstream_job.pk: run_job.delay(spark_job_id)
+                )
+
+    def get_due_date(self):
+        """
+        The date/time the job is due to run based on the latest run, the
+        configured interval in hours and the start offset, or the next
+        fire time of its cron schedule, independent of the latest run.
+
+        Jobs with upstream jobs are due once all of them completed a
+        successful run since the job's latest run.
+
+        The start offset the latest run was scheduled with is taken out,
+        so the offset doesn't add up from run to run.
+        """
+        if self.has_upstream_jobs:
+            return self.get_upstream_due_date()
+        if self.has_cron_schedule:
+            fire_time = self.fire_times.order_by('fire_at').first()
+            return None if fire_time is None else fire_time.fire_at
+        latest_run = self.latest_run
+        if (not latest_run or
+                latest_run.scheduled_date is None or
+                latest_run.status == LAUNCH_FAILED_STATUS):
+            # job has never run before or the cluster of the last run
+            # couldn't be launched, try again
+            return self.staggered_start_date
+        return max(
+            self.staggered_start_date,
+            latest_run.scheduled_date - latest_run.start_offset +
+            timedelta(hours=self.interval_in_hours) + self.start_offset,
+        )
+
     def is_due(self, now=None):
         """
         Whether the scheduled Spark job is due to be run based on the
-        latest run and the configured interval in hours.
+        latest run and the configured interval in hours, or its cron
+        schedule.
         """
         if now is None:
             now = timezone.now()
-        if not self.latest_run or self.latest_run.scheduled_date is None:
-            # job has never run before
-            hours_since_last_run = float('inf')
-        else:
-            hours_since_last_run = (now - self.latest_run.scheduled_date).total_seconds() // 3600
+        due_date = self.get_due_date()
+        return due_date is not None and due_date <= now
 
-        return hours_since_last_run >= self.interval_in_hours
+    @property
+    def next_run_date(self):
+        """
+        The date/time the job is due to run next based on the latest run,
+        the interval and the start date, or None if the job is disabled
+        or past its end date.
+        """
+        if not self.is_enabled:
+            return None
+        next_run_date = self.get_due_date()
+        if next_run_date is None:
+            return None
+        if (self.end_date is not None and
+                max(next_run_date, timezone.now()) > self.end_date):
+            return None
+        return next_run_date
 
     def should_run(self):
         """Whether the scheduled Spark job should run."""
         if not self.is_runnable:
             return False  # the job is still running, don't start it again
         now = timezone.now()
-        active = self.start_date <= now
+        # the fire times of cron schedules start at the start date
+        active = self.has_cron_schedule or self.staggered_start_date <= now
         if self.end_date is not None:
             active = active and self.end_date >= now
         return (
@@ -211,54 +475,378 @@ class SparkJob(EMRReleaseModel, CreatedByModel):
             self.is_due(now)
         )
 
-    def run(self):
-        """Actually run the scheduled Spark job."""
-        # if the job ran before and is still running, don't start it again
-        if not self.is_runnable:
-            return
-        jobflow_id = self.provisioner.run(
-            user_email=self.created_by.email,
-            identifier=self.identifier,
-            emr_release=self.emr_release,
-            size=self.size,
-            notebook_key=self.notebook_s3_key,
-            is_public=self.is_public,
-            job_timeout=self.job_timeout,
-        )
-        # Create new job history record.
-        run = self.runs.create(
-            spark_job=self,
-            jobflow_id=jobflow_id,
-            scheduled_date=timezone.now(),
-        )
-        # Remove the cached latest run to this objects will requery it.
+    def reserve_run(self, attempt=1):
+        """
+        Reserve a new run of the job in a short transaction and return it,
+        or return None if the job is still running or another process
+        reserved a run in the meantime.
+        """
+        with transaction.atomic():
+            # lock the job so only one process can reserve a run at a time
+            SparkJob.objects.select_for_update().get(pk=self.pk)
+            self.clear_latest_run()
+            # if the job ran before and is still running, don't start it again
+            if not self.is_runnable:
+                return None
+            run = self.runs.create(
+                status=RESERVED_STATUS,
+                scheduled_date=timezone.now(),
+                start_offset=self.start_offset,
+                attempt=attempt,
+            )
+            self.consume_fire_times(now=run.scheduled_date)
+        self.clear_latest_run()
+        return run
+
+    def run(self, attempt=1):
+        """
+        Actually run the scheduled Spark job.
+
+        The run is reserved first, then the cluster is launched outside
+        of any database transaction and the reservation is confirmed with
+        the jobflow ID (or marked as failed). Retries after an instance
+        failure, with an attempt after the first, use on-demand instances.
+
+        Returns the new run or None if the job wasn't run.
+        """
+        run = self.reserve_run(attempt=attempt)
+        if run is None:
+            return None
         try:
-            delattr(self, 'latest_run')
-        except AttributeError:
-            pass  # It didn't have a `latest_run` and that's ok.
+            jobflow_id = self.provisioner.run(
+                user_email=self.created_by.email,
+                identifier=self.identifier,
+                emr_release=self.emr_release,
+                size=self.size,
+                notebook_key=self.notebook_s3_key,
+                is_public=self.is_public,
+                job_timeout=self.job_timeout,
+                use_spot=run.use_spot,
+                max_size=self.max_size,
+            )
+        except Exception:
+            run.fail_reservation()
+            raise
+        run.confirm_reservation(jobflow_id)
         run.update_status()
+        return run
+
+    @classmethod
+    def run_packed(cls, spark_jobs):
+        """
+        Run the given scheduled Spark jobs as steps on a single cluster,
+        they need to have the same packing key.
+
+        The runs are reserved and confirmed like when running a single job.
+        The cluster is as large as the largest job needs and times out
+        when all jobs would have timed out one after another, each step
+        times out after its job's timeout.
+
+        The reservations of runs whose steps couldn't be found are failed,
+        so their timeouts don't stop the shared cluster.
+
+        Returns the new runs of the jobs that weren't running already.
+        """
+        reserved = []
+        for spark_job in spark_jobs:
+            run = spark_job.reserve_run()
+            if run is not None:
+                reserved.append((spark_job, run))
+        if not reserved:
+            return []
+        first_job = reserved[0][0]
+        try:
+            jobflow_id, step_ids = first_job.provisioner.run_packed(
+                user_email=settings.AWS_CONFIG['EMAIL_SOURCE'],
+                identifier=PACKED_IDENTIFIER,
+                emr_release=first_job.emr_release,
+                size=max(spark_job.size for spark_job, run in reserved),
+                notebooks=[
+                    (spark_job.identifier, spark_job.notebook_s3_key, spark_job.job_timeout)
+                    for spark_job, run in reserved
+                ],
+                is_public=first_job.is_public,
+                job_timeout=sum(spark_job.job_timeout for spark_job, run in reserved),
+            )
+        except Exception:
+            for spark_job, run in reserved:
+                run.fail_reservation()
+            raise
+        runs = []
+        for spark_job, run in reserved:
+            step_id = step_ids.get(spark_job.identifier)
+            if step_id is None:
+                run.fail_reservation()
+                continue
+            run.confirm_reservation(jobflow_id, step_id=step_id)
+            run.update_status()
+            runs.append(run)
+        return runs
+
+    @property
+    def running_jobflow_id(self):
+        """The jobflow ID of the cluster of the current run, if any."""
+        if self.is_runnable:
+            return None
+        return self.latest_run.jobflow_id
+
+    @property
+    def running_step_id(self):
+        """The step ID of the current run if it shares its cluster."""
+        if self.is_runnable:
+            return None
+        return self.latest_run.step_id
+
+    def get_backfill_dates(self, start_date, end_date):
+        """
+        The logical dates of the periods of the job's schedule from the
+        given start date up to the given end date, limited to one more
+        than the maximum number of runs of a backfill.
+        """
+        limit = MAX_BACKFILL_RUNS + 1
+        if self.has_cron_schedule:
+            dates = cron.fire_times(
+                self.crontab,
+                after=start_date - timedelta(seconds=1),
+                count=limit,
+            )
+            return [date for date in dates if date <= end_date]
+        dates = []
+        date = start_date
+        while date <= end_date and len(dates) < limit:
+            dates.append(date)
+            date += timedelta(hours=self.interval_in_hours)
+        return dates
+
+    def backfill(self, start_date, end_date, concurrency):
+        """
+        Create a backfill with a pending run for each period of the job's
+        schedule from the given start date up to the given end date.
+        """
+        with transaction.atomic():
+            backfill = self.backfills.create(
+                start_date=start_date,
+                end_date=end_date,
+                concurrency=concurrency,
+            )
+            SparkJobRun.objects.bulk_create([
+                SparkJobRun(spark_job=self, backfill=backfill, logical_date=logical_date)
+                for logical_date in self.get_backfill_dates(start_date, end_date)
+            ])
+        return backfill
 
     def terminate(self):
         """Stop the currently running scheduled Spark job."""
-        if self.is_expired and self.latest_run:
-            self.cluster_provisioner.stop(self.latest_run.jobflow_id)
+        if self.is_expired and self.latest_run and self.latest_run.jobflow_id:
+            if self.latest_run.step_id:
+                # don't stop the cluster the other packed jobs run on,
+                # a running step stops at its own timeout
+                self.provisioner.cancel_step(
+                    self.latest_run.jobflow_id,
+                    self.latest_run.step_id,
+                )
+            else:
+                self.cluster_provisioner.stop(self.latest_run.jobflow_id)
 
     def cleanup(self):
         """Remove the Spark job notebook file from S3"""
         self.provisioner.remove(self.notebook_s3_key)
 
-    def delete(self, *args, **kwargs):
-        # make sure to shut down the cluster if it's currently running
-        self.terminate()
-        # make sure to clean up the job notebook from storage
-        self.cleanup()
+    def delete(self, *args, cleanup=True, **kwargs):
+        """
+        Delete the job, pass cleanup=False to leave stopping the cluster
+        and removing the notebook to the caller, e.g. a background task.
+        """
+        if cleanup:
+            # make sure to shut down the cluster if it's currently running
+            self.terminate()
+            # make sure to clean up the job notebook from storage
+            self.cleanup()
+        QueuedLaunch.objects.filter(
+            task=QueuedLaunch.TASK_LAUNCH_SPARK_JOB,
+            object_id=self.pk,
+        ).delete()
         super().delete(*args, **kwargs)
 
     def get_results(self):
         return self.provisioner.results(self.identifier, self.is_public)
 
+    def update_runtime_stats(self):
+        """
+        Recompute the runtime statistics from the latest successful runs,
+        to be called when a run finished.
+        """
+        durations = [
+            # whole seconds are precise enough
+            timedelta(seconds=round((terminated_date - scheduled_date).total_seconds()))
+            for scheduled_date, terminated_date in self.runs.filter(
+                status=Cluster.STATUS_TERMINATED,
+                scheduled_date__isnull=False,
+                terminated_date__isnull=False,
+            ).order_by('-terminated_date').values_list(
+                'scheduled_date', 'terminated_date',
+            )[:RUNTIME_STATS_RUN_COUNT]
+        ]
+        if not durations:
+            return None
+        # compare the newer half of the runs with the older half
+        middle = len(durations) // 2
+        trend = 1.0
+        if middle:
+            newer = sorted(durations[:middle])
+            older = sorted(durations[middle:])
+            # runs that took no time at all can't be compared with
+            if percentile(older, 50):
+                trend = percentile(newer, 50) / percentile(older, 50)
+        durations.sort()
+        stats, created = SparkJobRuntimeStats.objects.update_or_create(
+            spark_job=self,
+            defaults={
+                'run_count': len(durations),
+                'median_duration': percentile(durations, 50),
+                'p95_duration': percentile(durations, 95),
+                'trend': trend,
+            },
+        )
+        return stats
+
+
+class SparkJobFireTime(models.Model):
+    """
+    An upcoming date/time at which a Spark job with a cron schedule is due,
+    precomputed so the due jobs can be queried by an index range scan.
+    """
+    spark_job = models.ForeignKey(
+        SparkJob,
+        on_delete=models.CASCADE,
+        related_name='fire_times',
+        related_query_name='fire_times',
+    )
+    fire_at = models.DateTimeField(
+        db_index=True,
+        help_text="Date/time that the job is due to run.",
+    )
+
+    class Meta:
+        ordering = ['fire_at']
+        unique_together = [
+            ['spark_job', 'fire_at'],
+        ]
+
+    def __str__(self):
+        return '%s at %s' % (self.spark_job_id, self.fire_at)
+
+    def __repr__(self):
+        return '<SparkJobFireTime {}>'.format(self)
+
+
+class SparkJobBackfill(EditedAtModel):
+    """
+    A group of runs of a Spark job for the periods of a date range, e.g.
+    to re-run the periods that were missed, launched in parallel up to a
+    concurrency cap.
+    """
+    spark_job = models.ForeignKey(
+        SparkJob,
+        on_delete=models.CASCADE,
+        related_name='backfills',
+        related_query_name='backfills',
+    )
+    start_date = models.DateTimeField(
+        help_text="Logical date/time of the first period to run.",
+    )
+    end_date = models.DateTimeField(
+        help_text="Logical date/time up to which the periods are run.",
+    )
+    concurrency = models.PositiveIntegerField(
+        default=2,
+        help_text="Maximum number of runs that are active at a time.",
+    )
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return '%s from %s to %s' % (self.spark_job_id, self.start_date, self.end_date)
+
+    def __repr__(self):
+        return '<SparkJobBackfill {}>'.format(self)
+
+    @property
+    def pending_runs(self):
+        return self.runs.filter(status=DEFAULT_STATUS).order_by('logical_date')
+
+    @property
+    def active_runs(self):
+        return self.runs.filter(
+            status__in=Cluster.ACTIVE_STATUS_LIST + (RESERVED_STATUS,),
+        )
+
+    @property
+    def is_finished(self):
+        return not self.pending_runs.exists() and not self.active_runs.exists()
+
+    @property
+    def progress(self):
+        """The numbers of runs that are pending, active, succeeded and failed."""
+        progress = OrderedDict([
+            ('pending', 0),
+            ('active', 0),
+            ('succeeded', 0),
+            ('failed', 0),
+        ])
+        for status in self.runs.values_list('status', flat=True):
+            if status == DEFAULT_STATUS:
+                progress['pending'] += 1
+            elif status == Cluster.STATUS_TERMINATED:
+                progress['succeeded'] += 1
+            elif status in Cluster.FAILED_STATUS_LIST + (LAUNCH_FAILED_STATUS,):
+                progress['failed'] += 1
+            else:
+                progress['active'] += 1
+        return progress
+
+    def launch_next_run(self):
+        """
+        Launch the pending run with the earliest logical date, passing the
+        logical date to the notebook.
+
+        The run is reserved first like a scheduled run, returns the run or
+        None if no run is pending or another process reserved it.
+        """
+        run = self.pending_runs.first()
+        if run is None:
+            return None
+        run.status = RESERVED_STATUS
+        run.scheduled_date = timezone.now()
+        if not run.compare_and_save(['status', 'scheduled_date'], status=DEFAULT_STATUS):
+            return None
+        spark_job = self.spark_job
+        try:
+            jobflow_id = spark_job.provisioner.run(
+                user_email=spark_job.created_by.email,
+                identifier=spark_job.identifier,
+                emr_release=spark_job.emr_release,
+                size=spark_job.size,
+                notebook_key=spark_job.notebook_s3_key,
+                is_public=spark_job.is_public,
+                job_timeout=spark_job.job_timeout,
+                logical_date=run.logical_date,
+                use_spot=run.use_spot,
+                max_size=spark_job.max_size,
+            )
+        except Exception:
+            run.fail_reservation()
+            raise
+        run.confirm_reservation(jobflow_id)
+        run.update_status()
+        return run
+
 
 class SparkJobRun(EditedAtModel):
+    # the EMR state change reason code of clusters that failed because
+    # instances were lost, e.g. because spot capacity was reclaimed
+    INSTANCE_FAILURE_REASON_CODE = 'INSTANCE_FAILURE'
 
     spark_job = models.ForeignKey(
         SparkJob,
@@ -271,6 +859,12 @@ class SparkJobRun(EditedAtModel):
         blank=True,
         null=True,
     )
+    step_id = models.CharField(
+        max_length=50,
+        blank=True,
+        null=True,
+        help_text="ID of the EMR step if the run shares its cluster with other runs.",
+    )
     status = models.CharField(
         max_length=50,
         blank=True,
@@ -281,6 +875,29 @@ class SparkJobRun(EditedAtModel):
         null=True,
         help_text="Date/time that the job was scheduled.",
     )
+    start_offset = models.DurationField(
+        default=timedelta(0),
+        help_text="Start offset of the job at the time the run was scheduled.",
+    )
+    backfill = models.ForeignKey(
+        SparkJobBackfill,
+        on_delete=models.CASCADE,
+        blank=True,
+        null=True,
+        related_name='runs',
+        related_query_name='runs',
+        help_text="Backfill the run is part of, if any.",
+    )
+    logical_date = models.DateTimeField(
+        blank=True,
+        null=True,
+        help_text="Date/time of the period a backfill run is for.",
+    )
+    attempt = models.PositiveIntegerField(
+        default=1,
+        help_text="Number of the attempt, retries after instance failures "
+                  "run on on-demand instances.",
+    )
     run_date = models.DateTimeField(
         blank=True,
         null=True,
@@ -302,30 +919,176 @@ class SparkJobRun(EditedAtModel):
         return "<SparkJobRun {} from job {}>".format(self.jobflow_id,
                                                      self.spark_job.identifier)
 
+    @property
+    def is_packed(self):
+        """Whether the run is a step on a cluster shared with other runs."""
+        return bool(self.step_id)
+
+    @property
+    def use_spot(self):
+        """
+        Whether the workers of the run's cluster are spot instances, only
+        for the first attempt.
+        """
+        return (
+            self.attempt == 1 and
+            self.spark_job.provisioner.uses_spot_instances(self.spark_job.size)
+        )
+
+    def can_fail_over(self, info):
+        """
+        Whether the run failed because of lost instances and is to be
+        relaunched on on-demand instances right away.
+
+        Packed runs share their cluster with other runs and are left to
+        their next scheduled run.
+        """
+        return (
+            not self.is_packed and
+            info['state_change_reason_code'] == self.INSTANCE_FAILURE_REASON_CODE and
+            self.attempt <= constance.config.AWS_SPOT_FAILOVER_RETRIES
+        )
+
+    def fail_over(self):
+        """Queue the relaunch of the run once the transaction is committed."""
+        # imported here since the tasks module loads the Celery app
+        from .tasks import fail_over_spark_job_run
+
+        transaction.on_commit(lambda: fail_over_spark_job_run.delay(self.pk))
+
+    def relaunch(self):
+        """
+        Launch the failed run again on on-demand instances and return the
+        new run, or None if the job ran again in the meantime.
+
+        Backfill runs are added to the pending runs of their backfill.
+        """
+        attempt = self.attempt + 1
+        if self.backfill_id is not None:
+            return self.backfill.runs.create(
+                spark_job_id=self.spark_job_id,
+                logical_date=self.logical_date,
+                attempt=attempt,
+            )
+        if self.spark_job.latest_run != self:
+            return None
+        return self.spark_job.run(attempt=attempt)
+
+    @property
+    def peak_node_count(self):
+        """The highest recorded number of worker nodes, if any."""
+        return self.node_counts.aggregate(
+            peak=models.Max('node_count'),
+        )['peak']
+
+    def record_node_count(self, now=None):
+        """
+        Record the current number of worker nodes of the run's auto-scaling
+        cluster if it changed since the last record.
+
+        Returns the new record or None if the count didn't change.
+        """
+        node_count = self.spark_job.cluster_provisioner.node_count(self.jobflow_id)
+        latest = self.node_counts.last()
+        if latest is not None and latest.node_count == node_count:
+            return None
+        return self.node_counts.create(
+            recorded_at=now or timezone.now(),
+            node_count=node_count,
+        )
+
+    def expire_on_timeout(self):
+        """
+        Queue the termination of the run for when it times out, once the
+        transaction is committed.
+        """
+        # imported here since the tasks module loads the Celery app
+        from .tasks import expire_spark_job
+
+        eta = self.run_date + timedelta(hours=self.spark_job.job_timeout)
+        transaction.on_commit(
+            lambda: expire_spark_job.apply_async(args=[self.spark_job_id], eta=eta)
+        )
+
     def get_info(self):
+        if self.is_packed:
+            return self.spark_job.provisioner.step_info(self.jobflow_id, self.step_id)
         return self.spark_job.cluster_provisioner.info(self.jobflow_id)
 
-    def update_status(self, info=None):
+    def confirm_reservation(self, jobflow_id, step_id=None):
+        """
+        Store the jobflow ID of the launched cluster (and the step ID if the
+        cluster is shared) for the reserved run, the status stays reserved
+        until the cluster status was fetched.
+        """
+        self.jobflow_id = jobflow_id
+        self.step_id = step_id
+        self.compare_and_save(['jobflow_id', 'step_id'], status=RESERVED_STATUS)
+
+    def fail_reservation(self):
+        """Mark the reserved run as failed to launch a cluster."""
+        self.status = LAUNCH_FAILED_STATUS
+        self.terminated_date = timezone.now()
+        self.compare_and_save(['status', 'terminated_date'], status=RESERVED_STATUS)
+
+    def status_transition(self):
+        """An unsaved status transition log entry for the current status."""
+        return ClusterStatusTransition(
+            jobflow_id=self.jobflow_id,
+            emr_release=self.spark_job.emr_release,
+            size=self.spark_job.size,
+            status=self.status,
+        )
+
+    def update_status(self, info=None, transitions=None):
         """
         Updates latest status and life cycle datetimes.
+
+        The status transition is logged right away, or appended to the
+        given list of transitions to be stored in bulk by the caller.
         """
         if info is None:
             info = self.get_info()
         if self.status != info['state']:
+            previous_status = self.status
             self.status = info['state']
             if self.status == Cluster.STATUS_RUNNING:
                 self.run_date = timezone.now()
             elif self.status in Cluster.FINAL_STATUS_LIST:
                 # set the terminated date to now
                 self.terminated_date = timezone.now()
-                # if the job cluster terminated with error raise the alarm
-                if self.status == Cluster.STATUS_TERMINATED_WITH_ERRORS:
+            saved = self.compare_and_save(
+                ['status', 'run_date', 'terminated_date'],
+                status=previous_status,
+            )
+            if not saved:
+                # another process already stored a newer status
+                self.refresh_from_db()
+                return self.status
+            if self.is_packed and self.status == Cluster.STATUS_RUNNING:
+                self.expire_on_timeout()
+            # the statuses of packed runs are the ones of their steps
+            if self.jobflow_id is not None and not self.is_packed:
+                if transitions is None:
+                    self.status_transition().save()
+                else:
+                    transitions.append(self.status_transition())
+            # if the job cluster terminated with error raise the alarm,
+            # unless it only lost its instances and is relaunched
+            if self.status == Cluster.STATUS_TERMINATED_WITH_ERRORS:
+                if self.can_fail_over(info):
+                    self.fail_over()
+                else:
                     SparkJobRunAlert.objects.create(
                         run=self,
                         reason_code=info['state_change_reason_code'],
                         reason_message=info['state_change_reason_message'],
                     )
-            self.save()
+            elif self.status == Cluster.STATUS_TERMINATED:
+                self.spark_job.update_runtime_stats()
+                # run the jobs that were waiting for this one to complete
+                if self.backfill_id is None:
+                    self.spark_job.dispatch_downstream_jobs()
         return self.status
 
 
@@ -355,3 +1118,86 @@ class SparkJobRunAlert(EditedAtModel):
         null=True,
         help_text="The datetime the alert email was sent.",
     )
+
+
+class SparkJobRunNodeCount(models.Model):
+    """
+    The number of worker nodes of an auto-scaling job run's cluster from
+    the given date/time on, recorded whenever it changed.
+    """
+    run = models.ForeignKey(
+        SparkJobRun,
+        on_delete=models.CASCADE,
+        related_name='node_counts',
+        related_query_name='node_counts',
+    )
+    recorded_at = models.DateTimeField(
+        help_text="Date/time that the node count was recorded.",
+    )
+    node_count = models.IntegerField(
+        help_text="Number of running worker nodes.",
+    )
+
+    class Meta:
+        ordering = ['recorded_at']
+
+    def __str__(self):
+        return '%s at %s' % (self.node_count, self.recorded_at)
+
+    def __repr__(self):
+        return '<SparkJobRunNodeCount {} of run {}>'.format(self, self.run_id)
+
+
+class SparkJobRuntimeStats(EditedAtModel):
+    """
+    Statistics of how long the latest successful runs of a Spark job took,
+    from being scheduled to the cluster being terminated.
+    """
+    # the minimum number of runs to base recommendations on
+    MIN_RUN_COUNT = 3
+    # the run duration a job's cluster size should aim for
+    TARGET_DURATION = timedelta(hours=1)
+    # how much longer than the p95 duration the timeout should be
+    TIMEOUT_FACTOR = 1.5
+
+    spark_job = ForgivingOneToOneField(
+        SparkJob,
+        on_delete=models.CASCADE,
+        related_name='runtime_stats',  # spark_job.runtime_stats
+        primary_key=True,
+    )
+    run_count = models.IntegerField(
+        help_text="Number of runs the statistics are based on.",
+    )
+    median_duration = models.DurationField(
+        help_text="Median duration of the runs.",
+    )
+    p95_duration = models.DurationField(
+        help_text="95th percentile of the duration of the runs.",
+    )
+    trend = models.FloatField(
+        default=1.0,
+        help_text="Median duration of the newer half of the runs relative to "
+                  "the older half, e.g. 1.2 if they took 20% longer.",
+    )
+
+    @property
+    def has_recommendations(self):
+        return self.run_count >= self.MIN_RUN_COUNT
+
+    @property
+    def recommended_timeout(self):
+        """The timeout in hours that leaves room above the p95 duration."""
+        hours = self.p95_duration.total_seconds() * self.TIMEOUT_FACTOR / 3600
+        return min(max(int(math.ceil(hours)), 1), 24)
+
+    @property
+    def recommended_size(self):
+        """
+        The cluster size that would still finish the runs within the target
+        duration, assuming the runtime scales with the size, but never more
+        than the current size.
+        """
+        size = self.spark_job.size
+        ratio = self.p95_duration / self.TARGET_DURATION
+        return min(max(int(math.ceil(size * ratio)), 1), size)
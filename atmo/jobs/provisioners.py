@@ -3,12 +3,29 @@
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 from collections import OrderedDict
 
+from ..clusters.models import Cluster
 from ..provisioners import Provisioner
 
 
 class SparkJobProvisioner(Provisioner):
     log_dir = 'jobs'
 
+    # the cluster statuses the step states of packed job runs map to
+    STEP_STATE_MAP = {
+        'PENDING': Cluster.STATUS_PENDING,
+        'RUNNING': Cluster.STATUS_RUNNING,
+        'CANCEL_PENDING': Cluster.STATUS_TERMINATING,
+        'COMPLETED': Cluster.STATUS_TERMINATED,
+        'CANCELLED': Cluster.STATUS_TERMINATED_WITH_ERRORS,
+        'FAILED': Cluster.STATUS_TERMINATED_WITH_ERRORS,
+        'INTERRUPTED': Cluster.STATUS_TERMINATED_WITH_ERRORS,
+    }
+    # runs the downloaded job shell script with the remaining arguments,
+    # the first one being the S3 URI of the script
+    TIMEOUT_COMMAND = 'aws s3 cp "$0" ./batch.sh && exec bash ./batch.sh "$@"'
+    # how long a timed out step has to exit before it's killed
+    TIMEOUT_KILL_AFTER = '5m'
+
     def __init__(self):
         super().__init__()
         # the S3 URI to the job shell script
@@ -32,8 +49,65 @@ class SparkJobProvisioner(Provisioner):
     def remove(self, key):
         self.s3.delete_object(Bucket=self.config['CODE_BUCKET'], Key=key)
 
+    def data_bucket(self, is_public):
+        if is_public:
+            return self.config['PUBLIC_DATA_BUCKET']
+        else:
+            return self.config['PRIVATE_DATA_BUCKET']
+
+    def notebook_step(self, name, identifier, notebook_key, is_public,
+                      action_on_failure='TERMINATE_JOB_FLOW', logical_date=None,
+                      job_timeout=None):
+        """
+        Returns the parameters of the EMR step running the given notebook,
+        for the period of the given logical date if any, e.g. a backfill.
+
+        If a timeout in hours is given the step fails once it ran that long,
+        e.g. for steps on a shared cluster which the cluster's timeout
+        doesn't apply to.
+        """
+        # the S3 URI to the Jupyter notebook file
+        notebook_uri = 's3://%s/%s' % (self.config['CODE_BUCKET'], notebook_key)
+        args = [
+            self.batch_uri,
+            '--job-name', identifier,
+            '--notebook', notebook_uri,
+            '--data-bucket', self.data_bucket(is_public),
+        ]
+        if logical_date is not None:
+            args.extend(['--date', logical_date.strftime('%Y%m%d')])
+        if job_timeout is None:
+            jar = self.jar_uri
+        else:
+            # the script runner can't limit the run time of the script
+            jar = 'command-runner.jar'
+            args = [
+                'timeout', '--kill-after', self.TIMEOUT_KILL_AFTER, '%sm' % (job_timeout * 60),
+                'bash', '-c', self.TIMEOUT_COMMAND,
+            ] + args
+        return {
+            'Name': name,
+            'ActionOnFailure': action_on_failure,
+            'HadoopJarStep': {
+                'Jar': jar,
+                'Args': args,
+            }
+        }
+
+    def bootstrap_actions(self, job_timeout):
+        return [{
+            'Name': 'setup-telemetry-spark-job',
+            'ScriptBootstrapAction': {
+                'Path': self.script_uri,
+                'Args': [
+                    '--timeout', str(job_timeout * 60),
+                ]
+            }
+        }]
+
     def run(self, user_email, identifier, emr_release, size,
-            notebook_key, is_public, job_timeout):
+            notebook_key, is_public, job_timeout, logical_date=None,
+            use_spot=None, max_size=None):
 
         # first get the common job flow parameters
         job_flow_params = self.job_flow_params(
@@ -41,53 +115,136 @@ class SparkJobProvisioner(Provisioner):
             identifier=identifier,
             emr_release=emr_release,
             size=size,
+            use_spot=use_spot,
+            max_size=max_size,
         )
 
-        # the S3 URI to the Jupyter notebook file
-        notebook_uri = 's3://%s/%s' % (self.config['CODE_BUCKET'], notebook_key)
+        job_flow_params.update({
+            'BootstrapActions': self.bootstrap_actions(job_timeout),
+            'Steps': [
+                self.notebook_step(
+                    name='RunNotebookStep',
+                    identifier=identifier,
+                    notebook_key=notebook_key,
+                    is_public=is_public,
+                    logical_date=logical_date,
+                ),
+            ],
+        })
 
-        if is_public:
-            data_bucket = self.config['PUBLIC_DATA_BUCKET']
-        else:
-            data_bucket = self.config['PRIVATE_DATA_BUCKET']
+        cluster = self.emr.run_job_flow(**job_flow_params)
+        return cluster['JobFlowId']
+
+    def step_name(self, identifier):
+        return 'RunNotebookStep-%s' % identifier
+
+    def run_packed(self, user_email, identifier, emr_release, size,
+                   notebooks, is_public, job_timeout):
+        """
+        Spawns a single cluster running the given notebooks, a list of
+        (job identifier, notebook key, job timeout) tuples, as consecutive
+        steps that fail once they ran longer than their job's timeout.
+
+        A failing step doesn't affect the other steps. Returns the jobflow
+        ID and a mapping of the job identifiers to their step IDs.
+        """
+        job_flow_params = self.job_flow_params(
+            user_email=user_email,
+            identifier=identifier,
+            emr_release=emr_release,
+            size=size,
+        )
 
         job_flow_params.update({
-            'BootstrapActions': [{
-                'Name': 'setup-telemetry-spark-job',
-                'ScriptBootstrapAction': {
-                    'Path': self.script_uri,
-                    'Args': [
-                        '--timeout', str(job_timeout * 60),
-                    ]
-                }
-            }],
-            'Steps': [{
-                'Name': 'RunNotebookStep',
-                'ActionOnFailure': 'TERMINATE_JOB_FLOW',
-                'HadoopJarStep': {
-                    'Jar': self.jar_uri,
-                    'Args': [
-                        self.batch_uri,
-                        '--job-name', identifier,
-                        '--notebook', notebook_uri,
-                        '--data-bucket', data_bucket
-                    ]
-                }
-            }],
+            'BootstrapActions': self.bootstrap_actions(job_timeout),
+            'Steps': [
+                self.notebook_step(
+                    name=self.step_name(notebook_identifier),
+                    identifier=notebook_identifier,
+                    notebook_key=notebook_key,
+                    is_public=is_public,
+                    action_on_failure='CONTINUE',
+                    job_timeout=notebook_timeout,
+                )
+                for notebook_identifier, notebook_key, notebook_timeout in notebooks
+            ],
         })
 
         cluster = self.emr.run_job_flow(**job_flow_params)
-        return cluster['JobFlowId']
+        jobflow_id = cluster['JobFlowId']
 
-    def results(self, identifier, is_public):
-        if is_public:
-            bucket = self.config['PUBLIC_DATA_BUCKET']
+        # the steps are known right away, but only by their names
+        step_ids = {}
+        names = {
+            self.step_name(notebook_identifier): notebook_identifier
+            for notebook_identifier, notebook_key, notebook_timeout in notebooks
+        }
+        list_steps_paginator = self.emr.get_paginator('list_steps')
+        for page in list_steps_paginator.paginate(ClusterId=jobflow_id):
+            for step in page.get('Steps', []):
+                if step['Name'] in names:
+                    step_ids[names[step['Name']]] = step['Id']
+        return jobflow_id, step_ids
+
+    def format_step(self, step):
+        """
+        Formats the data returned by the EMR API about a step like the
+        cluster info, mapping the step states to the cluster statuses.
+        """
+        status = step['Status']
+        state = self.STEP_STATE_MAP.get(status['State'], status['State'])
+        failure_details = status.get('FailureDetails', {})
+        if state == Cluster.STATUS_TERMINATED_WITH_ERRORS:
+            state_change_reason_code = Cluster.STATE_CHANGE_REASON_STEP_FAILURE
+            state_change_reason_message = (
+                failure_details.get('Message') or
+                status.get('StateChangeReason', {}).get('Message') or
+                'Step %s' % status['State'].lower()
+            )
         else:
-            bucket = self.config['PRIVATE_DATA_BUCKET']
+            state_change_reason_code = None
+            state_change_reason_message = None
+        return {
+            'step_id': step['Id'],
+            'state': state,
+            'state_change_reason_code': state_change_reason_code,
+            'state_change_reason_message': state_change_reason_message,
+        }
+
+    def step_info(self, jobflow_id, step_id):
+        """
+        Returns the info for the step with the given ID on the cluster with
+        the given jobflow ID, in the same format as the cluster info.
+        """
+        step = self.emr.describe_step(ClusterId=jobflow_id, StepId=step_id)['Step']
+        return self.format_step(step)
+
+    def list_steps(self, jobflow_id):
+        """
+        Returns the infos of all steps on the cluster with the given
+        jobflow ID, mapped by step ID.
+        """
+        steps = {}
+        list_steps_paginator = self.emr.get_paginator('list_steps')
+        for page in list_steps_paginator.paginate(ClusterId=jobflow_id):
+            for step in page.get('Steps', []):
+                steps[step['Id']] = self.format_step(step)
+        return steps
+
+    def cancel_step(self, jobflow_id, step_id):
+        """
+        Cancels the step with the given ID without stopping the cluster
+        with the given jobflow ID, e.g. for packed job runs.
 
+        EMR only cancels pending steps, running steps stop at the timeout
+        they were added with.
+        """
+        self.emr.cancel_steps(ClusterId=jobflow_id, StepIds=[step_id])
+
+    def results(self, identifier, is_public):
         params = {
             'Prefix': '%s/' % identifier,
-            'Bucket': bucket,
+            'Bucket': self.data_bucket(is_public),
         }
 
         results = OrderedDict()
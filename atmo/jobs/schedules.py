@@ -0,0 +1,112 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+from collections import Counter
+from datetime import timedelta
+
+from django.utils import timezone
+
+from ..schedules import remove_entry, schedule_entry
+from .models import SparkJob
+
+# the granularity of the launch timeline the start offsets are computed on
+STAGGER_SLOT = timedelta(minutes=5)
+# the maximum delay of the scheduled runs of a job
+STAGGER_MAX_OFFSET = timedelta(minutes=30)
+# how long to wait until checking again on a job that is due but can't run
+# yet, e.g. because its latest run is still running, and how often jobs
+# without an interval are checked if their next run wasn't scheduled
+RESCHEDULE_DELAY = timedelta(minutes=5)
+
+
+def entry_name(spark_job_id):
+    return 'spark-job-%s' % spark_job_id
+
+
+def schedule_spark_job(spark_job):
+    """
+    Register the next run of the given Spark job as an individual schedule
+    entry or remove it if the job isn't going to run anymore.
+
+    The entry is never due in the past, RedBeat would fire it on every
+    tick otherwise, e.g. while the job's latest run is still running.
+    """
+    next_run_date = spark_job.next_run_date
+    if next_run_date is None:
+        unschedule_spark_job(spark_job.pk)
+        return None
+    if spark_job.has_cron_schedule or spark_job.has_upstream_jobs:
+        # the interval doesn't apply, the next run is scheduled explicitly
+        run_every = RESCHEDULE_DELAY
+    else:
+        run_every = timedelta(hours=spark_job.interval_in_hours)
+    return schedule_entry(
+        name=entry_name(spark_job.pk),
+        task='atmo.jobs.tasks.run_job',
+        run_every=run_every,
+        due_at=max(next_run_date, timezone.now() + RESCHEDULE_DELAY),
+        args=[spark_job.pk],
+    )
+
+
+def unschedule_spark_job(spark_job_id):
+    """Remove the schedule entry of the Spark job with the given ID."""
+    remove_entry(entry_name(spark_job_id))
+
+
+def compute_start_offsets(spark_jobs):
+    """
+    Returns a mapping of the IDs of the given Spark jobs to start offsets
+    that flatten the peaks of launches in the daily launch timeline.
+
+    All intervals are multiples of a day, so the jobs launch at the time
+    of day of their start date, weighted by how often they run. The jobs
+    are placed one after another, each in the least busy slot from its
+    start time up to the maximum offset, the earliest in case of a tie.
+    The result only depends on the jobs' schedules and IDs.
+    """
+    slot_count = int(timedelta(days=1) / STAGGER_SLOT)
+    max_slots = int(STAGGER_MAX_OFFSET / STAGGER_SLOT)
+    load = Counter()
+    offsets = {}
+
+    def start_slot(spark_job):
+        start_date = spark_job.start_date
+        seconds = start_date.hour * 3600 + start_date.minute * 60 + start_date.second
+        return int(seconds // STAGGER_SLOT.total_seconds())
+
+    for spark_job in sorted(spark_jobs, key=lambda job: (start_slot(job), job.pk)):
+        weight = SparkJob.INTERVAL_DAILY / spark_job.interval_in_hours
+        first_slot = start_slot(spark_job)
+        best = min(
+            range(max_slots + 1),
+            key=lambda delay: (load[(first_slot + delay) % slot_count], delay),
+        )
+        load[(first_slot + best) % slot_count] += weight
+        offsets[spark_job.pk] = best * STAGGER_SLOT
+    return offsets
+
+
+def stagger_spark_jobs():
+    """
+    Recompute the start offsets of all enabled Spark jobs that run at an
+    interval and reschedule the jobs whose offset changed, returns those
+    jobs.
+    """
+    spark_jobs = list(SparkJob.objects.filter(is_enabled=True))
+    # jobs with a cron schedule run exactly when they were told to and
+    # jobs with upstream jobs as soon as those completed
+    offsets = compute_start_offsets([
+        spark_job for spark_job in spark_jobs
+        if not spark_job.has_cron_schedule and not spark_job.has_upstream_jobs
+    ])
+    changed = []
+    for spark_job in spark_jobs:
+        offset = offsets.get(spark_job.pk, timedelta(0))
+        if offset == spark_job.start_offset:
+            continue
+        spark_job.start_offset = offset
+        SparkJob.objects.filter(pk=spark_job.pk).update(start_offset=offset)
+        schedule_spark_job(spark_job)
+        changed.append(spark_job)
+    return changed
@@ -2,27 +2,56 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 import logging
+from collections import OrderedDict, defaultdict
+from datetime import timedelta
+
+import constance
 
 from django.conf import settings
+from django.core.cache import cache
 from django.db import transaction
 from django.template.loader import render_to_string
 from django.utils import timezone
 
 from atmo.celery import celery
-from atmo.clusters.models import Cluster
+from atmo.clusters import admission
+from atmo.clusters.models import Cluster, ClusterStatusTransition, QueuedLaunch
 from atmo.clusters.provisioners import ClusterProvisioner
 
 from .. import email
-from .models import SparkJob, SparkJobRunAlert
+from .models import (DEFAULT_STATUS, LAUNCH_FAILED_STATUS,
+                     RESERVATION_TIMEOUT, RESERVED_STATUS, SparkJob,
+                     SparkJobBackfill, SparkJobRun, SparkJobRunAlert)
+from .provisioners import SparkJobProvisioner
+from .schedules import (schedule_spark_job, stagger_spark_jobs,
+                        unschedule_spark_job)
 
 logger = logging.getLogger(__name__)
 
+# how long a queued launch of a Spark job prevents queuing another one
+LAUNCH_LOCK_TIMEOUT = 5 * 60
+
 
 @celery.autoretry_task()
 def run_jobs():
     """
-    Run all the scheduled tasks that are supposed to run.
+    Update the statuses of the active job runs and run all the scheduled
+    jobs that are supposed to run but weren't started by their individual
+    schedule entries, e.g. because they were still running at the time.
     """
+    # mark reserved runs as failed that never got a cluster, e.g. because
+    # the worker died while launching it, so the jobs can run again
+    now = timezone.now()
+    SparkJobRun.objects.filter(
+        status=RESERVED_STATUS,
+        jobflow_id__isnull=True,
+        scheduled_date__lte=now - RESERVATION_TIMEOUT,
+    ).update(
+        status=LAUNCH_FAILED_STATUS,
+        terminated_date=now,
+        modified_at=now,
+    )
+
     # first let's update the job statuses if there are prior runs
     run_jobs = []
     jobs = SparkJob.objects.all()
@@ -31,11 +60,17 @@ def run_jobs():
     jobs_with_active_runs = jobs.active().prefetch_related('runs')
     logger.debug('Updating Spark jobs: %s', jobs_with_active_runs)
 
-    # create a map between the jobflow ids of the latest runs and the jobs
-    jobflow_job_map = {
-        job.latest_run.jobflow_id: job
-        for job in jobs_with_active_runs
-    }
+    # create a map between the jobflow ids of the latest runs and the jobs,
+    # except for the runs packed on shared clusters which are updated from
+    # the statuses of their steps
+    jobflow_job_map = {}
+    packed_jobs = defaultdict(list)
+    transitions = []
+    for job in jobs_with_active_runs:
+        if job.latest_run.is_packed:
+            packed_jobs[job.latest_run.jobflow_id].append(job)
+        else:
+            jobflow_job_map[job.latest_run.jobflow_id] = job
     # get the created dates of the job runs to limit the ListCluster API call
     provisioner = ClusterProvisioner()
     runs_created_at = jobs_with_active_runs.datetimes('runs__created_at', 'day')
@@ -55,26 +90,325 @@ def run_jobs():
             logger.debug('Updating job status for %s, latest run %s', job, job.latest_run)
             # update the latest run status
             with transaction.atomic():
-                job.latest_run.update_status(cluster_info)
+                job.latest_run.update_status(cluster_info, transitions=transitions)
 
-    for job in jobs:
-        with transaction.atomic():
-            # then let's check if the job should be run at all
-            should_run = job.should_run()
-            logger.debug('Checking if job %s should run: %s', job, should_run)
-            if should_run:
-                job.run()
-                run_jobs.append(job.identifier)
-
-            # and then check if the job is expired and terminate it if needed
-            if job.is_expired:
-                logger.debug('Job %s is expired and is terminated', job)
-                # This shouldn't be required as we set a timeout in the bootstrap script,
-                # but let's keep it as a guard.
-                job.terminate()
+    spark_job_provisioner = SparkJobProvisioner()
+    for jobflow_id, packed in packed_jobs.items():
+        step_infos = spark_job_provisioner.list_steps(jobflow_id)
+        for job in packed:
+            step_info = step_infos.get(job.latest_run.step_id)
+            if step_info is None:
+                continue
+            logger.debug('Updating job status for %s, latest run %s', job, job.latest_run)
+            with transaction.atomic():
+                job.latest_run.update_status(step_info, transitions=transitions)
+    # log the status transitions of all runs at once
+    ClusterStatusTransition.objects.bulk_create(transitions)
+
+    # no transaction here, since running a job calls out to AWS EMR, it
+    # reserves and confirms the job run in separate short transactions
+    due_jobs = []
+    for job in jobs.due_candidates(now):
+        # then let's check if the job should be run at all
+        should_run = job.should_run()
+        logger.debug('Checking if job %s should run: %s', job, should_run)
+        if should_run:
+            due_jobs.append(job)
+            run_jobs.append(job.identifier)
+        else:
+            # skip the fire times that passed while the job was still running
+            job.consume_fire_times(now)
+    run_spark_jobs(due_jobs)
+
+    # record how many nodes the clusters of the auto-scaling runs use
+    for job in jobs_with_active_runs:
+        run = job.latest_run
+        if (job.max_size and not run.is_packed and
+                run.status in Cluster.READY_STATUS_LIST):
+            run.record_node_count(now)
+
+    # and then check if the running jobs are expired and terminate them if
+    # needed, in case it didn't happen when they timed out already
+    for job in jobs_with_active_runs:
+        if job.is_expired:
+            logger.debug('Job %s is expired and is terminated', job)
+            # This shouldn't be required as we set a timeout in the bootstrap script,
+            # but let's keep it as a guard.
+            job.terminate()
     return run_jobs
 
 
+def run_spark_job(spark_job, admitted=False,
+                  priority=QueuedLaunch.PRIORITY_SCHEDULED_SPARK_JOB):
+    """
+    Run the given Spark job, queue its termination for when the new run
+    times out and schedule its next run.
+
+    The launch waits in the launch queue with the given priority if it
+    would exceed the node budgets, unless it was admitted already.
+    """
+    if not admitted and not admission.admit(
+            task=QueuedLaunch.TASK_LAUNCH_SPARK_JOB,
+            object_id=spark_job.pk,
+            user=spark_job.created_by,
+            size=spark_job.peak_size,
+            priority=priority):
+        # the job is scheduled again once it was launched
+        return None
+    run = spark_job.run()
+    if run is not None:
+        expire_spark_job.apply_async(
+            args=[spark_job.pk],
+            eta=run.scheduled_date + timedelta(hours=spark_job.job_timeout),
+        )
+    schedule_spark_job(spark_job)
+    return run
+
+
+def run_packed_spark_jobs(spark_jobs):
+    """
+    Run the given Spark jobs on a shared cluster and schedule the next
+    runs, the terminations of the new runs are queued once their steps
+    started running.
+
+    The jobs are launched one by one instead if the shared cluster
+    doesn't fit the node budget right away.
+    """
+    if not admission.has_capacity(max(spark_job.size for spark_job in spark_jobs)):
+        runs = [run_spark_job(spark_job) for spark_job in spark_jobs]
+        return [run for run in runs if run is not None]
+    runs = SparkJob.run_packed(spark_jobs)
+    for spark_job in spark_jobs:
+        schedule_spark_job(spark_job)
+    return runs
+
+
+def pack_spark_jobs(spark_jobs):
+    """
+    Split the given Spark jobs into lists of packable jobs that can share
+    a cluster and the jobs that need their own cluster.
+    """
+    groups = OrderedDict()
+    single = []
+    for spark_job in spark_jobs:
+        if spark_job.is_packable:
+            groups.setdefault(spark_job.packing_key, []).append(spark_job)
+        else:
+            single.append(spark_job)
+    packs = []
+    max_steps = constance.config.SPARK_JOB_PACKING_MAX_STEPS
+    for group in groups.values():
+        for index in range(0, len(group), max_steps):
+            pack = group[index:index + max_steps]
+            if len(pack) > 1:
+                packs.append(pack)
+            else:
+                # no need to share a cluster with nobody
+                single.extend(pack)
+    return packs, single
+
+
+def run_spark_jobs(spark_jobs):
+    """
+    Run the given Spark jobs, packing the small ones on shared clusters.
+    """
+    packs, single = pack_spark_jobs(spark_jobs)
+    for pack in packs:
+        logger.debug('Running Spark jobs %s on a shared cluster', pack)
+        run_packed_spark_jobs(pack)
+    for spark_job in single:
+        run_spark_job(spark_job)
+
+
+def packable_due_jobs(spark_job):
+    """
+    Returns the other Spark jobs that are due and could share a cluster
+    with the given one.
+    """
+    emr_release, result_visibility = spark_job.packing_key
+    candidates = SparkJob.objects.filter(
+        is_enabled=True,
+        emr_release=emr_release,
+        result_visibility=result_visibility,
+        size__lte=constance.config.SPARK_JOB_PACKING_MAX_SIZE,
+    ).exclude(
+        pk=spark_job.pk,
+    ).select_related('runtime_stats')
+    return [
+        candidate for candidate in candidates
+        if candidate.is_packable and candidate.should_run()
+    ]
+
+
+@celery.autoretry_task()
+def run_job(spark_job_id):
+    """
+    Run the given Spark job if it should run, triggered by its individual
+    schedule entry, and schedule its next run.
+
+    If the job can share its cluster, the other due jobs it can share the
+    cluster with are run along with it.
+    """
+    try:
+        spark_job = SparkJob.objects.get(pk=spark_job_id)
+    except SparkJob.DoesNotExist:
+        # the job was deleted in the meantime
+        unschedule_spark_job(spark_job_id)
+        return
+    if spark_job.should_run():
+        if spark_job.is_packable:
+            run_spark_jobs([spark_job] + packable_due_jobs(spark_job))
+        else:
+            run_spark_job(spark_job)
+    else:
+        # skip the fire times that passed while the job was still running
+        spark_job.consume_fire_times()
+        schedule_spark_job(spark_job)
+
+
+@celery.autoretry_task()
+def run_backfills():
+    """
+    Update the statuses of the active backfill runs and launch the pending
+    ones up to the concurrency cap of each backfill, to be used periodically
+    and queued when a backfill was created.
+
+    Runs are only launched if they fit the node budgets, so backfills don't
+    take the nodes of the queued launches.
+    """
+    launched = []
+    transitions = []
+    now = timezone.now()
+    backfills = SparkJobBackfill.objects.filter(
+        runs__status__in=(DEFAULT_STATUS, RESERVED_STATUS) + Cluster.ACTIVE_STATUS_LIST,
+    ).distinct().select_related('spark_job__created_by')
+    for backfill in backfills:
+        spark_job = backfill.spark_job
+        for run in backfill.active_runs.filter(jobflow_id__isnull=False):
+            with transaction.atomic():
+                run.update_status(transitions=transitions)
+            if spark_job.max_size and run.status in Cluster.READY_STATUS_LIST:
+                run.record_node_count(now)
+            if (run.status in Cluster.ACTIVE_STATUS_LIST and
+                    now >= run.scheduled_date + timedelta(hours=spark_job.job_timeout)):
+                # the bootstrap script times out the run already, but let's
+                # keep this as a guard like for the scheduled runs
+                logger.debug('Backfill run %s is expired and is terminated', run)
+                spark_job.cluster_provisioner.stop(run.jobflow_id)
+
+        slots = backfill.concurrency - backfill.active_runs.count()
+        while slots > 0 and admission.has_capacity(spark_job.peak_size, spark_job.created_by):
+            run = backfill.launch_next_run()
+            if run is None:
+                break
+            launched.append(run.jobflow_id)
+            slots -= 1
+    ClusterStatusTransition.objects.bulk_create(transitions)
+    return launched
+
+
+@celery.autoretry_task()
+def stagger_jobs():
+    """
+    Recompute the start offsets of the Spark jobs to spread the launches
+    of jobs scheduled at the same time, queued when a job was created or
+    changed and to be used periodically.
+    """
+    return [spark_job.identifier for spark_job in stagger_spark_jobs()]
+
+
+def launch_lock_key(spark_job_id):
+    return 'spark-job-launch-%s' % spark_job_id
+
+
+def queue_launch(spark_job):
+    """
+    Queue the launch of the given Spark job right away unless it's still
+    running or its launch is already queued, returns whether it was queued.
+    """
+    if not spark_job.is_runnable:
+        return False
+    if not cache.add(launch_lock_key(spark_job.pk), True, LAUNCH_LOCK_TIMEOUT):
+        return False
+    launch_spark_job.delay(spark_job.pk)
+    return True
+
+
+@celery.autoretry_task(max_retries=3)
+def launch_spark_job(spark_job_id, admitted=False):
+    """
+    Run the Spark job with the given ID right away if it isn't running,
+    regardless of its schedule, queued by running the job on demand or
+    when the job's launch was released from the launch queue.
+    """
+    try:
+        try:
+            spark_job = SparkJob.objects.get(pk=spark_job_id)
+        except SparkJob.DoesNotExist:
+            # the job was deleted in the meantime
+            return
+        if spark_job.is_runnable:
+            run_spark_job(
+                spark_job,
+                admitted=admitted,
+                priority=QueuedLaunch.PRIORITY_MANUAL_SPARK_JOB,
+            )
+    finally:
+        cache.delete(launch_lock_key(spark_job_id))
+
+
+@celery.autoretry_task()
+def expire_spark_job(spark_job_id):
+    """
+    Terminate the current run of the Spark job with the given ID if it
+    timed out, queued for the time out when the run was started.
+    """
+    try:
+        spark_job = SparkJob.objects.get(pk=spark_job_id)
+    except SparkJob.DoesNotExist:
+        return
+    spark_job.terminate()
+
+
+@celery.autoretry_task()
+def fail_over_spark_job_run(run_id):
+    """
+    Relaunch the Spark job run with the given ID on on-demand instances
+    right away, queued when its cluster failed because instances were lost.
+    """
+    try:
+        run = SparkJobRun.objects.select_related('spark_job').get(pk=run_id)
+    except SparkJobRun.DoesNotExist:
+        return None
+    new_run = run.relaunch()
+    if new_run is None:
+        return None
+    if new_run.backfill_id is not None:
+        # the backfill launches the new run with its other pending runs
+        run_backfills.delay()
+        return None
+    expire_spark_job.apply_async(
+        args=[new_run.spark_job_id],
+        eta=new_run.scheduled_date + timedelta(hours=run.spark_job.job_timeout),
+    )
+    return new_run.jobflow_id
+
+
+@celery.autoretry_task()
+def cleanup_spark_job(notebook_s3_key, jobflow_id=None, step_id=None):
+    """
+    Stop the cluster of a deleted Spark job's current run if given (or
+    only cancel its step if the cluster is shared) and remove the job's
+    notebook from S3, both can safely be retried.
+    """
+    if jobflow_id is not None:
+        if step_id is not None:
+            SparkJobProvisioner().cancel_step(jobflow_id, step_id)
+        else:
+            ClusterProvisioner().stop(jobflow_id)
+    SparkJobProvisioner().remove(notebook_s3_key)
+
+
 @celery.task
 def send_run_alert_mails():
     failed_run_alerts = SparkJobRunAlert.objects.filter(
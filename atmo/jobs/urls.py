@@ -9,8 +9,10 @@ urlpatterns = [
     url(r'^new/', views.new_spark_job, name='jobs-new'),
     url(r'^identifier-available/', views.check_identifier_available,
         name='jobs-identifier-available'),
+    url(r'^(?P<id>\d+)/backfill/', views.backfill_spark_job, name='jobs-backfill'),
     url(r'^(?P<id>\d+)/delete/', views.delete_spark_job, name='jobs-delete'),
     url(r'^(?P<id>\d+)/download/', views.download_spark_job, name='jobs-download'),
     url(r'^(?P<id>\d+)/edit/', views.edit_spark_job, name='jobs-edit'),
+    url(r'^(?P<id>\d+)/run/', views.run_spark_job, name='jobs-run'),
     url(r'^(?P<id>\d+)/$', views.detail_spark_job, name='jobs-detail'),
 ]
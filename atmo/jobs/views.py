@@ -4,7 +4,9 @@
 import logging
 
 from allauth.account.utils import user_display
+from django.contrib import messages
 from django.contrib.auth.decorators import login_required
+from django.db import transaction
 from django.http import (HttpResponse, HttpResponseNotFound,
                          StreamingHttpResponse)
 from django.shortcuts import redirect, render
@@ -16,8 +18,12 @@ from ..decorators import (change_permission_required,
                           delete_permission_required, modified_date,
                           view_permission_required)
 from ..models import next_field_value
-from .forms import EditSparkJobForm, NewSparkJobForm, SparkJobAvailableForm
+from .forms import (BackfillSparkJobForm, EditSparkJobForm, NewSparkJobForm,
+                    SparkJobAvailableForm)
 from .models import SparkJob
+from .schedules import schedule_spark_job, unschedule_spark_job
+from .tasks import (cleanup_spark_job, queue_launch, run_backfills,
+                    stagger_jobs)
 
 logger = logging.getLogger("django")
 
@@ -61,6 +67,9 @@ def new_spark_job(request):
         if form.is_valid():
             # this will also magically create the spark job for us
             spark_job = form.save()
+            transaction.on_commit(lambda: schedule_spark_job(spark_job))
+            # spread the launches of the jobs scheduled at the same time
+            transaction.on_commit(lambda: stagger_jobs.delay())
             return redirect(spark_job)
 
     context = {
@@ -70,9 +79,8 @@ def new_spark_job(request):
 
 
 @login_required
-@change_permission_required(SparkJob)
-def edit_spark_job(request, id):
-    spark_job = SparkJob.objects.get(pk=id)
+@change_permission_required(SparkJob, select_related=['created_by'])
+def edit_spark_job(request, spark_job):
     form = EditSparkJobForm(request.user, instance=spark_job)
     if request.method == 'POST':
         form = EditSparkJobForm(
@@ -84,6 +92,9 @@ def edit_spark_job(request, id):
         if form.is_valid():
             # this will also update the job for us
             spark_job = form.save()
+            transaction.on_commit(lambda: schedule_spark_job(spark_job))
+            # spread the launches of the jobs scheduled at the same time
+            transaction.on_commit(lambda: stagger_jobs.delay())
             return redirect(spark_job)
     context = {
         'form': form,
@@ -93,10 +104,23 @@ def edit_spark_job(request, id):
 
 @login_required
 @delete_permission_required(SparkJob)
-def delete_spark_job(request, id):
-    spark_job = SparkJob.objects.get(pk=id)
+def delete_spark_job(request, spark_job):
     if request.method == 'POST':
-        spark_job.delete()
+        # only delete the database records right away and stop the
+        # cluster and remove the notebook in the background
+        spark_job_id = spark_job.pk
+        notebook_s3_key = spark_job.notebook_s3_key
+        jobflow_id = spark_job.running_jobflow_id
+        step_id = spark_job.running_step_id
+        spark_job.delete(cleanup=False)
+        transaction.on_commit(lambda: unschedule_spark_job(spark_job_id))
+        transaction.on_commit(
+            lambda: cleanup_spark_job.delay(
+                notebook_s3_key,
+                jobflow_id=jobflow_id,
+                step_id=step_id,
+            )
+        )
         return redirect('dashboard')
     context = {
         'spark_job': spark_job,
@@ -104,11 +128,51 @@ def delete_spark_job(request, id):
     return render(request, 'atmo/jobs/delete.html', context=context)
 
 
+@login_required
+@change_permission_required(SparkJob)
+def run_spark_job(request, spark_job):
+    if request.method == 'POST':
+        # launch the job's cluster in the background right away
+        if queue_launch(spark_job):
+            messages.success(
+                request,
+                'The Spark job %s will be run in a moment.' % spark_job.identifier,
+            )
+        else:
+            messages.warning(
+                request,
+                'The Spark job %s is already running.' % spark_job.identifier,
+            )
+    return redirect(spark_job)
+
+
+@login_required
+@change_permission_required(SparkJob)
+def backfill_spark_job(request, spark_job):
+    form = BackfillSparkJobForm(spark_job)
+    if request.method == 'POST':
+        form = BackfillSparkJobForm(spark_job, data=request.POST)
+        if form.is_valid():
+            backfill = form.save()
+            # launch the first runs in the background right away
+            transaction.on_commit(lambda: run_backfills.delay())
+            messages.success(
+                request,
+                'The backfill of %s runs of the Spark job %s was started.' %
+                (backfill.runs.count(), spark_job.identifier),
+            )
+            return redirect(spark_job)
+    context = {
+        'form': form,
+        'spark_job': spark_job,
+    }
+    return render(request, 'atmo/jobs/backfill.html', context)
+
+
 @login_required
 @view_permission_required(SparkJob)
 @modified_date
-def detail_spark_job(request, id):
-    spark_job = SparkJob.objects.get(pk=id)
+def detail_spark_job(request, spark_job):
     context = {
         'spark_job': spark_job,
     }
@@ -119,8 +183,7 @@ def detail_spark_job(request, id):
 
 @login_required
 @view_permission_required(SparkJob)
-def download_spark_job(request, id):
-    spark_job = SparkJob.objects.get(pk=id)
+def download_spark_job(request, spark_job):
     response = StreamingHttpResponse(
         spark_job.notebook_s3_object['Body'].read().decode('utf-8'),
         content_type='application/x-ipynb+json',
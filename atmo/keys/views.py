@@ -4,7 +4,7 @@
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.http import HttpResponse
-from django.shortcuts import get_object_or_404, redirect, render
+from django.shortcuts import redirect, render
 from django.utils.safestring import mark_safe
 from guardian.shortcuts import get_objects_for_user
 
@@ -51,9 +51,8 @@ def new_key(request):
 
 
 @login_required
-@view_permission_required(SSHKey, ignore=['raw'])
-def detail_key(request, id, raw=False):
-    ssh_key = SSHKey.objects.get(pk=id)
+@view_permission_required(SSHKey, ignore=['raw'], select_related=['created_by'])
+def detail_key(request, ssh_key, raw=False):
     if raw:
         return HttpResponse(ssh_key.key, content_type='text/plain; charset=utf8')
 
@@ -65,8 +64,7 @@ def detail_key(request, id, raw=False):
 
 @login_required
 @delete_permission_required(SSHKey)
-def delete_key(request, id):
-    key = get_object_or_404(SSHKey, pk=id)
+def delete_key(request, key):
     if request.method == 'POST':
         message = mark_safe(
             'SSH key <strong>%s</strong> successfully deleted.' % key
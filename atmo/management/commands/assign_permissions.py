@@ -0,0 +1,22 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+from django.apps import apps
+from django.core.management.base import BaseCommand
+
+from ...models import CreatedByModel, PermissionMigrator
+
+
+class Command(BaseCommand):
+    help = 'Assign missing object permissions to the creators of existing objects'
+
+    def handle(self, *args, **options):
+        for model in apps.get_models():
+            if not issubclass(model, CreatedByModel):
+                continue
+            for perm in model.OWNER_PERMISSIONS:
+                assigned = PermissionMigrator(apps, model, 'created_by', perm).assign()
+                self.stdout.write(
+                    'Assigned %s %s permissions for %s.' %
+                    (assigned, perm, model._meta.label)
+                )
@@ -0,0 +1,107 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+import base64
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from ...clusters.models import Cluster
+from ...clusters.tasks import update_clusters
+from ...fake_aws import get_fake_aws
+from ...jobs.models import SparkJob
+from ...jobs.tasks import run_jobs
+from ...keys.models import SSHKey
+
+
+class Command(BaseCommand):
+    help = 'Launch clusters and Spark jobs on the fake AWS and time the periodic tasks'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--clusters',
+            type=int,
+            default=100,
+            help='The number of clusters to launch.',
+        )
+        parser.add_argument(
+            '--spark-jobs',
+            type=int,
+            default=100,
+            help='The number of due Spark jobs to create.',
+        )
+        parser.add_argument(
+            '--size',
+            type=int,
+            default=3,
+            help='The size of the clusters and Spark jobs.',
+        )
+        parser.add_argument(
+            '--sweeps',
+            type=int,
+            default=1,
+            help='How often to run the periodic tasks.',
+        )
+
+    def handle(self, *args, **options):
+        if get_fake_aws() is None:
+            raise CommandError(
+                'The FAKE_AWS_URL setting is not set, load tests only run '
+                'against the fake AWS.'
+            )
+        user, _ = User.objects.get_or_create(
+            username='load-test',
+            defaults={'email': 'load-test@example.com'},
+        )
+        ssh_key, _ = SSHKey.objects.get_or_create(
+            created_by=user,
+            title='load-test',
+            defaults={
+                'key': 'ssh-rsa %s load-test' % base64.b64encode(b'load-test').decode(),
+            },
+        )
+        now = timezone.now()
+        prefix = now.strftime('load-test-%Y%m%d%H%M%S')
+
+        self.stdout.write('Launching %s clusters...' % options['clusters'], ending='')
+        for index in range(options['clusters']):
+            cluster = Cluster.objects.create(
+                identifier='%s-%s' % (prefix, index),
+                size=options['size'],
+                ssh_key=ssh_key,
+                created_by=user,
+            )
+            cluster.provision()
+        self.stdout.write('done.')
+
+        self.stdout.write('Creating %s Spark jobs...' % options['spark_jobs'], ending='')
+        for index in range(options['spark_jobs']):
+            identifier = '%s-%s' % (prefix, index)
+            spark_job = SparkJob(
+                identifier=identifier,
+                result_visibility=SparkJob.RESULT_PRIVATE,
+                size=options['size'],
+                interval_in_hours=SparkJob.INTERVAL_DAILY,
+                job_timeout=1,
+                start_date=now - timedelta(days=1),
+                created_by=user,
+            )
+            spark_job.notebook_s3_key = spark_job.provisioner.add(
+                identifier=identifier,
+                notebook_file=ContentFile(b'{}', name='load-test.ipynb'),
+            )
+            spark_job.save()
+        self.stdout.write('done.')
+
+        for sweep in range(options['sweeps']):
+            for task in (update_clusters, run_jobs):
+                started = time.monotonic()
+                task()
+                self.stdout.write(
+                    'Sweep %s: %s took %.2fs' %
+                    (sweep + 1, task.name, time.monotonic() - started)
+                )
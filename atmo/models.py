@@ -1,6 +1,11 @@
+import math
+
 from django.conf import settings
+from django.contrib.auth.models import Permission
 from django.db import models
 from django.db.models.fields.related import ReverseOneToOneDescriptor
+from django.utils import timezone
+from guardian.ctypes import get_content_type
 from guardian.utils import get_user_obj_perms_model
 
 
@@ -22,18 +27,34 @@ class PermissionMigrator:
 
     def params(self):
         objs = []
-        for obj in self.model.objects.all():
+        # only fetch the primary keys to not load the user objects one by one
+        for obj_pk, user_pk in self.model.objects.values_list('pk', self.user_field):
             objs.append({
                 'permission': self.perm,
                 'content_type': self.content_type,
-                'object_pk': obj.pk,
-                'user': getattr(obj, self.user_field),
+                'object_pk': str(obj_pk),
+                'user_id': user_pk,
             })
         return objs
 
     def assign(self):
-        for params in self.params():
-            self.user_object_permission.objects.get_or_create(**params)
+        """
+        Assign the permission to all objects that don't have it yet
+        in one bulk insert and return the number of assigned permissions.
+        """
+        existing = set(
+            self.user_object_permission.objects.filter(
+                permission=self.perm,
+                content_type=self.content_type,
+            ).values_list('object_pk', 'user_id')
+        )
+        missing = [
+            self.user_object_permission(**params)
+            for params in self.params()
+            if (params['object_pk'], params['user_id']) not in existing
+        ]
+        self.user_object_permission.objects.bulk_create(missing)
+        return len(missing)
 
     def remove(self):
         for params in self.params():
@@ -50,8 +71,28 @@ class EditedAtModel(models.Model):
         get_latest_by = 'modified_at'
         ordering = ('-modified_at', '-created_at',)
 
+    def compare_and_save(self, update_fields, **expected):
+        """
+        Save only the given fields (and the modification date) and only
+        if the stored row still has the given expected field values,
+        e.g. to not overwrite a status that was stored by another process
+        in the meantime.
+
+        Returns whether the row was updated.
+        """
+        self.modified_at = timezone.now()
+        values = {field: getattr(self, field) for field in update_fields}
+        values['modified_at'] = self.modified_at
+        updated = self.__class__._default_manager.filter(
+            pk=self.pk,
+            **expected
+        ).update(**values)
+        return bool(updated)
+
 
 class CreatedByModel(models.Model):
+    # note: no "add" permission, because it's useless for objects
+    OWNER_PERMISSIONS = ['change', 'delete', 'view']
 
     created_by = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -69,11 +110,44 @@ class CreatedByModel(models.Model):
         perm = '%s_%s' % (perm, self._meta.model_name)
         get_user_obj_perms_model(self).objects.assign_perm(perm, user, self)
 
+    def assign_permissions(self, user, perms):
+        """
+        assign the given permissions to the given user in one bulk insert,
+        e.g. ['change', 'view'].
+
+        Raises Permission.DoesNotExist if any of the permissions doesn't
+        exist, like guardian's assign_perm.
+        """
+        model = get_user_obj_perms_model(self)
+        content_type = get_content_type(self)
+        codenames = {'%s_%s' % (perm, self._meta.model_name) for perm in perms}
+        permissions = list(Permission.objects.filter(
+            content_type=content_type,
+            codename__in=codenames,
+        ))
+        missing = codenames - {permission.codename for permission in permissions}
+        if missing:
+            raise Permission.DoesNotExist(
+                'Permissions %s of %s do not exist' %
+                (', '.join(sorted(missing)), content_type)
+            )
+        model.objects.bulk_create([
+            model(
+                permission=permission,
+                user=user,
+                content_type=content_type,
+                object_pk=str(self.pk),
+            )
+            for permission in permissions
+        ])
+
     def save(self, *args, **kwargs):
+        # the owner's permissions never change after the object was created,
+        # so only assign them once instead of on every update
+        adding = self._state.adding
         instance = super().save(*args, **kwargs)
-        # note: no "add" permission, because it's useless for objects
-        for perm in ['change', 'delete', 'view']:
-            self.assign_permission(self.created_by, perm)
+        if adding:
+            self.assign_permissions(self.created_by, self.OWNER_PERMISSIONS)
         return instance
 
 
@@ -143,3 +217,9 @@ class ForgivingReverseOneToOneDescriptor(ReverseOneToOneDescriptor):
 
 class ForgivingOneToOneField(models.OneToOneField):
     related_accessor_class = ForgivingReverseOneToOneDescriptor
+
+
+def percentile(values, percent):
+    """The nearest-rank percentile of the given sorted values."""
+    rank = int(math.ceil(percent / 100 * len(values)))
+    return values[max(rank, 1) - 1]
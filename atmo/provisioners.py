@@ -9,6 +9,11 @@ import requests
 from django.conf import settings
 from django.utils import timezone
 
+from .fake_aws import get_fake_aws
+
+# how long EMR waits for the spot capacity of instance fleets by default
+DEFAULT_SPOT_TIMEOUT_MINUTES = 20
+
 
 class Provisioner:
     """
@@ -24,15 +29,22 @@ class Provisioner:
         self.script_uri = (
             's3://%s/bootstrap/telemetry.sh' % self.config['SPARK_EMR_BUCKET']
         )
-        self.emr = boto3.client(
-            'emr',
-            region_name=self.config['AWS_REGION'],
-        )
-        self.s3 = boto3.client(
-            's3',
-            region_name=self.config['AWS_REGION'],
-        )
-        self.session = requests.session()
+        fake_aws = get_fake_aws()
+        if fake_aws is None:
+            self.emr = boto3.client(
+                'emr',
+                region_name=self.config['AWS_REGION'],
+            )
+            self.s3 = boto3.client(
+                's3',
+                region_name=self.config['AWS_REGION'],
+            )
+            self.session = requests.session()
+        else:
+            # e.g. for load tests without AWS
+            self.emr = fake_aws.client('emr')
+            self.s3 = fake_aws.client('s3')
+            self.session = fake_aws.session()
 
         # the S3 URI to the script-runner jar
         self.jar_uri = (
@@ -52,11 +64,79 @@ class Provisioner:
         response.raise_for_status()
         return response.json()
 
-    def job_flow_params(self, user_email, identifier, emr_release, size):
+    def uses_spot_instances(self, size):
         """
-        Given the parameters returns the basic parameters for EMR job flows,
-        and handles for example the decision whether to use spot instances
-        or not.
+        Whether the workers of a cluster of the given size are spot
+        instances by default.
+        """
+        return size > 1 and constance.config.AWS_USE_SPOT_INSTANCES
+
+    def worker_instance_fleet(self, size):
+        """
+        Returns the instance fleet configuration of the workers of clusters
+        of the given size, the one with the largest minimum size that the
+        size reaches, or None if the workers are an instance group.
+        """
+        fleets = [
+            fleet for fleet in self.config['WORKER_INSTANCE_FLEETS']
+            if fleet['MIN_SIZE'] <= size
+        ]
+        if not fleets:
+            return None
+        return max(fleets, key=lambda fleet: fleet['MIN_SIZE'])
+
+    def auto_scaling_policy(self, min_capacity, max_capacity):
+        """
+        Returns the EMR auto-scaling policy of an instance group between the
+        given number of instances, adding instances when little YARN memory
+        is available and removing them again when most is.
+        """
+        adjustment = max(1, (max_capacity - min_capacity) // 4)
+
+        def rule(name, adjustment, operator, threshold, evaluation_periods):
+            return {
+                'Name': name,
+                'Action': {
+                    'SimpleScalingPolicyConfiguration': {
+                        'AdjustmentType': 'CHANGE_IN_CAPACITY',
+                        'ScalingAdjustment': adjustment,
+                        'CoolDown': 300,
+                    },
+                },
+                'Trigger': {
+                    'CloudWatchAlarmDefinition': {
+                        'ComparisonOperator': operator,
+                        'EvaluationPeriods': evaluation_periods,
+                        'MetricName': 'YARNMemoryAvailablePercentage',
+                        'Namespace': 'AWS/ElasticMapReduce',
+                        'Period': 300,
+                        'Statistic': 'AVERAGE',
+                        'Threshold': threshold,
+                        'Unit': 'PERCENT',
+                        'Dimensions': [
+                            {'Key': 'JobFlowId', 'Value': '${emr.clusterId}'},
+                        ],
+                    },
+                },
+            }
+
+        return {
+            'Constraints': {
+                'MinCapacity': min_capacity,
+                'MaxCapacity': max_capacity,
+            },
+            'Rules': [
+                rule('ScaleOut', adjustment, 'LESS_THAN', 15.0, 1),
+                # scale in more carefully, e.g. between stages of a job
+                rule('ScaleIn', -adjustment, 'GREATER_THAN', 75.0, 3),
+            ],
+        }
+
+    def instance_groups(self, size, use_spot, max_size=None):
+        """
+        Returns the instance groups of the master and, for clusters of
+        more than one node, the workers, which auto-scale up to the given
+        maximum size if any.
         """
         # setup instance groups using spot market for slaves
         instance_groups = [
@@ -76,15 +156,104 @@ class Provisioner:
                 'InstanceType': self.config['WORKER_INSTANCE_TYPE'],
                 'InstanceCount': size,
             }
-            if constance.config.AWS_USE_SPOT_INSTANCES:
+            if use_spot:
                 core_group.update({
                     'Market': 'SPOT',
                     'BidPrice': str(constance.config.AWS_SPOT_BID_CORE),
                 })
             else:
                 core_group['Market'] = 'ON_DEMAND'
+            if max_size is not None and max_size > size:
+                core_group['AutoScalingPolicy'] = self.auto_scaling_policy(size, max_size)
 
             instance_groups.append(core_group)
+        return instance_groups
+
+    def instance_fleets(self, size, use_spot, fleet):
+        """
+        Returns the instance fleets of the master and the workers, which
+        provision the size in units of the weighted capacities of the
+        fleet's instance types, whichever are available.
+
+        Spot capacity that isn't provisioned within the fleet's timeout is
+        provisioned on-demand instead.
+        """
+        bid = constance.config.AWS_SPOT_BID_CORE
+        instance_type_configs = []
+        for instance_type, weight in fleet['INSTANCE_TYPES']:
+            instance_type_config = {
+                'InstanceType': instance_type,
+                'WeightedCapacity': weight,
+            }
+            if use_spot:
+                # the bid price is per instance
+                instance_type_config['BidPrice'] = str(round(bid * weight, 4))
+            instance_type_configs.append(instance_type_config)
+
+        core_fleet = {
+            'Name': 'Worker Instances',
+            'InstanceFleetType': 'CORE',
+            'InstanceTypeConfigs': instance_type_configs,
+        }
+        if use_spot:
+            core_fleet.update({
+                'TargetSpotCapacity': size,
+                'LaunchSpecifications': {
+                    'SpotSpecification': {
+                        'TimeoutDurationMinutes': fleet.get(
+                            'SPOT_TIMEOUT_MINUTES',
+                            DEFAULT_SPOT_TIMEOUT_MINUTES,
+                        ),
+                        'TimeoutAction': 'SWITCH_TO_ON_DEMAND',
+                    },
+                },
+            })
+        else:
+            core_fleet['TargetOnDemandCapacity'] = size
+
+        return [
+            {
+                'Name': 'Master',
+                'InstanceFleetType': 'MASTER',
+                'TargetOnDemandCapacity': 1,
+                'InstanceTypeConfigs': [
+                    {'InstanceType': self.config['MASTER_INSTANCE_TYPE']},
+                ],
+            },
+            core_fleet,
+        ]
+
+    def job_flow_params(self, user_email, identifier, emr_release, size,
+                        use_spot=None, max_size=None):
+        """
+        Given the parameters returns the basic parameters for EMR job flows,
+        and handles for example the decision whether to use spot instances
+        or not, unless use_spot is given, whether to use an instance fleet
+        for the workers and whether they auto-scale up to the given maximum
+        size.
+        """
+        if use_spot is None:
+            use_spot = self.uses_spot_instances(size)
+        auto_scaling = size > 1 and max_size is not None and max_size > size
+
+        # EMR clusters use either instance groups or instance fleets, only
+        # instance groups can auto-scale
+        if size > 1 and not auto_scaling:
+            fleet = self.worker_instance_fleet(size)
+        else:
+            fleet = None
+        if fleet is None:
+            instances = {
+                'InstanceGroups': self.instance_groups(size, use_spot, max_size),
+            }
+        else:
+            instances = {
+                'InstanceFleets': self.instance_fleets(size, use_spot, fleet),
+            }
+        instances.update({
+            'Ec2KeyName': self.config['EC2_KEY_NAME'],
+            'KeepJobFlowAliveWhenNoSteps': False,
+        })
 
         now = timezone.now().isoformat()
 
@@ -93,16 +262,12 @@ class Provisioner:
             (self.config['LOG_BUCKET'], self.log_dir, identifier, now)
         )
 
-        return {
+        params = {
             'Name': str(uuid4()),
             'LogUri': log_uri,
             'ReleaseLabel': 'emr-%s' % emr_release,
             'Configurations': self.spark_emr_configuration(),
-            'Instances': {
-                'InstanceGroups': instance_groups,
-                'Ec2KeyName': self.config['EC2_KEY_NAME'],
-                'KeepJobFlowAliveWhenNoSteps': False,
-            },
+            'Instances': instances,
             'JobFlowRole': self.config['SPARK_INSTANCE_PROFILE'],
             'ServiceRole': 'EMR_DefaultRole',
             'Applications': [
@@ -118,3 +283,6 @@ class Provisioner:
             ],
             'VisibleToAllUsers': True,
         }
+        if auto_scaling:
+            params['AutoScalingRole'] = self.config['AUTO_SCALING_ROLE']
+        return params
@@ -0,0 +1,42 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Helpers to manage individual entries of the RedBeat schedule at runtime,
+in addition to the static entries in the CELERY_BEAT_SCHEDULE setting.
+
+Don't import this from models or the admin since it loads the Celery app.
+"""
+from celery.schedules import schedule
+from redbeat.schedulers import RedBeatSchedulerEntry, add_defaults
+
+from .celery import celery
+
+# the scheduler only adds the RedBeat settings when it starts
+add_defaults(celery)
+
+
+def schedule_entry(name, task, run_every, due_at, args=None, kwargs=None):
+    """
+    Add or update the schedule entry with the given name to run the task
+    every given timedelta, starting at the given due date/time.
+    """
+    entry = RedBeatSchedulerEntry(
+        name=name,
+        task=task,
+        schedule=schedule(run_every=run_every),
+        args=args or [],
+        kwargs=kwargs or {},
+        app=celery,
+    )
+    entry.save()
+    # RedBeat calculates the due date from the last run
+    entry.reschedule(last_run_at=due_at - run_every)
+    return entry
+
+
+def remove_entry(name):
+    """
+    Remove the schedule entry with the given name if it exists.
+    """
+    RedBeatSchedulerEntry(name=name, app=celery).delete()
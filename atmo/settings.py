@@ -56,19 +56,20 @@ class Celery:
     REDBEAT_LOCK_TIMEOUT = CELERY_BEAT_MAX_LOOP_INTERVAL * 5
     # The default/initial schedule to use.
     CELERYBEAT_SCHEDULE = CELERY_BEAT_SCHEDULE = {
+        # safety net for the deadlines queued when a cluster is created
         'deactivate_clusters': {
-            'schedule': crontab(minute='*'),
+            'schedule': crontab(minute='*/15'),  # every 15 minutes
             'task': 'atmo.clusters.tasks.deactivate_clusters',
             'options': {
                 'soft_time_limit': 15,
-                'expires': 40,
+                'expires': 14 * 60,
             },
         },
         'send_expiration_mails': {
-            'schedule': crontab(minute='*/5'),  # every 5 minutes
+            'schedule': crontab(minute='*/15'),  # every 15 minutes
             'task': 'atmo.clusters.tasks.send_expiration_mails',
             'options': {
-                'expires': 4 * 60,
+                'expires': 14 * 60,
             },
         },
         'send_run_alert_mails': {
@@ -79,11 +80,12 @@ class Celery:
             },
         },
         'update_clusters': {
-            'schedule': crontab(minute='*'),
+            # only polls the clusters that are due, see Cluster.get_poll_interval
+            'schedule': timedelta(seconds=30),
             'task': 'atmo.clusters.tasks.update_clusters',
             'options': {
                 'soft_time_limit': 15,
-                'expires': 40,
+                'expires': 25,
             },
         },
         'run_jobs': {
@@ -94,6 +96,38 @@ class Celery:
                 'expires': 40,
             },
         },
+        'release_queued_launches': {
+            'schedule': crontab(minute='*'),
+            'task': 'atmo.clusters.tasks.release_queued_launches',
+            'options': {
+                'soft_time_limit': 15,
+                'expires': 40,
+            },
+        },
+        'run_backfills': {
+            'schedule': crontab(minute='*'),
+            'task': 'atmo.jobs.tasks.run_backfills',
+            'options': {
+                'soft_time_limit': 45,
+                'expires': 40,
+            },
+        },
+        'stagger_jobs': {
+            'schedule': crontab(minute=40, hour=4),
+            'task': 'atmo.jobs.tasks.stagger_jobs',
+        },
+        'refill_cluster_pool': {
+            'schedule': crontab(minute='*/5'),
+            'task': 'atmo.clusters.tasks.refill_cluster_pool',
+            'options': {
+                'soft_time_limit': 60,
+                'expires': 4 * 60,
+            },
+        },
+        'rollup_cluster_statuses': {
+            'schedule': crontab(minute=15),  # every hour
+            'task': 'atmo.clusters.tasks.rollup_cluster_statuses',
+        },
         'clean_orphan_obj_perms': {
             'schedule': crontab(minute=30, hour=3),
             'task': 'guardian.utils.clean_orphan_obj_perms',
@@ -116,10 +150,42 @@ class Constance:
             0.84,
             'The spot instance bid price for the cluster workers',
         ),
+        'AWS_SPOT_FAILOVER_RETRIES': (
+            1,
+            'How often a Spark job run whose spot instances were reclaimed '
+            'is relaunched on on-demand instances right away, 0 to disable',
+        ),
         'AWS_EFS_DNS': (
             'fs-616ca0c8.efs.us-west-2.amazonaws.com',  # the current dev instance of EFS
             'The DNS name of the EFS mount for EMR clusters'
-        )
+        ),
+        'SPARK_JOB_PACKING_ENABLED': (
+            False,
+            'Whether small due Spark jobs are run as steps on a shared cluster',
+        ),
+        'SPARK_JOB_PACKING_MAX_SIZE': (
+            5,
+            'The maximum cluster size of Spark jobs to run on a shared cluster',
+        ),
+        'SPARK_JOB_PACKING_MAX_DURATION': (
+            30,
+            'The maximum 95th percentile of the run durations in minutes of '
+            'Spark jobs to run on a shared cluster',
+        ),
+        'SPARK_JOB_PACKING_MAX_STEPS': (
+            5,
+            'The maximum number of Spark jobs to run on a shared cluster',
+        ),
+        'NODE_BUDGET_TOTAL': (
+            0,
+            'The maximum number of EMR nodes to be active at a time, '
+            'further launches are queued, 0 for no limit',
+        ),
+        'NODE_BUDGET_PER_USER': (
+            0,
+            'The maximum number of EMR nodes of a user to be active at a time, '
+            'further launches are queued, 0 for no limit',
+        ),
     }
 
 
@@ -136,12 +202,27 @@ class AWS:
         # setup bootstrap action depends on it to autotune the cluster.
         'MASTER_INSTANCE_TYPE': 'c3.4xlarge',
         'WORKER_INSTANCE_TYPE': 'c3.4xlarge',
+        # Optional instance fleets of the workers of clusters of at least
+        # the given size, with a list of equivalent instance types and their
+        # capacity in workers, e.g. ('c3.8xlarge', 2). EMR provisions the
+        # size from whichever types are available and switches to on-demand
+        # instances if spot capacity isn't available within the timeout.
+        # Without a matching fleet the workers are an instance group, e.g.:
+        # {
+        #     'MIN_SIZE': 5,
+        #     'INSTANCE_TYPES': [('c3.4xlarge', 1), ('c4.4xlarge', 1)],
+        #     'SPOT_TIMEOUT_MINUTES': 20,
+        # }
+        'WORKER_INSTANCE_FLEETS': [],
         # available EMR releases, to be used as choices for Spark jobs and clusters
         # forms. Please keep the latest (newest) as the first item
         'EMR_RELEASES': (
             '5.2.1',
             '5.0.0',
         ),
+        # the IAM role EMR uses to add and remove the instances of clusters
+        # with a maximum size
+        'AUTO_SCALING_ROLE': 'EMR_AutoScaling_DefaultRole',
         'SPARK_INSTANCE_PROFILE': 'telemetry-spark-cloudformation-'
                                   'TelemetrySparkInstanceProfile-1SATUBVEXG7E3',
         'SPARK_EMR_BUCKET': 'telemetry-spark-emr-2',
@@ -424,6 +505,21 @@ class Base(Core):
     # Use redis as the Celery broker.
     CELERY_BROKER_URL = os.environ.get('REDIS_URL', REDIS_URL_DEFAULT)
 
+    # The queue to consume EMR cluster state change events from, an SQS
+    # queue URL or a redis:// or memory:// URL for development. Polling
+    # the cluster statuses is only a fallback if set.
+    EMR_EVENTS_QUEUE_URL = values.Value('')
+
+    # A memory:// or redis:// URL to fake EMR, S3 and SES, e.g. to load-test
+    # the scheduler and the dashboard without AWS. The simulated latencies,
+    # throttling and failure rates are query parameters, see atmo.fake_aws.
+    FAKE_AWS_URL = values.Value('')
+
+    # The number of standby clusters to keep around to be claimed when
+    # users launch a cluster, by "<EMR release>:<size>", e.g.
+    # {'5.2.1:1': 2} for two clusters of size 1 with EMR release 5.2.1.
+    CLUSTER_POOL = values.DictValue({})
+
     LOGGING_USE_JSON = values.BooleanValue(False)
 
     def LOGGING(self):
@@ -542,6 +638,9 @@ class Stage(Base):
     # This is needed to get a CRSF token in /admin
     ANON_ALWAYS = True
 
+    # never fake AWS outside of development
+    FAKE_AWS_URL = ''
+
     @property
     def DATABASES(self):
         "require encrypted connections to Postgres"
@@ -107,6 +107,16 @@ def patch_spark_emr_configuration(mocker):
     )
 
 
+@pytest.fixture(autouse=True)
+def schedule_entry_mocks(mocker):
+    """Don't write individual schedule entries to the RedBeat schedule."""
+    return {
+        'save': mocker.patch('redbeat.schedulers.RedBeatSchedulerEntry.save'),
+        'reschedule': mocker.patch('redbeat.schedulers.RedBeatSchedulerEntry.reschedule'),
+        'delete': mocker.patch('redbeat.schedulers.RedBeatSchedulerEntry.delete'),
+    }
+
+
 @pytest.fixture(autouse=True)
 def patch_google_auth_discovery_endpoint(mocker):
     mocker.patch(
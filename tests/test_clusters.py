@@ -1,15 +1,24 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
+import json
 from datetime import timedelta
+from io import StringIO
 
+import constance
 import pytest
 from allauth.account.utils import user_display
 from django.contrib.messages import get_messages
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.utils import timezone
+from freezegun import freeze_time
 
-from atmo.clusters import models
+from atmo.clusters import admin, admission, events, models, tasks
+from atmo.clusters.forms import NewClusterForm
+from atmo.jobs import tasks as job_tasks
+from atmo.jobs.models import SparkJob
 
 
 @pytest.fixture
@@ -63,8 +72,12 @@ def test_redirect_keys(client, test_user):
     assert response.redirect_chain[-1] == (reverse('keys-new'), 302)
 
 
-def test_create_cluster(client, test_user, ssh_key, cluster_provisioner_mocks):
+def test_create_cluster(client, mocker, test_user, ssh_key, cluster_provisioner_mocks):
     start_date = timezone.now()
+    mocker.patch('django.db.transaction.on_commit', side_effect=lambda func: func())
+    provision_cluster = mocker.patch('atmo.clusters.tasks.provision_cluster.delay')
+    send_expiration_mail = mocker.patch('atmo.clusters.tasks.send_expiration_mail.apply_async')
+    expire_cluster = mocker.patch('atmo.clusters.tasks.expire_cluster.apply_async')
 
     # request that a new cluster be created
     response = client.post(
@@ -74,17 +87,40 @@ def test_create_cluster(client, test_user, ssh_key, cluster_provisioner_mocks):
             'new-ssh_key': ssh_key.id,
             'new-emr_release': models.Cluster.EMR_RELEASES_CHOICES_DEFAULT,
         }, follow=True)
-    cluster = models.Cluster.objects.get(jobflow_id='12345')
+    cluster = models.Cluster.objects.get(identifier='test-cluster')
 
     assert response.status_code == 200
     assert response.redirect_chain[-1] == (cluster.get_absolute_url(), 302)
 
+    # the cluster is stored as pending and spawned in the background
+    assert cluster.is_pending
+    assert cluster.is_active
+    assert cluster.jobflow_id is None
+    cluster_provisioner_mocks['start'].assert_not_called()
+    provision_cluster.assert_called_once_with(cluster.id)
+    # the deadlines are only queued once the cluster is spawned
+    send_expiration_mail.assert_not_called()
+    expire_cluster.assert_not_called()
+
+    with freeze_time(start_date + timedelta(hours=2)):
+        tasks.provision_cluster(cluster.id)
+    cluster.refresh_from_db()
+    assert cluster.jobflow_id == '12345'
+    # the cluster's lifetime starts when it was spawned
+    assert cluster.end_date == start_date + timedelta(hours=2) + models.Cluster.LIFETIME
+    send_expiration_mail.assert_called_once_with(
+        args=[cluster.id],
+        eta=cluster.end_date - timedelta(hours=1),
+    )
+    expire_cluster.assert_called_once_with(args=[cluster.id], eta=cluster.end_date)
+    assert cluster.most_recent_status == models.Cluster.STATUS_BOOTSTRAPPING
     cluster_provisioner_mocks['start'].assert_called_with(
         user_email='test@example.com',
         identifier='test-cluster',
         emr_release=models.Cluster.EMR_RELEASES_CHOICES_DEFAULT,
         size=5,
         public_key=ssh_key.key,
+        max_size=None,
     )
 
     assert cluster.identifier == 'test-cluster'
@@ -98,7 +134,13 @@ def test_create_cluster(client, test_user, ssh_key, cluster_provisioner_mocks):
     assert cluster.emr_release == models.Cluster.EMR_RELEASES_CHOICES_DEFAULT
 
 
-def test_empty_public_dns(client, cluster_provisioner_mocks, test_user, ssh_key):
+def test_empty_public_dns(client, mocker, cluster_provisioner_mocks, test_user, ssh_key):
+    mocker.patch(
+        'atmo.clusters.tasks.provision_cluster.delay',
+        side_effect=lambda cluster_id: tasks.provision_cluster(cluster_id),
+    )
+    mocker.patch('atmo.clusters.tasks.schedule_deadlines')
+    mocker.patch('django.db.transaction.on_commit', side_effect=lambda func: func())
     cluster_provisioner_mocks['info'].return_value = {
         'start_time': timezone.now(),
         'state': models.Cluster.STATUS_BOOTSTRAPPING,
@@ -129,7 +171,7 @@ def test_empty_public_dns(client, cluster_provisioner_mocks, test_user, ssh_key)
     assert cluster.master_address == ''
 
 
-def test_terminate_cluster(client, cluster_provisioner_mocks, test_user,
+def test_terminate_cluster(client, mocker, cluster_provisioner_mocks, test_user,
                            test_user2, ssh_key):
 
     # create a test cluster to delete later
@@ -169,10 +211,920 @@ def test_terminate_cluster(client, cluster_provisioner_mocks, test_user,
     client.force_login(test_user)
 
     # request that the test cluster be terminated
+    mocker.patch('django.db.transaction.on_commit', side_effect=lambda func: func())
+    deactivate_cluster = mocker.patch('atmo.clusters.tasks.deactivate_cluster.delay')
     response = client.post(terminate_url, follow=True)
 
     assert response.status_code == 200
     assert response.redirect_chain[-1] == (cluster.get_absolute_url(), 302)
 
+    # the cluster is shown as terminating right away
+    # and shut down in the background
+    cluster.refresh_from_db()
+    assert cluster.is_terminating
+    cluster_provisioner_mocks['stop'].assert_not_called()
+    deactivate_cluster.assert_called_once_with(cluster.id)
+
+    tasks.deactivate_cluster(cluster.id)
     cluster_provisioner_mocks['stop'].assert_called_with('12345')
     assert models.Cluster.objects.filter(jobflow_id='12345').exists()
+
+
+def test_terminate_cluster_admin_action(mocker, cluster_provisioner_mocks, test_user,
+                                        ssh_key):
+    cluster = models.Cluster.objects.create(
+        identifier='test-cluster',
+        size=5,
+        ssh_key=ssh_key,
+        created_by=test_user,
+        jobflow_id='12345',
+        most_recent_status=models.Cluster.STATUS_WAITING,
+    )
+    mocker.patch('django.db.transaction.on_commit', side_effect=lambda func: func())
+    deactivate_cluster = mocker.patch('atmo.clusters.tasks.deactivate_cluster.delay')
+    admin.terminate(None, None, models.Cluster.objects.all())
+    cluster.refresh_from_db()
+    assert cluster.is_terminating
+    # the cluster is shut down in the background
+    cluster_provisioner_mocks['stop'].assert_not_called()
+    deactivate_cluster.assert_called_once_with(cluster.id)
+
+
+def test_provision_cluster(mocker, cluster_provisioner_mocks, test_user, ssh_key):
+    cluster = models.Cluster.objects.create(
+        identifier='test-cluster',
+        size=5,
+        ssh_key=ssh_key,
+        created_by=test_user,
+    )
+    assert cluster.is_pending
+    assert cluster.start_date is not None
+
+    # terminating a pending cluster doesn't call out to AWS
+    cluster.deactivate()
+    cluster_provisioner_mocks['stop'].assert_not_called()
+    cluster.refresh_from_db()
+    assert cluster.most_recent_status == models.Cluster.STATUS_TERMINATED
+
+    # and the cluster isn't spawned anymore
+    tasks.provision_cluster(cluster.id)
+    cluster_provisioner_mocks['start'].assert_not_called()
+
+    # the just spawned cluster is stopped when terminated in the meantime
+    cluster.most_recent_status = models.Cluster.STATUS_PENDING
+    cluster.save()
+
+    def terminate(**kwargs):
+        models.Cluster.objects.filter(pk=cluster.pk).update(
+            most_recent_status=models.Cluster.STATUS_TERMINATED,
+        )
+        return '12345'
+    cluster_provisioner_mocks['start'].side_effect = terminate
+    assert not cluster.provision()
+    cluster_provisioner_mocks['stop'].assert_called_once_with('12345')
+    assert cluster.jobflow_id is None
+    assert cluster.most_recent_status == models.Cluster.STATUS_TERMINATED
+
+
+def test_provision_cluster_failed(mocker, cluster_provisioner_mocks, test_user, ssh_key):
+    cluster = models.Cluster.objects.create(
+        identifier='test-cluster',
+        size=5,
+        ssh_key=ssh_key,
+        created_by=test_user,
+    )
+    cluster_provisioner_mocks['start'].side_effect = ValueError('EMR is down')
+    retry = mocker.patch.object(tasks.provision_cluster, 'retry', side_effect=ValueError)
+
+    # the task is retried but the cluster is kept pending
+    with pytest.raises(ValueError):
+        tasks.provision_cluster(cluster.id)
+    assert retry.call_count == 1
+    cluster.refresh_from_db()
+    assert cluster.is_pending
+
+    # until the last retry fails
+    mocker.patch.object(tasks.provision_cluster, 'max_retries', 0)
+    with pytest.raises(ValueError):
+        tasks.provision_cluster(cluster.id)
+    cluster.refresh_from_db()
+    assert cluster.is_failed
+
+
+def test_update_clusters(mocker, now, test_user, ssh_key):
+    def make_cluster(identifier, jobflow_id, status, master_address=''):
+        return models.Cluster.objects.create(
+            identifier=identifier,
+            size=5,
+            ssh_key=ssh_key,
+            created_by=test_user,
+            jobflow_id=jobflow_id,
+            most_recent_status=status,
+            master_address=master_address,
+            start_date=now,
+        )
+    cluster1 = make_cluster('cluster-1', 'j-1', models.Cluster.STATUS_BOOTSTRAPPING)
+    cluster2 = make_cluster('cluster-2', 'j-2', models.Cluster.STATUS_STARTING)
+    cluster3 = make_cluster('cluster-3', 'j-3', models.Cluster.STATUS_WAITING, 'master.dns')
+    cluster4 = make_cluster('cluster-4', 'j-4', models.Cluster.STATUS_RUNNING)
+
+    mocker.patch(
+        'atmo.clusters.provisioners.ClusterProvisioner.list',
+        return_value=[
+            {'jobflow_id': 'j-1', 'state': models.Cluster.STATUS_WAITING},
+            {'jobflow_id': 'j-2', 'state': models.Cluster.STATUS_BOOTSTRAPPING},
+            {'jobflow_id': 'j-3', 'state': models.Cluster.STATUS_WAITING},
+        ],
+    )
+    mocker.patch('django.db.transaction.on_commit', side_effect=lambda func: func())
+    update_master_address = mocker.patch('atmo.clusters.tasks.update_master_address.delay')
+    save = mocker.spy(models.Cluster, 'save')
+
+    updated = tasks.update_clusters()
+
+    assert sorted(updated) == ['cluster-1', 'cluster-2']
+    # the states are written with a bulk update, not by saving each cluster
+    assert save.call_count == 0
+    update_master_address.assert_called_once_with(cluster1.pk)
+
+    for cluster, status in [
+            (cluster1, models.Cluster.STATUS_WAITING),
+            (cluster2, models.Cluster.STATUS_BOOTSTRAPPING),
+            (cluster3, models.Cluster.STATUS_WAITING),
+            (cluster4, models.Cluster.STATUS_RUNNING)]:
+        modified_at = cluster.modified_at
+        cluster.refresh_from_db()
+        assert cluster.most_recent_status == status
+        if cluster in (cluster1, cluster2):
+            assert cluster.modified_at > modified_at
+        else:
+            assert cluster.modified_at == modified_at
+
+
+def test_deactivate_keeps_concurrent_status(cluster_provisioner_mocks, test_user, ssh_key):
+    cluster = models.Cluster.objects.create(
+        identifier='test-cluster',
+        size=5,
+        ssh_key=ssh_key,
+        created_by=test_user,
+        jobflow_id='12345',
+        most_recent_status=models.Cluster.STATUS_WAITING,
+    )
+    # another process already stored a newer status
+    other = models.Cluster.objects.get(pk=cluster.pk)
+    other.most_recent_status = models.Cluster.STATUS_TERMINATED
+    assert other.compare_and_save(
+        ['most_recent_status'],
+        most_recent_status=models.Cluster.STATUS_WAITING,
+    )
+
+    cluster_provisioner_mocks['info'].return_value['state'] = models.Cluster.STATUS_TERMINATING
+    cluster.deactivate()
+    cluster_provisioner_mocks['stop'].assert_called_with('12345')
+    assert cluster.most_recent_status == models.Cluster.STATUS_TERMINATED
+    cluster.refresh_from_db()
+    assert cluster.most_recent_status == models.Cluster.STATUS_TERMINATED
+
+    # without a concurrent change the status is stored
+    cluster.most_recent_status = models.Cluster.STATUS_WAITING
+    cluster.save()
+    cluster.deactivate()
+    cluster.refresh_from_db()
+    assert cluster.most_recent_status == models.Cluster.STATUS_TERMINATING
+
+
+def test_expire_cluster(mocker, now, cluster_provisioner_mocks, test_user, ssh_key):
+    cluster = models.Cluster.objects.create(
+        identifier='test-cluster',
+        size=5,
+        ssh_key=ssh_key,
+        created_by=test_user,
+        jobflow_id='12345',
+        most_recent_status=models.Cluster.STATUS_WAITING,
+        end_date=now + timedelta(hours=1),
+    )
+    # the cluster was extended or the timer fired early
+    tasks.expire_cluster(cluster.id)
+    cluster_provisioner_mocks['stop'].assert_not_called()
+
+    mocker.patch('django.utils.timezone.now', return_value=now + timedelta(hours=1))
+    cluster_provisioner_mocks['info'].return_value['state'] = models.Cluster.STATUS_TERMINATING
+    tasks.expire_cluster(cluster.id)
+    cluster_provisioner_mocks['stop'].assert_called_once_with('12345')
+    cluster.refresh_from_db()
+    assert cluster.most_recent_status == models.Cluster.STATUS_TERMINATING
+
+
+def test_send_expiration_mail(mocker, now, test_user, ssh_key):
+    send_email = mocker.patch('atmo.email.send_email')
+    cluster = models.Cluster.objects.create(
+        identifier='test-cluster',
+        size=5,
+        ssh_key=ssh_key,
+        created_by=test_user,
+        jobflow_id='12345',
+        most_recent_status=models.Cluster.STATUS_WAITING,
+        end_date=now + timedelta(hours=2),
+    )
+    # not expiring soon yet
+    assert not tasks.send_expiration_mail(cluster.id)
+    send_email.assert_not_called()
+
+    cluster.end_date = now + timedelta(minutes=59)
+    cluster.save()
+    assert tasks.send_expiration_mail(cluster.id)
+    send_email.assert_called_once()
+    assert send_email.call_args[1]['to'] == test_user.email
+    cluster.refresh_from_db()
+    assert cluster.expiration_mail_sent
+
+    # the safety net doesn't send it again
+    tasks.send_expiration_mails()
+    assert not tasks.send_expiration_mail(cluster.id)
+    send_email.assert_called_once()
+
+
+def test_update_clusters_adaptive_polling(mocker, now, test_user, ssh_key):
+    def make_cluster(identifier, jobflow_id, status):
+        return models.Cluster.objects.create(
+            identifier=identifier,
+            size=5,
+            ssh_key=ssh_key,
+            created_by=test_user,
+            jobflow_id=jobflow_id,
+            most_recent_status=status,
+            start_date=now,
+        )
+    cluster1 = make_cluster('cluster-1', 'j-1', models.Cluster.STATUS_BOOTSTRAPPING)
+    cluster2 = make_cluster('cluster-2', 'j-2', models.Cluster.STATUS_WAITING)
+    mocker.patch('django.utils.timezone.now', return_value=now)
+    cluster_list = mocker.patch(
+        'atmo.clusters.provisioners.ClusterProvisioner.list',
+        return_value=[
+            {'jobflow_id': 'j-1', 'state': models.Cluster.STATUS_BOOTSTRAPPING},
+            {'jobflow_id': 'j-2', 'state': models.Cluster.STATUS_WAITING},
+        ],
+    )
+    assert tasks.update_clusters() == []
+    assert cluster_list.call_count == 1
+    cluster1.refresh_from_db()
+    cluster2.refresh_from_db()
+    assert cluster1.next_poll_date == now + models.Cluster.POLL_INTERVAL_TRANSITIONAL
+    assert cluster2.next_poll_date == now + models.Cluster.POLL_INTERVAL_STEADY
+
+    # nothing is due yet, so AWS isn't asked at all
+    assert tasks.update_clusters() == []
+    assert cluster_list.call_count == 1
+
+    # only the bootstrapping cluster is due to be polled again
+    later = now + models.Cluster.POLL_INTERVAL_TRANSITIONAL
+    mocker.patch('django.utils.timezone.now', return_value=later)
+    assert list(models.Cluster.objects.due_for_poll()) == [cluster1]
+    tasks.update_clusters()
+    assert cluster_list.call_count == 2
+
+    # storing a new status makes the cluster due right away
+    cluster2.mark_terminating()
+    cluster2.refresh_from_db()
+    assert cluster2.next_poll_date is None
+    assert cluster2 in models.Cluster.objects.due_for_poll()
+
+
+def make_state_change_event(jobflow_id, state, code='', message=''):
+    return json.dumps({
+        'detail-type': 'EMR Cluster State Change',
+        'source': 'aws.emr',
+        'detail': {
+            'clusterId': jobflow_id,
+            'state': state,
+            'stateChangeReason': json.dumps({'code': code, 'message': message}),
+        },
+    })
+
+
+def test_consume_emr_events(mocker, now, test_user, ssh_key):
+    cluster = models.Cluster.objects.create(
+        identifier='test-cluster',
+        size=5,
+        ssh_key=ssh_key,
+        created_by=test_user,
+        jobflow_id='j-1',
+        most_recent_status=models.Cluster.STATUS_BOOTSTRAPPING,
+    )
+    spark_job = SparkJob.objects.create(
+        identifier='test-spark-job',
+        notebook_s3_key='jobs/test-spark-job/test-notebook.ipynb',
+        size=5,
+        job_timeout=12,
+        start_date=now,
+        created_by=test_user,
+    )
+    run = spark_job.runs.create(
+        jobflow_id='j-2',
+        status=models.Cluster.STATUS_RUNNING,
+        scheduled_date=now,
+    )
+    mocker.patch('django.db.transaction.on_commit', side_effect=lambda func: func())
+    update_master_address = mocker.patch('atmo.clusters.tasks.update_master_address.delay')
+    info = mocker.patch('atmo.clusters.provisioners.ClusterProvisioner.info')
+
+    queue = events.MemoryEventQueue()
+    queue.send(make_state_change_event('j-1', models.Cluster.STATUS_WAITING))
+    queue.send(make_state_change_event(
+        'j-2',
+        models.Cluster.STATUS_TERMINATED_WITH_ERRORS,
+        code=models.Cluster.STATE_CHANGE_REASON_STEP_FAILURE,
+        message='Step failed',
+    ))
+    queue.send('not an event')
+    queue.send(json.dumps({'detail-type': 'EMR Step Status Change', 'detail': {}}))
+
+    assert events.consume_events(queue, wait_seconds=0) == 4
+    # all messages were processed
+    assert not queue.messages
+    assert not queue.in_flight
+    # the statuses are updated without asking EMR
+    assert info.call_count == 0
+
+    cluster.refresh_from_db()
+    assert cluster.most_recent_status == models.Cluster.STATUS_WAITING
+    assert cluster.next_poll_date is not None
+    update_master_address.assert_called_once_with(cluster.id)
+
+    run.refresh_from_db()
+    assert run.status == models.Cluster.STATUS_TERMINATED_WITH_ERRORS
+    assert run.terminated_date is not None
+    assert run.alert.reason_code == models.Cluster.STATE_CHANGE_REASON_STEP_FAILURE
+    assert run.alert.reason_message == 'Step failed'
+
+    # events that arrive late don't move the cluster back
+    queue.send(make_state_change_event('j-1', models.Cluster.STATUS_STARTING))
+    assert events.consume_events(queue, wait_seconds=0) == 1
+    cluster.refresh_from_db()
+    assert cluster.most_recent_status == models.Cluster.STATUS_WAITING
+
+    # and don't change final statuses
+    cluster.most_recent_status = models.Cluster.STATUS_TERMINATED
+    cluster.save()
+    queue.send(make_state_change_event('j-1', models.Cluster.STATUS_RUNNING))
+    queue.send(make_state_change_event('j-2', models.Cluster.STATUS_RUNNING))
+    assert events.consume_events(queue, wait_seconds=0) == 2
+    cluster.refresh_from_db()
+    assert cluster.most_recent_status == models.Cluster.STATUS_TERMINATED
+    run.refresh_from_db()
+    assert run.status == models.Cluster.STATUS_TERMINATED_WITH_ERRORS
+
+
+def test_consume_emr_events_failure(mocker, test_user, ssh_key):
+    cluster = models.Cluster.objects.create(
+        identifier='test-cluster',
+        size=5,
+        ssh_key=ssh_key,
+        created_by=test_user,
+        jobflow_id='j-1',
+        most_recent_status=models.Cluster.STATUS_BOOTSTRAPPING,
+    )
+    clock = mocker.patch('atmo.clusters.events.time')
+    clock.time.return_value = 1000.0
+    save_status = mocker.patch.object(models.Cluster, 'save_status', side_effect=ValueError)
+    queue = events.MemoryEventQueue()
+    queue.send(make_state_change_event('j-1', models.Cluster.STATUS_WAITING))
+    # failed messages aren't counted as processed
+    assert events.consume_events(queue, wait_seconds=0) == 0
+    # the message isn't deleted but released to be received again later
+    assert not queue.in_flight
+    assert not queue.messages
+    assert events.consume_events(queue, wait_seconds=0) == 0
+    assert save_status.call_count == 1
+
+    # applying it works the next time
+    mocker.stopall()
+    clock = mocker.patch('atmo.clusters.events.time')
+    clock.time.return_value = 1000.0 + events.RELEASE_DELAY_SECONDS
+    assert events.consume_events(queue, wait_seconds=0) == 1
+    assert not queue.in_flight
+    assert not queue.messages
+    assert not queue.delayed
+    cluster.refresh_from_db()
+    assert cluster.most_recent_status == models.Cluster.STATUS_WAITING
+
+
+def test_consume_emr_events_dead_letter(mocker):
+    clock = mocker.patch('atmo.clusters.events.time')
+    clock.time.return_value = 1000.0
+    apply_event = mocker.patch('atmo.clusters.events.apply_event', side_effect=ValueError)
+    queue = events.MemoryEventQueue()
+    body = make_state_change_event('j-1', models.Cluster.STATUS_WAITING)
+    queue.send(body)
+    delays = []
+    while not queue.dead:
+        assert events.consume_events(queue, wait_seconds=0) == 0
+        if queue.delayed:
+            delays.append(queue.delayed[0][0] - clock.time.return_value)
+            clock.time.return_value = queue.delayed[0][0]
+    # the delay increases with every attempt until the message is given up
+    assert apply_event.call_count == events.MAX_RECEIVE_COUNT
+    assert delays == [30, 60, 120, 240]
+    assert queue.dead == [body]
+    assert not queue.messages
+    assert not queue.delayed
+
+
+def test_event_queue_interface():
+    with pytest.raises(TypeError):
+        events.EventQueue()
+
+
+def test_consume_emr_events_command(settings, test_user, ssh_key):
+    cluster = models.Cluster.objects.create(
+        identifier='test-cluster',
+        size=5,
+        ssh_key=ssh_key,
+        created_by=test_user,
+        jobflow_id='j-1',
+        most_recent_status=models.Cluster.STATUS_STARTING,
+    )
+    settings.EMR_EVENTS_QUEUE_URL = 'memory://'
+    queue = events.get_event_queue()
+    queue.send(make_state_change_event('j-1', models.Cluster.STATUS_BOOTSTRAPPING))
+    output = StringIO()
+    call_command('consume_emr_events', once=True, stdout=output)
+    assert 'Consumed 1 events.' in output.getvalue()
+    cluster.refresh_from_db()
+    assert cluster.most_recent_status == models.Cluster.STATUS_BOOTSTRAPPING
+    # polling is only a fallback now
+    assert (models.Cluster.get_poll_interval(models.Cluster.STATUS_STARTING) ==
+            models.Cluster.POLL_INTERVAL_FALLBACK)
+
+
+def test_consume_emr_events_command_failure(mocker, settings):
+    mocker.patch.object(events, '_memory_queue', events.MemoryEventQueue())
+    mocker.patch('atmo.clusters.events.apply_event', side_effect=ValueError)
+    settings.EMR_EVENTS_QUEUE_URL = 'memory://'
+    events.get_event_queue().send(make_state_change_event('j-1', models.Cluster.STATUS_WAITING))
+    output = StringIO()
+    # a failing message doesn't keep the command from finishing
+    call_command('consume_emr_events', once=True, stdout=output)
+    assert 'Consumed' not in output.getvalue()
+    assert 'done.' in output.getvalue()
+
+
+def test_status_transitions(mocker, now, cluster_provisioner_mocks, test_user, ssh_key):
+    cluster = models.Cluster.objects.create(
+        identifier='test-cluster',
+        size=5,
+        ssh_key=ssh_key,
+        created_by=test_user,
+        jobflow_id='j-1',
+        most_recent_status=models.Cluster.STATUS_STARTING,
+        start_date=now,
+    )
+    transitions = models.ClusterStatusTransition.objects.filter(jobflow_id='j-1')
+    mocker.patch(
+        'atmo.clusters.provisioners.ClusterProvisioner.list',
+        return_value=[
+            {'jobflow_id': 'j-1', 'state': models.Cluster.STATUS_BOOTSTRAPPING},
+        ],
+    )
+    mocker.patch('django.db.transaction.on_commit')
+    tasks.update_clusters()
+    assert list(transitions.values_list('status', 'emr_release', 'size')) == [
+        (models.Cluster.STATUS_BOOTSTRAPPING, cluster.emr_release, 5),
+    ]
+
+    # storing the same status again isn't a transition
+    cluster.refresh_from_db()
+    cluster.mark_terminating()
+    cluster.mark_terminating()
+    assert list(transitions.order_by('pk').values_list('status', flat=True)) == [
+        models.Cluster.STATUS_BOOTSTRAPPING,
+        models.Cluster.STATUS_TERMINATING,
+    ]
+
+
+def test_status_transitions_in_bulk(mocker, now, cluster_provisioner_mocks, test_user,
+                                    ssh_key):
+    for number in range(2):
+        models.Cluster.objects.create(
+            identifier='test-cluster-%s' % number,
+            size=5,
+            ssh_key=ssh_key,
+            created_by=test_user,
+            jobflow_id='j-%s' % number,
+            most_recent_status=models.Cluster.STATUS_BOOTSTRAPPING,
+        )
+    mocker.patch('django.db.transaction.on_commit')
+    bulk_create = mocker.spy(models.ClusterStatusTransition.objects, 'bulk_create')
+    save = mocker.spy(models.ClusterStatusTransition, 'save')
+
+    # the transitions of a batch of events are stored at once
+    queue = events.MemoryEventQueue()
+    queue.send(make_state_change_event('j-0', models.Cluster.STATUS_WAITING))
+    queue.send(make_state_change_event('j-1', models.Cluster.STATUS_WAITING))
+    assert events.consume_events(queue, wait_seconds=0) == 2
+    assert bulk_create.call_count == 1
+    assert len(bulk_create.call_args[0][0]) == 2
+
+    # and so are the ones of the expired clusters
+    models.Cluster.objects.update(end_date=now - timedelta(minutes=1))
+    cluster_provisioner_mocks['info'].return_value = dict(
+        cluster_provisioner_mocks['info'].return_value,
+        state=models.Cluster.STATUS_TERMINATING,
+    )
+    assert len(tasks.deactivate_clusters()) == 2
+    assert bulk_create.call_count == 2
+    assert len(bulk_create.call_args[0][0]) == 2
+    save.assert_not_called()
+    assert models.ClusterStatusTransition.objects.count() == 4
+
+
+def test_status_rollups(db, now):
+    def transition(jobflow_id, status, minutes, emr_release='5.2.1', size=5):
+        models.ClusterStatusTransition.objects.create(
+            jobflow_id=jobflow_id,
+            emr_release=emr_release,
+            size=size,
+            status=status,
+            created_at=now + timedelta(minutes=minutes),
+        )
+    # bootstrapping took 10, 20 and 30 minutes on the three clusters
+    for number, minutes in enumerate([10, 20, 30]):
+        jobflow_id = 'j-%s' % number
+        transition(jobflow_id, models.Cluster.STATUS_BOOTSTRAPPING, 0)
+        transition(jobflow_id, models.Cluster.STATUS_WAITING, minutes)
+    transition('j-3', models.Cluster.STATUS_BOOTSTRAPPING, 0, size=10)
+    transition('j-3', models.Cluster.STATUS_WAITING, 5, size=10)
+    # a cluster that is still bootstrapping doesn't count
+    transition('j-4', models.Cluster.STATUS_BOOTSTRAPPING, 0)
+
+    rollups = models.ClusterStatusRollup.compute()
+    assert [(r.size, r.status, r.count, r.p50, r.p95) for r in rollups] == [
+        (5, models.Cluster.STATUS_BOOTSTRAPPING, 3,
+         timedelta(minutes=20), timedelta(minutes=30)),
+        (10, models.Cluster.STATUS_BOOTSTRAPPING, 1,
+         timedelta(minutes=5), timedelta(minutes=5)),
+    ]
+    assert models.ClusterStatusRollup.objects.count() == 2
+
+    # the rollups are replaced when computing them again
+    output = StringIO()
+    call_command('rollup_cluster_statuses', days=1, stdout=output)
+    assert models.ClusterStatusRollup.objects.count() == 2
+    assert '0:20:00' in output.getvalue()
+
+
+def test_provision_standby_cluster(mocker, cluster_provisioner_mocks, test_user, ssh_key):
+    claim = mocker.patch('atmo.clusters.provisioners.ClusterProvisioner.claim')
+    other_release = models.StandbyCluster.objects.create(
+        jobflow_id='j-other-release',
+        emr_release='5.0.0',
+        size=1,
+        most_recent_status=models.Cluster.STATUS_WAITING,
+    )
+    bootstrapping = models.StandbyCluster.objects.create(
+        jobflow_id='j-bootstrapping',
+        emr_release='5.2.1',
+        size=1,
+        most_recent_status=models.Cluster.STATUS_BOOTSTRAPPING,
+    )
+    waiting = models.StandbyCluster.objects.create(
+        jobflow_id='j-waiting',
+        emr_release='5.2.1',
+        size=1,
+        most_recent_status=models.Cluster.STATUS_WAITING,
+    )
+    cluster = models.Cluster.objects.create(
+        identifier='test-cluster',
+        emr_release='5.2.1',
+        size=1,
+        ssh_key=ssh_key,
+        created_by=test_user,
+    )
+    # the waiting standby cluster is claimed instead of spawning one
+    assert cluster.provision()
+    cluster_provisioner_mocks['start'].assert_not_called()
+    claim.assert_called_once_with(
+        jobflow_id='j-waiting',
+        user_email=test_user.email,
+        identifier='test-cluster',
+        public_key=ssh_key.key,
+    )
+    cluster.refresh_from_db()
+    assert cluster.jobflow_id == 'j-waiting'
+    waiting.refresh_from_db()
+    assert waiting.cluster == cluster
+    assert waiting.claimed_at is not None
+    # to be included when listing the clusters for the status updates
+    assert cluster.start_date == waiting.created_at
+
+    # then the one that is still bootstrapping
+    other_cluster = models.Cluster.objects.create(
+        identifier='other-test-cluster',
+        emr_release='5.2.1',
+        size=1,
+        ssh_key=ssh_key,
+        created_by=test_user,
+    )
+    assert other_cluster.provision()
+    assert other_cluster.jobflow_id == 'j-bootstrapping'
+
+    # and a new cluster is spawned if there is no matching one left
+    third_cluster = models.Cluster.objects.create(
+        identifier='third-test-cluster',
+        emr_release='5.2.1',
+        size=1,
+        ssh_key=ssh_key,
+        created_by=test_user,
+    )
+    assert third_cluster.provision()
+    assert third_cluster.jobflow_id == '12345'
+    cluster_provisioner_mocks['start'].assert_called_once()
+    assert list(models.StandbyCluster.objects.available()) == [other_release]
+    bootstrapping.refresh_from_db()
+    assert bootstrapping.cluster == other_cluster
+
+
+def test_refill_cluster_pool(db, mocker, settings, now, cluster_provisioner_mocks):
+    settings.CLUSTER_POOL = {'5.2.1:1': 2, '5.2.1:3': 1}
+    start_standby = mocker.patch(
+        'atmo.clusters.provisioners.ClusterProvisioner.start_standby',
+        side_effect=['j-new-1', 'j-new-2'],
+    )
+    # a standby cluster that is ready
+    models.StandbyCluster.objects.create(
+        jobflow_id='j-ready',
+        emr_release='5.2.1',
+        size=1,
+    )
+    # a standby cluster that failed to start
+    models.StandbyCluster.objects.create(
+        jobflow_id='j-failed',
+        emr_release='5.2.1',
+        size=3,
+    )
+    # a standby cluster that isn't needed anymore
+    models.StandbyCluster.objects.create(
+        jobflow_id='j-dropped',
+        emr_release='5.0.0',
+        size=1,
+    )
+    mocker.patch(
+        'atmo.clusters.provisioners.ClusterProvisioner.list',
+        return_value=[
+            {'jobflow_id': 'j-ready', 'state': models.Cluster.STATUS_WAITING},
+            {'jobflow_id': 'j-failed', 'state': models.Cluster.STATUS_TERMINATED_WITH_ERRORS},
+            {'jobflow_id': 'j-dropped', 'state': models.Cluster.STATUS_WAITING},
+        ],
+    )
+    spawned = tasks.refill_cluster_pool()
+    assert spawned == ['j-new-1', 'j-new-2']
+    assert sorted(call[1]['size'] for call in start_standby.call_args_list) == [1, 3]
+    cluster_provisioner_mocks['stop'].assert_called_once_with('j-dropped')
+    assert sorted(
+        models.StandbyCluster.objects.available().values_list('jobflow_id', flat=True)
+    ) == ['j-new-1', 'j-new-2', 'j-ready']
+    assert models.StandbyCluster.objects.get(
+        jobflow_id='j-ready',
+    ).most_recent_status == models.Cluster.STATUS_WAITING
+
+    # the pool is full now
+    start_standby.reset_mock()
+    tasks.refill_cluster_pool()
+    start_standby.assert_not_called()
+
+    # standby clusters that weren't claimed for too long are replaced
+    models.StandbyCluster.objects.filter(jobflow_id='j-ready').update(
+        created_at=now - models.StandbyCluster.MAX_AGE,
+    )
+    cluster_provisioner_mocks['stop'].reset_mock()
+    start_standby.side_effect = ['j-new-3']
+    assert tasks.refill_cluster_pool() == ['j-new-3']
+    cluster_provisioner_mocks['stop'].assert_called_once_with('j-ready')
+    assert sorted(
+        models.StandbyCluster.objects.available().values_list('jobflow_id', flat=True)
+    ) == ['j-new-1', 'j-new-2', 'j-new-3']
+
+
+@pytest.fixture
+def node_budgets():
+    constance.config.NODE_BUDGET_TOTAL = 10
+    constance.config.NODE_BUDGET_PER_USER = 6
+    yield
+    constance.config.NODE_BUDGET_TOTAL = 0
+    constance.config.NODE_BUDGET_PER_USER = 0
+
+
+def test_admission_control(mocker, now, cluster_provisioner_mocks, test_user, test_user2,
+                           ssh_key, node_budgets):
+    send_task = mocker.patch('atmo.clusters.admission.celery.send_task')
+    schedule_deadlines = mocker.patch('atmo.clusters.tasks.schedule_deadlines')
+    running_cluster = models.Cluster.objects.create(
+        identifier='running-cluster',
+        size=5,
+        jobflow_id='j-running',
+        most_recent_status=models.Cluster.STATUS_WAITING,
+        ssh_key=ssh_key,
+        created_by=test_user,
+    )
+    # the user's budget would be exceeded
+    cluster = models.Cluster.objects.create(
+        identifier='test-cluster',
+        size=3,
+        ssh_key=ssh_key,
+        created_by=test_user,
+    )
+    tasks.provision_cluster(cluster.id)
+    cluster_provisioner_mocks['start'].assert_not_called()
+    cluster.refresh_from_db()
+    assert cluster.is_pending
+    assert cluster.is_queued
+    # the queued cluster's lifetime doesn't start yet
+    schedule_deadlines.assert_not_called()
+
+    # another user's cluster fits the budgets and isn't held back
+    other_cluster = models.Cluster.objects.create(
+        identifier='other-test-cluster',
+        size=4,
+        ssh_key=ssh_key,
+        created_by=test_user2,
+    )
+    tasks.provision_cluster(other_cluster.id)
+    cluster_provisioner_mocks['start'].assert_called_once()
+
+    # the global budget would be exceeded
+    spark_job = SparkJob.objects.create(
+        identifier='test-spark-job',
+        notebook_s3_key='jobs/test-spark-job/test-notebook.ipynb',
+        size=2,
+        job_timeout=1,
+        start_date=now,
+        created_by=test_user2,
+    )
+    assert job_tasks.run_spark_job(spark_job) is None
+    assert spark_job.get_latest_run() is None
+    assert [launch.task for launch in models.QueuedLaunch.objects.all()] == [
+        models.QueuedLaunch.TASK_PROVISION_CLUSTER,
+        models.QueuedLaunch.TASK_LAUNCH_SPARK_JOB,
+    ]
+
+    # nothing fits yet
+    assert tasks.release_queued_launches() == []
+    send_task.assert_not_called()
+
+    # until the first cluster is terminated
+    running_cluster.most_recent_status = models.Cluster.STATUS_TERMINATED
+    running_cluster.save()
+    assert tasks.release_queued_launches() == [
+        'atmo.clusters.tasks.provision_cluster(%s)' % cluster.id,
+        'atmo.jobs.tasks.launch_spark_job(%s)' % spark_job.id,
+    ]
+    send_task.assert_any_call(
+        models.QueuedLaunch.TASK_PROVISION_CLUSTER,
+        args=[cluster.id],
+        kwargs={'admitted': True},
+    )
+    assert not models.QueuedLaunch.objects.exists()
+
+    # the released launch isn't held back again
+    tasks.provision_cluster(cluster.id, admitted=True)
+    assert cluster_provisioner_mocks['start'].call_count == 2
+    cluster.refresh_from_db()
+    schedule_deadlines.assert_called_with(cluster)
+    assert schedule_deadlines.call_args[0][0].end_date == cluster.end_date
+
+    # terminating a queued cluster removes it from the queue
+    queued_cluster = models.Cluster.objects.create(
+        identifier='queued-cluster',
+        size=10,
+        ssh_key=ssh_key,
+        created_by=test_user2,
+    )
+    tasks.provision_cluster(queued_cluster.id)
+    assert queued_cluster.is_queued
+    queued_cluster.deactivate()
+    assert not models.QueuedLaunch.objects.exists()
+
+
+def test_admission_counts_admitted_clusters(mocker, cluster_provisioner_mocks, test_user,
+                                            test_user2, ssh_key, node_budgets):
+    mocker.patch('atmo.clusters.admission.celery.send_task')
+    # admitted from the queue but not spawned yet
+    admitted_cluster = models.Cluster.objects.create(
+        identifier='admitted-cluster',
+        size=5,
+        ssh_key=ssh_key,
+        created_by=test_user,
+    )
+    queued_cluster = models.Cluster.objects.create(
+        identifier='queued-cluster',
+        size=4,
+        ssh_key=ssh_key,
+        created_by=test_user,
+    )
+    models.QueuedLaunch.objects.create(
+        task=models.QueuedLaunch.TASK_PROVISION_CLUSTER,
+        object_id=queued_cluster.pk,
+        user=test_user,
+        size=4,
+        priority=models.QueuedLaunch.PRIORITY_CLUSTER,
+    )
+    usage = admission.NodeUsage.current()
+    assert usage.per_user[test_user.pk] == 5
+    assert usage.total == 5
+    # the cluster being admitted doesn't count against itself
+    assert admission.NodeUsage.current(cluster_id=admitted_cluster.pk).total == 0
+
+    # the queued cluster doesn't fit the user's budget next to it
+    assert tasks.release_queued_launches() == []
+    assert queued_cluster.is_queued
+
+    # until it's spawned and terminated
+    admitted_cluster.jobflow_id = 'j-admitted'
+    admitted_cluster.most_recent_status = models.Cluster.STATUS_TERMINATED
+    admitted_cluster.save()
+    assert tasks.release_queued_launches() == [
+        'atmo.clusters.tasks.provision_cluster(%s)' % queued_cluster.pk,
+    ]
+
+
+def test_release_stale_queued_launches(mocker, now, test_user, ssh_key, node_budgets):
+    send_task = mocker.patch('atmo.clusters.admission.celery.send_task')
+    spark_job = SparkJob.objects.create(
+        identifier='test-spark-job',
+        notebook_s3_key='jobs/test-spark-job/test-notebook.ipynb',
+        size=2,
+        job_timeout=1,
+        start_date=now,
+        created_by=test_user,
+    )
+    terminated_cluster = models.Cluster.objects.create(
+        identifier='terminated-cluster',
+        size=1,
+        ssh_key=ssh_key,
+        created_by=test_user,
+    )
+    # e.g. terminated before it was spawned
+    models.Cluster.objects.filter(pk=terminated_cluster.pk).update(
+        most_recent_status=models.Cluster.STATUS_TERMINATED,
+    )
+    for task, object_id in [
+            (models.QueuedLaunch.TASK_LAUNCH_SPARK_JOB, spark_job.pk),
+            (models.QueuedLaunch.TASK_LAUNCH_SPARK_JOB, spark_job.pk + 1),
+            (models.QueuedLaunch.TASK_PROVISION_CLUSTER, terminated_cluster.pk),
+            (models.QueuedLaunch.TASK_PROVISION_CLUSTER, terminated_cluster.pk + 1)]:
+        models.QueuedLaunch.objects.create(
+            task=task,
+            object_id=object_id,
+            user=test_user,
+            size=2,
+            priority=models.QueuedLaunch.PRIORITY_CLUSTER,
+        )
+    # the launches of objects that are gone or done are dropped
+    assert tasks.release_queued_launches() == [
+        'atmo.jobs.tasks.launch_spark_job(%s)' % spark_job.pk,
+    ]
+    send_task.assert_called_once()
+    assert not models.QueuedLaunch.objects.exists()
+
+
+def test_cluster_form_max_size(test_user):
+    form = NewClusterForm(test_user)
+    # the maximum size is validated the same way as for Spark jobs
+    form.cleaned_data = {'size': 4, 'max_size': 4}
+    with pytest.raises(ValidationError) as exc:
+        form.clean_max_size()
+    assert exc.value.messages == [
+        'The maximum cluster size needs to be larger than the cluster size.',
+    ]
+    form.cleaned_data = {'size': 4, 'max_size': 8}
+    assert form.clean_max_size() == 8
+
+
+def test_auto_scaling_cluster(mocker, cluster_provisioner_mocks, test_user, ssh_key,
+                              node_budgets):
+    mocker.patch('atmo.clusters.tasks.schedule_deadlines')
+    models.StandbyCluster.objects.create(
+        jobflow_id='j-waiting',
+        emr_release='5.2.1',
+        size=2,
+        most_recent_status=models.Cluster.STATUS_WAITING,
+    )
+    cluster = models.Cluster.objects.create(
+        identifier='test-cluster',
+        emr_release='5.2.1',
+        size=2,
+        max_size=6,
+        ssh_key=ssh_key,
+        created_by=test_user,
+    )
+    assert cluster.peak_size == 6
+    # standby clusters don't auto-scale and aren't claimed
+    tasks.provision_cluster(cluster.id)
+    assert cluster_provisioner_mocks['start'].call_args[1]['max_size'] == 6
+    cluster.refresh_from_db()
+    assert cluster.jobflow_id == '12345'
+
+    # the user's budget counts the cluster with its maximum size
+    usage = admission.NodeUsage.current()
+    assert usage.per_user[test_user.pk] == 6
+    assert not usage.fits_user(test_user.pk, 1)
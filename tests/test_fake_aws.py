@@ -0,0 +1,169 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+import pytest
+from botocore.exceptions import ClientError
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from atmo import fake_aws
+from atmo.clusters.models import Cluster
+from atmo.clusters.provisioners import ClusterProvisioner
+from atmo.jobs.models import SparkJob
+from atmo.jobs.provisioners import SparkJobProvisioner
+
+
+@pytest.fixture
+def fake(mocker, settings):
+    mocker.patch.dict(fake_aws._fake_aws, clear=True)
+    settings.FAKE_AWS_URL = (
+        'memory://?starting=10&bootstrapping=20&step=30&terminating=5&seed=1'
+    )
+    fake = fake_aws.get_fake_aws()
+    fake.clock = 1000.0
+    mocker.patch.object(fake, 'now', side_effect=lambda: fake.clock)
+    return fake
+
+
+def test_fake_aws_url(settings):
+    settings.FAKE_AWS_URL = ''
+    assert fake_aws.get_fake_aws() is None
+    aws = fake_aws.FakeAWS.from_url('redis://localhost:6379/2?latency=0.5&seed=3')
+    assert isinstance(aws.store, fake_aws.RedisStore)
+    assert aws.options['latency'] == 0.5
+    assert aws.options['seed'] == 3
+    with pytest.raises(ValueError):
+        fake_aws.FakeAWS.from_url('memory://?speed=10')
+    with pytest.raises(ValueError):
+        fake_aws.FakeAWS.from_url('http://localhost/')
+
+
+def test_fake_aws_cluster(fake, ssh_key):
+    provisioner = ClusterProvisioner()
+    assert isinstance(provisioner.emr, fake_aws.FakeEMR)
+    assert provisioner.session.get(provisioner.spark_emr_configuration_url).json() == []
+    jobflow_id = provisioner.start(
+        user_email='user@example.com',
+        identifier='cluster',
+        emr_release='5.2.1',
+        size=3,
+        public_key=ssh_key.key,
+        max_size=5,
+    )
+
+    def state():
+        return provisioner.info(jobflow_id)['state']
+
+    assert state() == Cluster.STATUS_STARTING
+    fake.clock += 10
+    assert state() == Cluster.STATUS_BOOTSTRAPPING
+    assert provisioner.info(jobflow_id)['public_dns'] is None
+    fake.clock += 20
+    # the Zeppelin setup step runs first
+    assert state() == Cluster.STATUS_RUNNING
+    assert provisioner.info(jobflow_id)['public_dns']
+    assert provisioner.node_count(jobflow_id) == 3
+    fake.clock += 30
+    assert state() == Cluster.STATUS_WAITING
+    assert provisioner.node_count(jobflow_id) == 3
+    assert [info['jobflow_id'] for info in provisioner.list(created_after=0)] == [jobflow_id]
+
+    provisioner.stop(jobflow_id)
+    assert state() == Cluster.STATUS_TERMINATING
+    fake.clock += 5
+    info = provisioner.info(jobflow_id)
+    assert info['state'] == Cluster.STATUS_TERMINATED
+    assert info['state_change_reason_code'] == Cluster.STATE_CHANGE_REASON_USER_REQUEST
+    assert provisioner.node_count(jobflow_id) == 0
+
+
+def test_fake_aws_spark_jobs(fake, notebook_maker):
+    provisioner = SparkJobProvisioner()
+    cluster_provisioner = ClusterProvisioner()
+    key = provisioner.add('test-spark-job', notebook_maker())
+    notebook = provisioner.get(key)
+    assert notebook['Body'].read() == b'{}'
+    assert notebook['ContentLength'] == 2
+    assert provisioner.results('test-spark-job', is_public=False) == {}
+
+    jobflow_id = provisioner.run(
+        user_email='user@example.com',
+        identifier='test-spark-job',
+        emr_release='5.2.1',
+        size=2,
+        notebook_key=key,
+        is_public=False,
+        job_timeout=1,
+    )
+    fake.clock += 30
+    assert cluster_provisioner.info(jobflow_id)['state'] == Cluster.STATUS_RUNNING
+    fake.clock += 30
+    assert cluster_provisioner.info(jobflow_id)['state'] == Cluster.STATUS_TERMINATING
+    fake.clock += 5
+    info = cluster_provisioner.info(jobflow_id)
+    assert info['state'] == Cluster.STATUS_TERMINATED
+    assert info['state_change_reason_code'] == Cluster.STATE_CHANGE_REASON_ALL_STEPS_COMPLETED
+
+    # the steps of packed runs run one after the other
+    jobflow_id, step_ids = provisioner.run_packed(
+        user_email='user@example.com',
+        identifier='packed',
+        emr_release='5.2.1',
+        size=2,
+        notebooks=[('first', key, 1), ('second', key, 1), ('third', key, 1)],
+        is_public=False,
+        job_timeout=1,
+    )
+    fake.clock += 30
+    provisioner.cancel_step(jobflow_id, step_ids['third'])
+    states = {
+        step_id: step_info['state']
+        for step_id, step_info in provisioner.list_steps(jobflow_id).items()
+    }
+    assert states == {
+        step_ids['first']: Cluster.STATUS_RUNNING,
+        step_ids['second']: Cluster.STATUS_PENDING,
+        step_ids['third']: Cluster.STATUS_TERMINATED_WITH_ERRORS,
+    }
+    fake.clock += 60
+    step_info = provisioner.step_info(jobflow_id, step_ids['second'])
+    assert step_info['state'] == Cluster.STATUS_TERMINATED
+
+
+def test_fake_aws_failures(mocker, fake, ssh_key):
+    provisioner = ClusterProvisioner()
+    mocker.patch.dict(fake.options, {'failure_rate': 1.0})
+    jobflow_id = provisioner.start(
+        user_email='user@example.com',
+        identifier='cluster',
+        emr_release='5.2.1',
+        size=3,
+        public_key=ssh_key.key,
+    )
+    fake.clock += 35
+    info = provisioner.info(jobflow_id)
+    assert info['state'] == Cluster.STATUS_TERMINATED_WITH_ERRORS
+    assert info['state_change_reason_code'] == Cluster.STATE_CHANGE_REASON_BOOTSTRAP_FAILURE
+
+    mocker.patch.dict(fake.options, {'throttle_rate': 1.0})
+    with pytest.raises(ClientError) as exc:
+        provisioner.info(jobflow_id)
+    assert exc.value.response['Error']['Code'] == 'ThrottlingException'
+
+    mocker.patch.dict(fake.options, {'throttle_rate': 0.0})
+    with pytest.raises(ClientError):
+        provisioner.info('j-unknown')
+
+
+@pytest.mark.django_db
+def test_load_test_command(mocker, fake, settings, schedule_entry_mocks):
+    mocker.patch('atmo.jobs.tasks.expire_spark_job.apply_async')
+    call_command('load_test', clusters=2, spark_jobs=2, sweeps=1)
+    assert Cluster.objects.filter(jobflow_id__startswith='j-').count() == 2
+    # the due Spark jobs were run on the fake AWS
+    for spark_job in SparkJob.objects.all():
+        assert spark_job.latest_run.jobflow_id.startswith('j-')
+
+    settings.FAKE_AWS_URL = ''
+    with pytest.raises(CommandError):
+        call_command('load_test')
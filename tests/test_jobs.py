@@ -4,14 +4,18 @@
 import io
 from datetime import datetime, timedelta
 
+import constance
 import pytest
 from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
 from django.utils import timezone
 from freezegun import freeze_time
 
-from atmo.clusters.models import Cluster
-from atmo.jobs import models, tasks
+from atmo.clusters.models import Cluster, ClusterStatusTransition
+from atmo.jobs import cron, models, schedules, tasks
+from atmo.jobs.forms import EditSparkJobForm
 
 
 @pytest.fixture
@@ -147,6 +151,8 @@ def test_create_spark_job(client, mocker, notebook_maker,
         notebook_key=spark_job.notebook_s3_key,
         size=spark_job.size,
         user_email=test_user.email,
+        use_spot=True,
+        max_size=None,
     )
     assert spark_job.latest_run is not None
     assert spark_job.latest_run.status == Cluster.STATUS_BOOTSTRAPPING
@@ -343,8 +349,43 @@ def test_spark_job_update_statuses(request, mocker, client, test_user,
     assert spark_job.latest_run.status == Cluster.STATUS_TERMINATED_WITH_ERRORS
 
 
+def test_spark_job_run_update_status_concurrent(mocker, now, test_user):
+    spark_job = models.SparkJob.objects.create(
+        identifier='test-spark-job',
+        description='description',
+        notebook_s3_key='jobs/test-spark-job/test-notebook.ipynb',
+        result_visibility='private',
+        size=5,
+        interval_in_hours=24,
+        job_timeout=12,
+        start_date=now,
+        created_by=test_user,
+    )
+    run = spark_job.runs.create(
+        jobflow_id='12345',
+        status=Cluster.STATUS_RUNNING,
+        scheduled_date=now,
+    )
+    stale_run = models.SparkJobRun.objects.get(pk=run.pk)
+    info = {
+        'start_time': now,
+        'state': Cluster.STATUS_TERMINATED_WITH_ERRORS,
+        'state_change_reason_code': Cluster.STATE_CHANGE_REASON_BOOTSTRAP_FAILURE,
+        'state_change_reason_message': 'Bootstrapping steps failed.',
+        'public_dns': None,
+    }
+    assert run.update_status(info) == Cluster.STATUS_TERMINATED_WITH_ERRORS
+    assert run.alert is not None
+
+    # a second worker with an outdated copy doesn't store the status again
+    # and doesn't create a second alert
+    assert stale_run.update_status(info) == Cluster.STATUS_TERMINATED_WITH_ERRORS
+    assert stale_run.terminated_date == run.terminated_date
+    assert models.SparkJobRunAlert.objects.filter(run=run).count() == 1
+
+
 def test_delete_spark_job(request, mocker, client, test_user, test_user2,
-                          sparkjob_provisioner_mocks):
+                          sparkjob_provisioner_mocks, schedule_entry_mocks):
     # create a test job to delete later
     spark_job = models.SparkJob.objects.create(
         identifier='test-spark-job',
@@ -369,11 +410,23 @@ def test_delete_spark_job(request, mocker, client, test_user, test_user2,
     client.force_login(test_user)
 
     # request that the test job be deleted
+    mocker.patch('django.db.transaction.on_commit', side_effect=lambda func: func())
+    cleanup_spark_job = mocker.patch('atmo.jobs.tasks.cleanup_spark_job.delay')
     response = client.post(delete_url, follow=True)
 
     assert response.status_code == 200
     assert response.redirect_chain[-1], ('/' == 302)
 
+    # the schedule entry is removed right away
+    schedule_entry_mocks['delete'].assert_called_once_with()
+    # the notebook is removed in the background
+    sparkjob_provisioner_mocks['remove'].assert_not_called()
+    cleanup_spark_job.assert_called_once_with(
+        'jobs/test-spark-job/test-notebook.ipynb',
+        jobflow_id=None,
+        step_id=None,
+    )
+    tasks.cleanup_spark_job('jobs/test-spark-job/test-notebook.ipynb', jobflow_id=None)
     sparkjob_provisioner_mocks['remove'].assert_called_with(
         'jobs/test-spark-job/test-notebook.ipynb'
     )
@@ -646,3 +699,1230 @@ def test_send_run_alert_mails(client, mocker, test_user,
         subject='[ATMO] Running Spark job %s failed' % spark_job.identifier,
         body=mocker.ANY,
     )
+
+
+def test_spark_job_run_reservation(mocker, now, test_user, sparkjob_provisioner_mocks):
+    spark_job = models.SparkJob.objects.create(
+        identifier='test-spark-job',
+        description='description',
+        notebook_s3_key='jobs/test-spark-job/test-notebook.ipynb',
+        result_visibility='private',
+        size=5,
+        interval_in_hours=24,
+        job_timeout=12,
+        start_date=now - timedelta(hours=1),
+        created_by=test_user,
+    )
+    run = spark_job.reserve_run()
+    assert run.status == models.RESERVED_STATUS
+    assert run.jobflow_id is None
+    assert spark_job.latest_run == run
+    assert not spark_job.is_runnable
+    assert not spark_job.is_expired
+
+    # another process can't reserve a second run
+    other_spark_job = models.SparkJob.objects.get(pk=spark_job.pk)
+    assert other_spark_job.reserve_run() is None
+    other_spark_job.run()
+    sparkjob_provisioner_mocks['run'].assert_not_called()
+
+    run.confirm_reservation('12345')
+    run.refresh_from_db()
+    assert run.jobflow_id == '12345'
+    assert run.status == models.RESERVED_STATUS
+    assert list(models.SparkJob.objects.active()) == [spark_job]
+
+
+def test_spark_job_run_launch_failed(mocker, now, test_user, sparkjob_provisioner_mocks):
+    spark_job = models.SparkJob.objects.create(
+        identifier='test-spark-job',
+        description='description',
+        notebook_s3_key='jobs/test-spark-job/test-notebook.ipynb',
+        result_visibility='private',
+        size=5,
+        interval_in_hours=24,
+        job_timeout=12,
+        start_date=now - timedelta(hours=1),
+        created_by=test_user,
+    )
+    sparkjob_provisioner_mocks['run'].side_effect = ValueError('EMR is down')
+    with pytest.raises(ValueError):
+        spark_job.run()
+
+    run = spark_job.runs.get()
+    assert run.status == models.LAUNCH_FAILED_STATUS
+    assert run.jobflow_id is None
+    assert run.terminated_date is not None
+    # the job is retried right away
+    spark_job.clear_latest_run()
+    assert spark_job.is_runnable
+    assert spark_job.should_run()
+
+
+def test_run_jobs_fails_stale_reservations(mocker, now, test_user, sparkjob_provisioner_mocks):
+    spark_job = models.SparkJob.objects.create(
+        identifier='test-spark-job',
+        description='description',
+        notebook_s3_key='jobs/test-spark-job/test-notebook.ipynb',
+        result_visibility='private',
+        size=5,
+        interval_in_hours=24,
+        job_timeout=12,
+        start_date=now - timedelta(hours=1),
+        created_by=test_user,
+        is_enabled=False,
+    )
+    stale_run = spark_job.runs.create(
+        status=models.RESERVED_STATUS,
+        scheduled_date=now - models.RESERVATION_TIMEOUT - timedelta(minutes=1),
+    )
+    mocker.patch(
+        'atmo.clusters.provisioners.ClusterProvisioner.list',
+        return_value=[],
+    )
+    tasks.run_jobs()
+    stale_run.refresh_from_db()
+    assert stale_run.status == models.LAUNCH_FAILED_STATUS
+
+
+def test_run_jobs_status_transitions(mocker, now, test_user):
+    for number in range(2):
+        spark_job = models.SparkJob.objects.create(
+            identifier='test-spark-job-%s' % number,
+            description='description',
+            notebook_s3_key='jobs/test-spark-job/test-notebook.ipynb',
+            result_visibility='private',
+            size=5,
+            interval_in_hours=24,
+            job_timeout=12,
+            start_date=now - timedelta(hours=1),
+            created_by=test_user,
+        )
+        spark_job.runs.create(
+            jobflow_id='j-%s' % number,
+            status=Cluster.STATUS_BOOTSTRAPPING,
+            scheduled_date=now,
+        )
+    mocker.patch(
+        'atmo.clusters.provisioners.ClusterProvisioner.list',
+        return_value=[
+            {
+                'jobflow_id': 'j-%s' % number,
+                'state': Cluster.STATUS_RUNNING,
+                'state_change_reason_code': None,
+                'state_change_reason_message': None,
+            }
+            for number in range(2)
+        ],
+    )
+    bulk_create = mocker.spy(ClusterStatusTransition.objects, 'bulk_create')
+    tasks.run_jobs()
+    # the transitions of all runs are stored at once
+    assert bulk_create.call_count == 1
+    assert sorted(
+        transition.jobflow_id for transition in bulk_create.call_args[0][0]
+    ) == ['j-0', 'j-1']
+    assert ClusterStatusTransition.objects.filter(status=Cluster.STATUS_RUNNING).count() == 2
+
+
+def test_cleanup_spark_job(cluster_provisioner_mocks, sparkjob_provisioner_mocks):
+    tasks.cleanup_spark_job('jobs/test-spark-job/test-notebook.ipynb', jobflow_id='12345')
+    cluster_provisioner_mocks['stop'].assert_called_once_with('12345')
+    sparkjob_provisioner_mocks['remove'].assert_called_once_with(
+        'jobs/test-spark-job/test-notebook.ipynb'
+    )
+
+
+def test_spark_job_running_jobflow_id(now, test_user):
+    spark_job = models.SparkJob.objects.create(
+        identifier='test-spark-job',
+        description='description',
+        notebook_s3_key='jobs/test-spark-job/test-notebook.ipynb',
+        result_visibility='private',
+        size=5,
+        interval_in_hours=24,
+        job_timeout=12,
+        start_date=now - timedelta(hours=1),
+        created_by=test_user,
+    )
+    assert spark_job.running_jobflow_id is None
+    run = spark_job.runs.create(
+        jobflow_id='12345',
+        status=Cluster.STATUS_RUNNING,
+        scheduled_date=now,
+    )
+    spark_job.clear_latest_run()
+    assert spark_job.running_jobflow_id == '12345'
+    run.status = Cluster.STATUS_TERMINATED
+    run.save()
+    spark_job.clear_latest_run()
+    assert spark_job.running_jobflow_id is None
+
+
+def test_spark_job_next_run_date(now, test_user):
+    spark_job = models.SparkJob.objects.create(
+        identifier='test-spark-job',
+        description='description',
+        notebook_s3_key='jobs/test-spark-job/test-notebook.ipynb',
+        result_visibility='private',
+        size=5,
+        interval_in_hours=24,
+        job_timeout=12,
+        start_date=now - timedelta(hours=1),
+        created_by=test_user,
+    )
+    # never ran before, so it's due at the start date
+    assert spark_job.next_run_date == spark_job.start_date
+
+    run = spark_job.runs.create(
+        jobflow_id='12345',
+        status=Cluster.STATUS_RUNNING,
+        scheduled_date=now,
+    )
+    spark_job.clear_latest_run()
+    assert spark_job.next_run_date == now + timedelta(hours=24)
+
+    # failed launches are tried again right away
+    run.status = models.LAUNCH_FAILED_STATUS
+    run.save()
+    spark_job.clear_latest_run()
+    assert spark_job.next_run_date == spark_job.start_date
+
+    spark_job.end_date = now - timedelta(minutes=30)
+    assert spark_job.next_run_date is None
+    spark_job.end_date = None
+    spark_job.is_enabled = False
+    assert spark_job.next_run_date is None
+
+
+def test_schedule_spark_job(mocker, now, test_user, schedule_entry_mocks):
+    spark_job = models.SparkJob.objects.create(
+        identifier='test-spark-job',
+        description='description',
+        notebook_s3_key='jobs/test-spark-job/test-notebook.ipynb',
+        result_visibility='private',
+        size=5,
+        interval_in_hours=24,
+        job_timeout=12,
+        start_date=now + timedelta(hours=1),
+        created_by=test_user,
+    )
+    entry = schedules.schedule_spark_job(spark_job)
+    assert entry.name == 'spark-job-%s' % spark_job.pk
+    assert entry.task == 'atmo.jobs.tasks.run_job'
+    assert entry.args == [spark_job.pk]
+    assert entry.schedule.run_every == timedelta(hours=24)
+    schedule_entry_mocks['save'].assert_called_once_with()
+    schedule_entry_mocks['reschedule'].assert_called_once_with(
+        last_run_at=spark_job.start_date - timedelta(hours=24),
+    )
+    schedule_entry_mocks['delete'].assert_not_called()
+
+    # a job that is due but still running isn't scheduled in the past
+    schedule_entry_mocks['reschedule'].reset_mock()
+    spark_job.start_date = now - timedelta(days=2)
+    spark_job.runs.create(
+        jobflow_id='j-1',
+        status=Cluster.STATUS_RUNNING,
+        scheduled_date=now - timedelta(hours=30),
+    )
+    spark_job.clear_latest_run()
+    assert spark_job.next_run_date < now
+    mocker.patch('django.utils.timezone.now', return_value=now)
+    schedules.schedule_spark_job(spark_job)
+    schedule_entry_mocks['reschedule'].assert_called_once_with(
+        last_run_at=now + schedules.RESCHEDULE_DELAY - timedelta(hours=24),
+    )
+
+    # cron jobs are checked shortly after instead of at the interval
+    spark_job.schedule = '0 6 * * *'
+    spark_job.save()
+    spark_job.update_fire_times()
+    entry = schedules.schedule_spark_job(spark_job)
+    assert entry.schedule.run_every == schedules.RESCHEDULE_DELAY
+
+    spark_job.is_enabled = False
+    assert schedules.schedule_spark_job(spark_job) is None
+    schedule_entry_mocks['delete'].assert_called_once_with()
+
+
+def test_run_job(mocker, now, test_user, sparkjob_provisioner_mocks):
+    spark_job = models.SparkJob.objects.create(
+        identifier='test-spark-job',
+        description='description',
+        notebook_s3_key='jobs/test-spark-job/test-notebook.ipynb',
+        result_visibility='private',
+        size=5,
+        interval_in_hours=24,
+        job_timeout=12,
+        start_date=now - timedelta(hours=1),
+        created_by=test_user,
+    )
+    mocker.patch(
+        'atmo.clusters.provisioners.ClusterProvisioner.info',
+        return_value={
+            'start_time': now,
+            'state': Cluster.STATUS_BOOTSTRAPPING,
+            'state_change_reason_code': None,
+            'state_change_reason_message': None,
+            'public_dns': None,
+        },
+    )
+    schedule_spark_job = mocker.patch('atmo.jobs.tasks.schedule_spark_job')
+    expire_spark_job = mocker.patch('atmo.jobs.tasks.expire_spark_job.apply_async')
+    tasks.run_job(spark_job.pk)
+    sparkjob_provisioner_mocks['run'].assert_called_once()
+    assert schedule_spark_job.call_count == 1
+    scheduled_job = schedule_spark_job.call_args[0][0]
+    assert scheduled_job.latest_run.jobflow_id == '12345'
+    # the termination is queued for when the run times out
+    expire_spark_job.assert_called_once_with(
+        args=[spark_job.pk],
+        eta=scheduled_job.latest_run.scheduled_date + timedelta(hours=12),
+    )
+
+    # the job is still running, so it's only scheduled again
+    tasks.run_job(spark_job.pk)
+    sparkjob_provisioner_mocks['run'].assert_called_once()
+    assert schedule_spark_job.call_count == 2
+
+    # a deleted job removes its schedule entry
+    unschedule_spark_job = mocker.patch('atmo.jobs.tasks.unschedule_spark_job')
+    spark_job_id = spark_job.pk
+    spark_job.delete(cleanup=False)
+    tasks.run_job(spark_job_id)
+    unschedule_spark_job.assert_called_once_with(spark_job_id)
+
+
+def test_expire_spark_job(mocker, now, test_user, cluster_provisioner_mocks):
+    spark_job = models.SparkJob.objects.create(
+        identifier='test-spark-job',
+        description='description',
+        notebook_s3_key='jobs/test-spark-job/test-notebook.ipynb',
+        result_visibility='private',
+        size=5,
+        interval_in_hours=24,
+        job_timeout=12,
+        start_date=now - timedelta(hours=1),
+        created_by=test_user,
+    )
+    spark_job.runs.create(
+        jobflow_id='12345',
+        status=Cluster.STATUS_RUNNING,
+        scheduled_date=now,
+    )
+    # the run hasn't timed out yet
+    tasks.expire_spark_job(spark_job.pk)
+    cluster_provisioner_mocks['stop'].assert_not_called()
+
+    mocker.patch('django.utils.timezone.now', return_value=now + timedelta(hours=12))
+    tasks.expire_spark_job(spark_job.pk)
+    cluster_provisioner_mocks['stop'].assert_called_once_with('12345')
+
+
+def test_run_spark_job(client, mocker, now, test_user, test_user2,
+                       sparkjob_provisioner_mocks):
+    spark_job = models.SparkJob.objects.create(
+        identifier='test-spark-job',
+        description='description',
+        notebook_s3_key='jobs/test-spark-job/test-notebook.ipynb',
+        result_visibility='private',
+        size=5,
+        interval_in_hours=24,
+        job_timeout=12,
+        start_date=now + timedelta(days=1),
+        created_by=test_user,
+    )
+    cache.delete(tasks.launch_lock_key(spark_job.id))
+    launch_spark_job = mocker.patch('atmo.jobs.tasks.launch_spark_job.delay')
+    run_url = reverse('jobs-run', kwargs={'id': spark_job.id})
+
+    # login the second user so we can check the change_sparkjob permission
+    client.force_login(test_user2)
+    response = client.post(run_url, follow=True)
+    assert response.status_code == 403
+    client.force_login(test_user)
+
+    response = client.post(run_url, follow=True)
+    assert response.status_code == 200
+    assert response.redirect_chain[-1] == (spark_job.get_absolute_url(), 302)
+    launch_spark_job.assert_called_once_with(spark_job.id)
+
+    # the launch is already queued, so it's not queued again
+    response = client.post(run_url, follow=True)
+    assert response.status_code == 200
+    launch_spark_job.assert_called_once_with(spark_job.id)
+
+
+def test_launch_spark_job(mocker, now, test_user, sparkjob_provisioner_mocks):
+    spark_job = models.SparkJob.objects.create(
+        identifier='test-spark-job',
+        description='description',
+        notebook_s3_key='jobs/test-spark-job/test-notebook.ipynb',
+        result_visibility='private',
+        size=5,
+        interval_in_hours=24,
+        job_timeout=12,
+        start_date=now + timedelta(days=1),
+        created_by=test_user,
+    )
+    cache.delete(tasks.launch_lock_key(spark_job.id))
+    mocker.patch(
+        'atmo.clusters.provisioners.ClusterProvisioner.info',
+        return_value={
+            'start_time': now,
+            'state': Cluster.STATUS_BOOTSTRAPPING,
+            'state_change_reason_code': None,
+            'state_change_reason_message': None,
+            'public_dns': None,
+        },
+    )
+    mocker.patch('atmo.jobs.tasks.expire_spark_job.apply_async')
+    launch_spark_job = mocker.patch('atmo.jobs.tasks.launch_spark_job.delay')
+    assert tasks.queue_launch(spark_job)
+    assert not tasks.queue_launch(spark_job)
+
+    # the job runs even though it's not scheduled to run yet
+    tasks.launch_spark_job(spark_job.id)
+    sparkjob_provisioner_mocks['run'].assert_called_once()
+    spark_job.clear_latest_run()
+    assert spark_job.latest_run.jobflow_id == '12345'
+
+    # the job is running, so it can't be queued again
+    assert not tasks.queue_launch(spark_job)
+    assert launch_spark_job.call_count == 1
+
+
+def test_spark_job_runtime_stats(mocker, now, test_user):
+    spark_job = models.SparkJob.objects.create(
+        identifier='test-spark-job',
+        description='description',
+        notebook_s3_key='jobs/test-spark-job/test-notebook.ipynb',
+        result_visibility='private',
+        size=10,
+        interval_in_hours=24,
+        job_timeout=12,
+        start_date=now - timedelta(days=5),
+        created_by=test_user,
+    )
+    assert spark_job.runtime_stats is None
+    # older runs took 20 and 30 minutes, newer ones 40 minutes
+    for days, minutes in [(5, 20), (4, 30), (3, 40)]:
+        scheduled_date = now - timedelta(days=days)
+        spark_job.runs.create(
+            jobflow_id='j-%s' % days,
+            status=Cluster.STATUS_TERMINATED,
+            scheduled_date=scheduled_date,
+            terminated_date=scheduled_date + timedelta(minutes=minutes),
+        )
+    # failed runs don't count
+    spark_job.runs.create(
+        jobflow_id='j-2',
+        status=Cluster.STATUS_TERMINATED_WITH_ERRORS,
+        scheduled_date=now - timedelta(days=2),
+        terminated_date=now - timedelta(days=1),
+    )
+    # the stats are updated when a run finishes
+    run = spark_job.runs.create(
+        jobflow_id='j-1',
+        status=Cluster.STATUS_RUNNING,
+        scheduled_date=now - timedelta(minutes=40),
+    )
+    mocker.patch('django.utils.timezone.now', return_value=now)
+    run.update_status({
+        'state': Cluster.STATUS_TERMINATED,
+        'state_change_reason_code': None,
+        'state_change_reason_message': None,
+    })
+    spark_job.refresh_from_db()
+    stats = spark_job.runtime_stats
+    assert stats.run_count == 4
+    assert stats.median_duration == timedelta(minutes=30)
+    assert stats.p95_duration == timedelta(minutes=40)
+    assert stats.trend == 40 / 20
+    assert stats.has_recommendations
+    assert stats.recommended_timeout == 1
+    assert stats.recommended_size == 7
+
+    # the recommendations are shown on the edit form
+    form = EditSparkJobForm(test_user, instance=spark_job)
+    assert '<strong>1 hours</strong>' in form.fields['job_timeout'].help_text
+    assert 'cluster size of <strong>7</strong>' in form.fields['size'].help_text
+
+
+def test_spark_job_runtime_stats_zero_median(now, test_user):
+    spark_job = models.SparkJob.objects.create(
+        identifier='test-spark-job',
+        description='description',
+        notebook_s3_key='jobs/test-spark-job/test-notebook.ipynb',
+        result_visibility='private',
+        size=10,
+        interval_in_hours=24,
+        job_timeout=12,
+        start_date=now - timedelta(days=2),
+        created_by=test_user,
+    )
+    # the older run finished right away, the newer one took 10 minutes
+    for days, minutes in [(2, 0), (1, 10)]:
+        scheduled_date = now - timedelta(days=days)
+        spark_job.runs.create(
+            jobflow_id='j-%s' % days,
+            status=Cluster.STATUS_TERMINATED,
+            scheduled_date=scheduled_date,
+            terminated_date=scheduled_date + timedelta(minutes=minutes),
+        )
+    stats = spark_job.update_runtime_stats()
+    assert stats.run_count == 2
+    assert stats.trend == 1.0
+
+
+@pytest.fixture
+def spark_job_packing():
+    constance.config.SPARK_JOB_PACKING_ENABLED = True
+    yield
+    constance.config.SPARK_JOB_PACKING_ENABLED = False
+
+
+def test_run_packed_spark_jobs(mocker, now, test_user, cluster_provisioner_mocks,
+                               spark_job_packing):
+
+    def create_job(identifier, size, p95_minutes):
+        spark_job = models.SparkJob.objects.create(
+            identifier=identifier,
+            description='description',
+            notebook_s3_key='jobs/%s/test-notebook.ipynb' % identifier,
+            result_visibility='private',
+            size=size,
+            interval_in_hours=24,
+            job_timeout=2,
+            start_date=now - timedelta(hours=1),
+            created_by=test_user,
+        )
+        models.SparkJobRuntimeStats.objects.create(
+            spark_job=spark_job,
+            run_count=5,
+            median_duration=timedelta(minutes=p95_minutes / 2),
+            p95_duration=timedelta(minutes=p95_minutes),
+        )
+        return spark_job
+
+    small_job = create_job('small-job', 2, 10)
+    other_small_job = create_job('other-small-job', 3, 20)
+    large_job = create_job('large-job', 20, 10)
+    slow_job = create_job('slow-job', 2, 120)
+    assert small_job.is_packable
+    assert other_small_job.is_packable
+    assert not large_job.is_packable
+    assert not slow_job.is_packable
+
+    run_packed = mocker.patch(
+        'atmo.jobs.provisioners.SparkJobProvisioner.run_packed',
+        return_value=('j-packed', {'small-job': 's-1', 'other-small-job': 's-2'}),
+    )
+    mocker.patch(
+        'atmo.jobs.provisioners.SparkJobProvisioner.step_info',
+        return_value={
+            'step_id': 's-1',
+            'state': Cluster.STATUS_PENDING,
+            'state_change_reason_code': None,
+            'state_change_reason_message': None,
+        },
+    )
+    schedule_spark_job = mocker.patch('atmo.jobs.tasks.schedule_spark_job')
+    expire_spark_job = mocker.patch('atmo.jobs.tasks.expire_spark_job.apply_async')
+
+    # the other small due job is run on the same cluster
+    tasks.run_job(small_job.pk)
+    run_packed.assert_called_once_with(
+        user_email=settings.AWS_CONFIG['EMAIL_SOURCE'],
+        identifier=models.PACKED_IDENTIFIER,
+        emr_release=small_job.emr_release,
+        size=3,
+        notebooks=[
+            ('small-job', 'jobs/small-job/test-notebook.ipynb', 2),
+            ('other-small-job', 'jobs/other-small-job/test-notebook.ipynb', 2),
+        ],
+        is_public=False,
+        job_timeout=4,
+    )
+    assert schedule_spark_job.call_count == 2
+    # the terminations are queued once the steps are running
+    expire_spark_job.assert_not_called()
+    small_run = small_job.get_latest_run()
+    other_small_run = other_small_job.get_latest_run()
+    assert (small_run.jobflow_id, small_run.step_id) == ('j-packed', 's-1')
+    assert (other_small_run.jobflow_id, other_small_run.step_id) == ('j-packed', 's-2')
+    assert small_run.is_packed
+    assert small_run.status == Cluster.STATUS_PENDING
+    # the large and slow jobs weren't run along
+    assert large_job.get_latest_run() is None
+    assert slow_job.get_latest_run() is None
+
+    # the packed runs are updated from their steps
+    mocker.patch(
+        'atmo.clusters.provisioners.ClusterProvisioner.list',
+        return_value=[],
+    )
+    list_steps = mocker.patch(
+        'atmo.jobs.provisioners.SparkJobProvisioner.list_steps',
+        return_value={
+            's-1': {
+                'step_id': 's-1',
+                'state': Cluster.STATUS_TERMINATED,
+                'state_change_reason_code': None,
+                'state_change_reason_message': None,
+            },
+            's-2': {
+                'step_id': 's-2',
+                'state': Cluster.STATUS_TERMINATED_WITH_ERRORS,
+                'state_change_reason_code': Cluster.STATE_CHANGE_REASON_STEP_FAILURE,
+                'state_change_reason_message': 'Step failed',
+            },
+        },
+    )
+    mocker.patch('atmo.jobs.provisioners.SparkJobProvisioner.run', return_value='12345')
+    mocker.patch(
+        'atmo.clusters.provisioners.ClusterProvisioner.info',
+        return_value={
+            'start_time': now,
+            'state': Cluster.STATUS_BOOTSTRAPPING,
+            'state_change_reason_code': None,
+            'state_change_reason_message': None,
+            'public_dns': None,
+        },
+    )
+    tasks.run_jobs()
+    list_steps.assert_called_once_with('j-packed')
+    small_run.refresh_from_db()
+    other_small_run.refresh_from_db()
+    assert small_run.status == Cluster.STATUS_TERMINATED
+    assert other_small_run.status == Cluster.STATUS_TERMINATED_WITH_ERRORS
+    assert other_small_run.alert.reason_message == 'Step failed'
+    # no cluster status transitions are logged for the steps
+    assert not ClusterStatusTransition.objects.filter(jobflow_id='j-packed').exists()
+    # the remaining due jobs couldn't be packed and run on their own
+    assert large_job.get_latest_run().jobflow_id == '12345'
+    assert slow_job.get_latest_run().jobflow_id == '12345'
+
+
+def test_terminate_packed_spark_job(mocker, now, test_user, cluster_provisioner_mocks,
+                                    sparkjob_provisioner_mocks):
+    spark_job = models.SparkJob.objects.create(
+        identifier='test-spark-job',
+        description='description',
+        notebook_s3_key='jobs/test-spark-job/test-notebook.ipynb',
+        result_visibility='private',
+        size=2,
+        interval_in_hours=24,
+        job_timeout=1,
+        start_date=now - timedelta(days=1),
+        created_by=test_user,
+    )
+    spark_job.runs.create(
+        jobflow_id='j-packed',
+        step_id='s-1',
+        status=Cluster.STATUS_RUNNING,
+        scheduled_date=now - timedelta(hours=2),
+        run_date=now - timedelta(hours=1),
+    )
+    assert spark_job.running_jobflow_id == 'j-packed'
+    assert spark_job.running_step_id == 's-1'
+    cancel_step = mocker.patch('atmo.jobs.provisioners.SparkJobProvisioner.cancel_step')
+    # only the step is cancelled, not the shared cluster
+    spark_job.terminate()
+    cancel_step.assert_called_once_with('j-packed', 's-1')
+    cluster_provisioner_mocks['stop'].assert_not_called()
+
+    cancel_step.reset_mock()
+    tasks.cleanup_spark_job(
+        'jobs/test-spark-job/test-notebook.ipynb',
+        jobflow_id='j-packed',
+        step_id='s-1',
+    )
+    cancel_step.assert_called_once_with('j-packed', 's-1')
+    cluster_provisioner_mocks['stop'].assert_not_called()
+
+
+def test_run_packed_spark_jobs_missing_step(mocker, now, test_user):
+    spark_jobs = [
+        models.SparkJob.objects.create(
+            identifier='job-%s' % index,
+            description='description',
+            notebook_s3_key='jobs/job-%s/test-notebook.ipynb' % index,
+            result_visibility='private',
+            size=2,
+            interval_in_hours=24,
+            job_timeout=1,
+            start_date=now - timedelta(hours=1),
+            created_by=test_user,
+        )
+        for index in range(1, 3)
+    ]
+    mocker.patch(
+        'atmo.jobs.provisioners.SparkJobProvisioner.run_packed',
+        return_value=('j-packed', {'job-1': 's-1'}),
+    )
+    mocker.patch(
+        'atmo.jobs.provisioners.SparkJobProvisioner.step_info',
+        return_value={
+            'step_id': 's-1',
+            'state': Cluster.STATUS_PENDING,
+            'state_change_reason_code': None,
+            'state_change_reason_message': None,
+        },
+    )
+    runs = models.SparkJob.run_packed(spark_jobs)
+    assert [run.step_id for run in runs] == ['s-1']
+    # the run without a step isn't mistaken for one with its own cluster
+    missing_run = spark_jobs[1].get_latest_run()
+    assert missing_run.status == models.LAUNCH_FAILED_STATUS
+    assert missing_run.jobflow_id is None
+    assert not missing_run.is_packed
+
+
+def test_packed_spark_job_timeouts(mocker, now, test_user, cluster_provisioner_mocks,
+                                   spark_job_packing):
+    spark_jobs = []
+    for index in range(1, 4):
+        spark_job = models.SparkJob.objects.create(
+            identifier='job-%s' % index,
+            description='description',
+            notebook_s3_key='jobs/job-%s/test-notebook.ipynb' % index,
+            result_visibility='private',
+            size=2,
+            interval_in_hours=24,
+            job_timeout=1,
+            start_date=now - timedelta(hours=1),
+            created_by=test_user,
+        )
+        models.SparkJobRuntimeStats.objects.create(
+            spark_job=spark_job,
+            run_count=5,
+            median_duration=timedelta(minutes=20),
+            p95_duration=timedelta(minutes=30),
+        )
+        spark_jobs.append(spark_job)
+    mocker.patch(
+        'atmo.jobs.provisioners.SparkJobProvisioner.run_packed',
+        return_value=('j-packed', {'job-1': 's-1', 'job-2': 's-2', 'job-3': 's-3'}),
+    )
+
+    def step_info(step_id, state):
+        return {
+            'step_id': step_id,
+            'state': state,
+            'state_change_reason_code': None,
+            'state_change_reason_message': None,
+        }
+
+    mocker.patch(
+        'atmo.jobs.provisioners.SparkJobProvisioner.step_info',
+        side_effect=lambda jobflow_id, step_id: step_info(step_id, Cluster.STATUS_PENDING),
+    )
+    mocker.patch(
+        'atmo.jobs.provisioners.SparkJobProvisioner.list_steps',
+        return_value={
+            's-1': step_info('s-1', Cluster.STATUS_RUNNING),
+            's-2': step_info('s-2', Cluster.STATUS_PENDING),
+            's-3': step_info('s-3', Cluster.STATUS_PENDING),
+        },
+    )
+    mocker.patch('atmo.clusters.provisioners.ClusterProvisioner.list', return_value=[])
+    mocker.patch('atmo.jobs.tasks.schedule_spark_job')
+    mocker.patch('django.db.transaction.on_commit', side_effect=lambda func: func())
+    expire_spark_job = mocker.patch('atmo.jobs.tasks.expire_spark_job.apply_async')
+    cancel_step = mocker.patch('atmo.jobs.provisioners.SparkJobProvisioner.cancel_step')
+
+    tasks.run_packed_spark_jobs(spark_jobs)
+    expire_spark_job.assert_not_called()
+
+    # only the running step's termination is queued, from its start
+    tasks.run_jobs()
+    first_run = spark_jobs[0].get_latest_run()
+    assert first_run.status == Cluster.STATUS_RUNNING
+    expire_spark_job.assert_called_once_with(
+        args=[spark_jobs[0].pk],
+        eta=first_run.run_date + timedelta(hours=1),
+    )
+
+    # the queued steps don't time out while they wait for their turn
+    with freeze_time(now + timedelta(hours=2)):
+        for spark_job in spark_jobs:
+            spark_job.clear_latest_run()
+        assert spark_jobs[0].is_expired
+        assert not spark_jobs[1].is_expired
+        assert not spark_jobs[2].is_expired
+        for spark_job in spark_jobs:
+            tasks.expire_spark_job(spark_job.pk)
+    cancel_step.assert_called_once_with('j-packed', 's-1')
+    assert not models.SparkJobRunAlert.objects.exists()
+
+
+def test_compute_start_offsets(now):
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def make_job(pk, start_date, interval_in_hours=24):
+        return models.SparkJob(
+            pk=pk,
+            start_date=start_date,
+            interval_in_hours=interval_in_hours,
+        )
+
+    spark_jobs = [
+        make_job(1, midnight),
+        make_job(2, midnight),
+        make_job(3, midnight + timedelta(minutes=1)),
+        make_job(4, midnight + timedelta(minutes=5)),
+        make_job(5, midnight + timedelta(hours=6)),
+        make_job(6, midnight + timedelta(hours=6), models.SparkJob.INTERVAL_WEEKLY),
+    ]
+    offsets = schedules.compute_start_offsets(spark_jobs)
+    assert offsets == {
+        1: timedelta(0),
+        2: timedelta(minutes=5),
+        3: timedelta(minutes=10),
+        4: timedelta(minutes=10),
+        5: timedelta(0),
+        6: timedelta(minutes=5),
+    }
+    # the offsets don't depend on the order of the jobs
+    assert schedules.compute_start_offsets(reversed(spark_jobs)) == offsets
+    # and are bounded
+    many_jobs = [make_job(pk, midnight) for pk in range(1, 20)]
+    offsets = schedules.compute_start_offsets(many_jobs)
+    assert max(offsets.values()) == schedules.STAGGER_MAX_OFFSET
+
+
+def test_spark_job_start_offset(mocker, now, test_user, schedule_entry_mocks):
+    spark_job = models.SparkJob.objects.create(
+        identifier='test-spark-job',
+        description='description',
+        notebook_s3_key='jobs/test-spark-job/test-notebook.ipynb',
+        result_visibility='private',
+        size=5,
+        interval_in_hours=24,
+        job_timeout=12,
+        start_date=now - timedelta(minutes=5),
+        created_by=test_user,
+    )
+    other_spark_job = models.SparkJob.objects.create(
+        identifier='other-test-spark-job',
+        description='description',
+        notebook_s3_key='jobs/other-test-spark-job/test-notebook.ipynb',
+        result_visibility='private',
+        size=5,
+        interval_in_hours=24,
+        job_timeout=12,
+        start_date=now - timedelta(minutes=5),
+        created_by=test_user,
+    )
+    # the second job scheduled at the same time is delayed
+    assert tasks.stagger_jobs() == ['other-test-spark-job']
+    assert schedule_entry_mocks['save'].call_count == 1
+    other_spark_job.refresh_from_db()
+    assert other_spark_job.start_offset == timedelta(minutes=5)
+    assert other_spark_job.next_run_date == other_spark_job.start_date + timedelta(minutes=5)
+    mocker.patch('django.utils.timezone.now', return_value=now - timedelta(seconds=1))
+    assert not other_spark_job.should_run()
+    mocker.patch('django.utils.timezone.now', return_value=now)
+    assert other_spark_job.should_run()
+    # nothing changes when recomputing the offsets
+    assert tasks.stagger_jobs() == []
+
+    # the offset doesn't add up from run to run
+    other_spark_job.runs.create(
+        status=Cluster.STATUS_TERMINATED,
+        scheduled_date=now + timedelta(seconds=30),
+        start_offset=timedelta(minutes=5),
+    )
+    other_spark_job.clear_latest_run()
+    assert other_spark_job.next_run_date == now + timedelta(hours=24, seconds=30)
+    # but a changed offset moves the next run
+    other_spark_job.start_offset = timedelta(minutes=10)
+    assert other_spark_job.next_run_date == now + timedelta(hours=24, minutes=5, seconds=30)
+    spark_job.refresh_from_db()
+    assert spark_job.start_offset == timedelta(0)
+
+
+def test_cron_fire_times():
+    crontab = cron.parse('15 2 * * mon-fri')
+    # Friday, March 3rd 2017
+    after = datetime(2017, 3, 3, 2, 15, tzinfo=timezone.utc)
+    assert cron.fire_times(crontab, after=after, count=3) == [
+        datetime(2017, 3, 6, 2, 15, tzinfo=timezone.utc),
+        datetime(2017, 3, 7, 2, 15, tzinfo=timezone.utc),
+        datetime(2017, 3, 8, 2, 15, tzinfo=timezone.utc),
+    ]
+    # the lookahead covers at least one leap day
+    crontab = cron.parse('0 */12 29 2 *')
+    assert cron.fire_times(crontab, after=after, count=3) == [
+        datetime(2020, 2, 29, 0, 0, tzinfo=timezone.utc),
+        datetime(2020, 2, 29, 12, 0, tzinfo=timezone.utc),
+    ]
+    # a schedule that never fires
+    assert cron.fire_times(cron.parse('0 0 31 2 *'), after=after, count=1) == []
+    for expression in ['', '* * * *', '61 * * * *', '0 0 * * funday']:
+        with pytest.raises(ValueError):
+            cron.parse(expression)
+
+
+def test_spark_job_cron_schedule(mocker, now, test_user, sparkjob_provisioner_mocks):
+    now = now.replace(second=0, microsecond=0)
+    spark_job = models.SparkJob.objects.create(
+        identifier='test-spark-job',
+        description='description',
+        notebook_s3_key='jobs/test-spark-job/test-notebook.ipynb',
+        result_visibility='private',
+        size=5,
+        interval_in_hours=24,
+        job_timeout=12,
+        start_date=now - timedelta(days=1),
+        schedule='* * * * *',
+        created_by=test_user,
+    )
+    spark_job.update_fire_times(now=now - timedelta(minutes=2))
+    fire_times = list(spark_job.fire_times.values_list('fire_at', flat=True))
+    assert len(fire_times) == models.FIRE_TIME_COUNT
+    assert fire_times[0] == now - timedelta(minutes=1)
+    assert spark_job.next_run_date == now - timedelta(minutes=1)
+    assert spark_job.should_run()
+    # only the jobs with a passed fire time are due candidates
+    assert list(models.SparkJob.objects.due_candidates(now - timedelta(minutes=2))) == []
+    assert list(models.SparkJob.objects.due_candidates(now)) == [spark_job]
+
+    mocker.patch(
+        'atmo.clusters.provisioners.ClusterProvisioner.info',
+        return_value={
+            'start_time': now,
+            'state': Cluster.STATUS_BOOTSTRAPPING,
+            'state_change_reason_code': None,
+            'state_change_reason_message': None,
+            'public_dns': None,
+        },
+    )
+    mocker.patch('atmo.jobs.tasks.schedule_spark_job')
+    mocker.patch('atmo.jobs.tasks.expire_spark_job.apply_async')
+    mocker.patch('django.utils.timezone.now', return_value=now)
+    tasks.run_job(spark_job.pk)
+    sparkjob_provisioner_mocks['run'].assert_called_once()
+    # the fire times that passed were consumed and topped up
+    fire_times = list(spark_job.fire_times.values_list('fire_at', flat=True))
+    assert len(fire_times) == models.FIRE_TIME_COUNT
+    assert fire_times[0] == now + timedelta(minutes=1)
+
+    # the fire times that pass while the job is running are skipped
+    later = now + timedelta(minutes=3)
+    mocker.patch('django.utils.timezone.now', return_value=later)
+    spark_job = models.SparkJob.objects.get(pk=spark_job.pk)
+    assert not spark_job.should_run()
+    tasks.run_job(spark_job.pk)
+    sparkjob_provisioner_mocks['run'].assert_called_once()
+    # and the next fire times don't drift with the launch times
+    assert spark_job.next_run_date == later + timedelta(minutes=1)
+
+    # an interval based job has no fire times
+    spark_job.schedule = ''
+    spark_job.save()
+    spark_job.update_fire_times()
+    assert not spark_job.fire_times.exists()
+
+
+def test_spark_job_form_schedule(test_user):
+    form = EditSparkJobForm(test_user)
+
+    def clean_schedule(schedule):
+        form.cleaned_data = {'schedule': schedule}
+        return form.clean_schedule()
+
+    assert clean_schedule('') == ''
+    assert clean_schedule(' 15  2 * * mon-fri ') == '15 2 * * mon-fri'
+    with pytest.raises(ValidationError) as exc:
+        clean_schedule('0 0 * *')
+    assert 'five fields' in exc.value.messages[0]
+    with pytest.raises(ValidationError) as exc:
+        clean_schedule('0 0 31 2 *')
+    assert exc.value.messages == ['The schedule never fires.']
+
+
+def test_spark_job_upstream_jobs(mocker, now, test_user, schedule_entry_mocks):
+
+    def create_job(identifier):
+        return models.SparkJob.objects.create(
+            identifier=identifier,
+            description='description',
+            notebook_s3_key='jobs/%s/test-notebook.ipynb' % identifier,
+            result_visibility='private',
+            size=5,
+            interval_in_hours=24,
+            job_timeout=12,
+            start_date=now - timedelta(days=1),
+            created_by=test_user,
+        )
+
+    def complete_run(spark_job, jobflow_id):
+        run = spark_job.runs.create(
+            jobflow_id=jobflow_id,
+            status=Cluster.STATUS_RUNNING,
+            scheduled_date=timezone.now() - timedelta(hours=1),
+        )
+        run.update_status({
+            'state': Cluster.STATUS_TERMINATED,
+            'state_change_reason_code': None,
+            'state_change_reason_message': None,
+        })
+
+    mocker.patch('django.db.transaction.on_commit', side_effect=lambda func: func())
+    run_job = mocker.patch('atmo.jobs.tasks.run_job.delay')
+    extract = create_job('extract')
+    load = create_job('load')
+    report = create_job('report')
+    report.upstream_jobs.add(extract, load)
+    assert report.has_upstream_jobs
+    assert not extract.has_upstream_jobs
+    assert report.all_upstream_job_ids() == {extract.pk, load.pk}
+    # the job doesn't run at its interval but waits for its upstream jobs
+    assert report.get_due_date() is None
+    assert report.next_run_date is None
+    assert not report.should_run()
+
+    complete_run(extract, 'j-1')
+    assert not run_job.called
+    complete_run(load, 'j-2')
+    run_job.assert_called_once_with(report.pk)
+    report = models.SparkJob.objects.get(pk=report.pk)
+    assert report.should_run()
+
+    # once the job ran it waits for the next runs of its upstream jobs
+    report.runs.create(
+        status=Cluster.STATUS_TERMINATED,
+        scheduled_date=timezone.now(),
+    )
+    report.clear_latest_run()
+    assert not report.should_run()
+    complete_run(load, 'j-3')
+    assert run_job.call_count == 1
+
+    # the dependencies can't have cycles
+    form = EditSparkJobForm(test_user, instance=extract)
+    assert report in form.fields['upstream_jobs'].queryset
+    assert extract not in form.fields['upstream_jobs'].queryset
+    form.cleaned_data = {'upstream_jobs': [report]}
+    with pytest.raises(ValidationError) as exc:
+        form.clean_upstream_jobs()
+    assert exc.value.messages == ['The job report already depends on this job.']
+    form = EditSparkJobForm(test_user, instance=report)
+    form.cleaned_data = {'upstream_jobs': [extract]}
+    assert form.clean_upstream_jobs() == [extract]
+
+    # and jobs with upstream jobs aren't staggered
+    assert report.pk not in [spark_job.pk for spark_job in schedules.stagger_spark_jobs()]
+
+
+def test_spark_job_backfill(mocker, client, now, test_user, sparkjob_provisioner_mocks):
+    now = now.replace(microsecond=0)
+    spark_job = models.SparkJob.objects.create(
+        identifier='test-spark-job',
+        description='description',
+        notebook_s3_key='jobs/test-spark-job/test-notebook.ipynb',
+        result_visibility='private',
+        size=5,
+        interval_in_hours=24,
+        job_timeout=12,
+        start_date=now - timedelta(days=10),
+        created_by=test_user,
+    )
+    start_date = now - timedelta(days=3)
+    assert spark_job.get_backfill_dates(start_date, now - timedelta(days=1)) == [
+        now - timedelta(days=3),
+        now - timedelta(days=2),
+        now - timedelta(days=1),
+    ]
+    assert len(spark_job.get_backfill_dates(
+        now - timedelta(days=1000), now,
+    )) == models.MAX_BACKFILL_RUNS + 1
+
+    # the backfill is created from the job page
+    run_backfills = mocker.patch('atmo.jobs.tasks.run_backfills.delay')
+    mocker.patch('django.db.transaction.on_commit', side_effect=lambda func: func())
+    backfill_url = reverse('jobs-backfill', kwargs={'id': spark_job.id})
+    response = client.post(backfill_url, {
+        'backfill-start_date': start_date.strftime('%Y-%m-%d %H:%M:%S'),
+        'backfill-end_date': (now + timedelta(hours=1)).strftime('%Y-%m-%d %H:%M:%S'),
+        'backfill-concurrency': 10,
+    })
+    assert response.status_code == 200
+    assert response.context['form'].errors['end_date'] == [
+        'Only past periods can be backfilled.',
+    ]
+    response = client.post(backfill_url, {
+        'backfill-start_date': start_date.strftime('%Y-%m-%d %H:%M:%S'),
+        'backfill-end_date': (now - timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S'),
+        'backfill-concurrency': 2,
+    }, follow=True)
+    assert response.redirect_chain[-1] == (spark_job.get_absolute_url(), 302)
+    run_backfills.assert_called_once_with()
+    backfill = spark_job.backfills.get()
+    assert backfill.concurrency == 2
+    assert backfill.progress == {'pending': 3, 'active': 0, 'succeeded': 0, 'failed': 0}
+
+    cluster_info = {
+        'start_time': now,
+        'state': Cluster.STATUS_BOOTSTRAPPING,
+        'state_change_reason_code': None,
+        'state_change_reason_message': None,
+        'public_dns': None,
+    }
+    mocker.patch(
+        'atmo.clusters.provisioners.ClusterProvisioner.info',
+        return_value=cluster_info,
+    )
+    # the runs are launched in parallel up to the concurrency cap
+    assert tasks.run_backfills() == ['12345', '12345']
+    assert sparkjob_provisioner_mocks['run'].call_count == 2
+    logical_dates = [
+        call[1]['logical_date']
+        for call in sparkjob_provisioner_mocks['run'].call_args_list
+    ]
+    assert logical_dates == [now - timedelta(days=3), now - timedelta(days=2)]
+    assert backfill.progress == {'pending': 1, 'active': 2, 'succeeded': 0, 'failed': 0}
+    assert tasks.run_backfills() == []
+
+    # and the scheduled runs aren't affected
+    spark_job = models.SparkJob.objects.get(pk=spark_job.pk)
+    assert spark_job.latest_run is None
+    assert spark_job not in models.SparkJob.objects.active()
+
+    # the next run is launched once a run finished
+    cluster_info['state'] = Cluster.STATUS_TERMINATED
+    assert tasks.run_backfills() == ['12345']
+    assert sparkjob_provisioner_mocks['run'].call_args[1]['logical_date'] == now - timedelta(days=1)
+    assert backfill.progress == {'pending': 0, 'active': 0, 'succeeded': 3, 'failed': 0}
+    assert backfill.is_finished
+
+
+def test_spark_job_run_fail_over(mocker, now, test_user, sparkjob_provisioner_mocks):
+    spark_job = models.SparkJob.objects.create(
+        identifier='test-spark-job',
+        description='description',
+        notebook_s3_key='jobs/test-spark-job/test-notebook.ipynb',
+        result_visibility='private',
+        size=5,
+        interval_in_hours=24,
+        job_timeout=12,
+        start_date=now - timedelta(hours=1),
+        created_by=test_user,
+    )
+    mocker.patch(
+        'atmo.clusters.provisioners.ClusterProvisioner.info',
+        return_value={
+            'start_time': now,
+            'state': Cluster.STATUS_BOOTSTRAPPING,
+            'state_change_reason_code': None,
+            'state_change_reason_message': None,
+            'public_dns': None,
+        },
+    )
+    mocker.patch('django.db.transaction.on_commit', side_effect=lambda func: func())
+    mocker.patch(
+        'atmo.jobs.tasks.fail_over_spark_job_run.delay',
+        side_effect=lambda run_id: tasks.fail_over_spark_job_run(run_id),
+    )
+    expire_spark_job = mocker.patch('atmo.jobs.tasks.expire_spark_job.apply_async')
+    constance.config.AWS_USE_SPOT_INSTANCES = True
+    run = spark_job.run()
+    assert run.attempt == 1
+    assert sparkjob_provisioner_mocks['run'].call_args[1]['use_spot'] is True
+
+    instance_failure = {
+        'state': Cluster.STATUS_TERMINATED_WITH_ERRORS,
+        'state_change_reason_code': models.SparkJobRun.INSTANCE_FAILURE_REASON_CODE,
+        'state_change_reason_message': 'Spot instances were reclaimed',
+    }
+    # the run whose instances were lost is relaunched on on-demand instances
+    run.update_status(instance_failure)
+    assert not models.SparkJobRunAlert.objects.exists()
+    assert sparkjob_provisioner_mocks['run'].call_count == 2
+    assert sparkjob_provisioner_mocks['run'].call_args[1]['use_spot'] is False
+    spark_job.clear_latest_run()
+    retry = spark_job.latest_run
+    assert retry.pk != run.pk
+    assert retry.attempt == 2
+    expire_spark_job.assert_called_once_with(
+        args=[spark_job.pk],
+        eta=retry.scheduled_date + timedelta(hours=12),
+    )
+
+    # but only as often as configured before raising the alarm
+    retry.update_status(instance_failure)
+    assert sparkjob_provisioner_mocks['run'].call_count == 2
+    alert = models.SparkJobRunAlert.objects.get()
+    assert alert.run == retry
+    assert alert.reason_code == models.SparkJobRun.INSTANCE_FAILURE_REASON_CODE
+
+    # a run that is no longer the latest one isn't relaunched
+    assert run.relaunch() is None
+
+
+def test_spark_job_auto_scaling(mocker, now, test_user, sparkjob_provisioner_mocks):
+    spark_job = models.SparkJob.objects.create(
+        identifier='test-spark-job',
+        description='description',
+        notebook_s3_key='jobs/test-spark-job/test-notebook.ipynb',
+        result_visibility='private',
+        size=2,
+        max_size=10,
+        interval_in_hours=24,
+        job_timeout=12,
+        start_date=now - timedelta(hours=1),
+        created_by=test_user,
+    )
+    assert spark_job.peak_size == 10
+    # auto-scaling jobs don't share clusters
+    constance.config.SPARK_JOB_PACKING_ENABLED = True
+    assert not spark_job.is_packable
+    mocker.patch(
+        'atmo.clusters.provisioners.ClusterProvisioner.info',
+        return_value={
+            'start_time': now,
+            'state': Cluster.STATUS_RUNNING,
+            'state_change_reason_code': None,
+            'state_change_reason_message': None,
+            'public_dns': None,
+        },
+    )
+    run = spark_job.run()
+    assert sparkjob_provisioner_mocks['run'].call_args[1]['max_size'] == 10
+
+    # the node counts are recorded whenever they changed
+    node_count = mocker.patch(
+        'atmo.clusters.provisioners.ClusterProvisioner.node_count',
+        return_value=2,
+    )
+    assert run.record_node_count(now) is not None
+    assert run.record_node_count(now + timedelta(minutes=5)) is None
+    node_count.return_value = 6
+    assert run.record_node_count(now + timedelta(minutes=10)) is not None
+    node_count.return_value = 4
+    assert run.record_node_count(now + timedelta(minutes=15)) is not None
+    assert [count.node_count for count in run.node_counts.all()] == [2, 6, 4]
+    assert run.peak_node_count == 6
+    node_count.assert_called_with(run.jobflow_id)
+
+
+def test_spark_job_form_max_size(test_user):
+    form = EditSparkJobForm(test_user)
+
+    def clean_max_size(size, max_size):
+        form.cleaned_data = {'size': size, 'max_size': max_size}
+        return form.clean_max_size()
+
+    assert clean_max_size(2, None) is None
+    assert clean_max_size(2, 10) == 10
+    with pytest.raises(ValidationError) as exc:
+        clean_max_size(4, 4)
+    assert exc.value.messages == [
+        'The maximum cluster size needs to be larger than the cluster size.',
+    ]
+    with pytest.raises(ValidationError) as exc:
+        clean_max_size(1, 10)
+    assert 'can\'t auto-scale' in exc.value.messages[0]
@@ -2,10 +2,15 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 from datetime import datetime
+from io import StringIO
 
 import pytest
+from django.contrib.auth.models import Permission
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
+from guardian.models import UserObjectPermission
 
+from atmo.keys import views
 from atmo.keys.models import SSHKey
 from atmo.keys.utils import calculate_fingerprint
 
@@ -162,3 +167,53 @@ def test_list_keys(client, ssh_key, test_user2):
     assert response.status_code == 200
     assert 'ssh_keys' in response.context
     assert ssh_key not in response.context['ssh_keys']
+
+
+def test_ssh_key_permissions(ssh_key, test_user, mocker):
+    assert test_user.has_perm('keys.view_sshkey', ssh_key)
+    assert test_user.has_perm('keys.change_sshkey', ssh_key)
+    assert test_user.has_perm('keys.delete_sshkey', ssh_key)
+
+    # updating the key doesn't assign the permissions again
+    assign_permissions = mocker.spy(SSHKey, 'assign_permissions')
+    ssh_key.title = 'A new title'
+    ssh_key.save()
+    assert assign_permissions.call_count == 0
+
+
+def test_assign_unknown_permissions(ssh_key, test_user2):
+    # nothing is granted if any permission doesn't exist
+    with pytest.raises(Permission.DoesNotExist):
+        ssh_key.assign_permissions(test_user2, ['view', 'frobnicate'])
+    assert not test_user2.has_perm('keys.view_sshkey', ssh_key)
+
+
+def test_assign_permissions_command(ssh_key, test_user):
+    permissions = UserObjectPermission.objects.filter(
+        object_pk=str(ssh_key.pk),
+        user=test_user,
+        permission__codename__endswith='_sshkey',
+    )
+    assert permissions.count() == 3
+    permissions.filter(permission__codename='view_sshkey').delete()
+    assert permissions.count() == 2
+
+    output = StringIO()
+    call_command('assign_permissions', stdout=output)
+    assert permissions.count() == 3
+    assert 'Assigned 1 view permissions for keys.SSHKey' in output.getvalue()
+
+    # running it again doesn't create duplicates
+    call_command('assign_permissions', stdout=StringIO())
+    assert permissions.count() == 3
+
+
+def test_view_key_passes_object(rf, mocker, ssh_key, test_user):
+    # the decorator already fetched the object, no need to fetch it again
+    get = mocker.spy(SSHKey.objects, 'get')
+    request = rf.get(ssh_key.get_absolute_url())
+    request.user = test_user
+    response = views.detail_key(request, id=ssh_key.id, raw=True)
+    assert response.status_code == 200
+    assert response.content.decode('utf-8') == ssh_key.key
+    assert get.call_count == 0
@@ -9,6 +9,7 @@ from botocore.stub import ANY, Stubber
 from django.conf import settings
 from freezegun import freeze_time
 
+from atmo.clusters.provisioners import CLAIM_COMMAND
 from atmo.provisioners import Provisioner
 
 
@@ -594,3 +595,321 @@ def test_spark_job_run(mocker, is_public, spark_job_provisioner):
             job_timeout=job_timeout,
         )
         assert jobflow_id == '12345'
+
+
+@freeze_time('2017-02-03 13:48:09')
+def test_spark_job_run_packed(mocker, spark_job_provisioner):
+    notebooks = [
+        ('first-job', 'jobs/first-job/notebook.ipynb', 1),
+        ('second-job', 'jobs/second-job/notebook.ipynb', 3),
+    ]
+    stubber = Stubber(spark_job_provisioner.emr)
+    stubber.add_response('run_job_flow', {'JobFlowId': '12345'})
+    stubber.add_response(
+        'list_steps',
+        {
+            'Steps': [
+                {'Id': 's-2', 'Name': 'RunNotebookStep-second-job'},
+                {'Id': 's-1', 'Name': 'RunNotebookStep-first-job'},
+            ],
+        },
+        {'ClusterId': '12345'},
+    )
+    run_job_flow = mocker.spy(spark_job_provisioner.emr, 'run_job_flow')
+
+    with stubber:
+        jobflow_id, step_ids = spark_job_provisioner.run_packed(
+            user_email='foo@bar.com',
+            identifier='packed-spark-jobs',
+            emr_release='1.0',
+            size=3,
+            notebooks=notebooks,
+            is_public=False,
+            job_timeout=4,
+        )
+    assert jobflow_id == '12345'
+    assert step_ids == {'first-job': 's-1', 'second-job': 's-2'}
+
+    params = run_job_flow.call_args[1]
+    assert params['BootstrapActions'][0]['ScriptBootstrapAction']['Args'] == [
+        '--timeout', str(4 * 60),
+    ]
+    steps = params['Steps']
+    assert [step['Name'] for step in steps] == [
+        'RunNotebookStep-first-job',
+        'RunNotebookStep-second-job',
+    ]
+    # a failing job doesn't affect the others
+    assert all(step['ActionOnFailure'] == 'CONTINUE' for step in steps)
+    # each step times out after its job's timeout
+    assert steps[1]['HadoopJarStep']['Jar'] == 'command-runner.jar'
+    assert steps[1]['HadoopJarStep']['Args'] == [
+        'timeout', '--kill-after', '5m', '180m',
+        'bash', '-c', spark_job_provisioner.TIMEOUT_COMMAND,
+        spark_job_provisioner.batch_uri,
+        '--job-name', 'second-job',
+        '--notebook', 's3://telemetry-analysis-code-2/jobs/second-job/notebook.ipynb',
+        '--data-bucket', spark_job_provisioner.config['PRIVATE_DATA_BUCKET'],
+    ]
+
+
+@pytest.mark.parametrize('step_state,state,reason_code', [
+    ['PENDING', 'PENDING', None],
+    ['RUNNING', 'RUNNING', None],
+    ['COMPLETED', 'TERMINATED', None],
+    ['FAILED', 'TERMINATED_WITH_ERRORS', 'STEP_FAILURE'],
+    ['CANCELLED', 'TERMINATED_WITH_ERRORS', 'STEP_FAILURE'],
+])
+def test_spark_job_step_info(spark_job_provisioner, step_state, state, reason_code):
+    stubber = Stubber(spark_job_provisioner.emr)
+    response = {
+        'Step': {
+            'Id': 's-1',
+            'Status': {
+                'State': step_state,
+                'FailureDetails': {'Message': 'Notebook failed'},
+            },
+        },
+    }
+    expected_params = {'ClusterId': '12345', 'StepId': 's-1'}
+    stubber.add_response('describe_step', response, expected_params)
+
+    with stubber:
+        info = spark_job_provisioner.step_info('12345', 's-1')
+    assert info['step_id'] == 's-1'
+    assert info['state'] == state
+    assert info['state_change_reason_code'] == reason_code
+    if reason_code:
+        assert info['state_change_reason_message'] == 'Notebook failed'
+
+
+def test_spark_job_cancel_step(spark_job_provisioner):
+    stubber = Stubber(spark_job_provisioner.emr)
+    expected_params = {'ClusterId': '12345', 'StepIds': ['s-1']}
+    stubber.add_response('cancel_steps', {}, expected_params)
+
+    with stubber:
+        spark_job_provisioner.cancel_step('12345', 's-1')
+
+
+@pytest.mark.django_db
+def test_cluster_start_standby(mocker, cluster_provisioner):
+    stubber = Stubber(cluster_provisioner.emr)
+    stubber.add_response('run_job_flow', {'JobFlowId': '12345'})
+    run_job_flow = mocker.spy(cluster_provisioner.emr, 'run_job_flow')
+
+    with stubber:
+        jobflow_id = cluster_provisioner.start_standby(
+            identifier='standby-cluster',
+            emr_release='5.0.0',
+            size=1,
+        )
+    assert jobflow_id == '12345'
+    params = run_job_flow.call_args[1]
+    # the cluster isn't set up for any user yet
+    assert params['BootstrapActions'][0]['ScriptBootstrapAction']['Args'] == [
+        '--efs-dns', constance.config.AWS_EFS_DNS,
+    ]
+    tags = {tag['Key']: tag['Value'] for tag in params['Tags']}
+    assert tags['Owner'] == cluster_provisioner.config['EMAIL_SOURCE']
+    assert tags['Name'] == 'standby-cluster'
+
+
+def test_cluster_claim(cluster_provisioner):
+    stubber = Stubber(cluster_provisioner.emr)
+    stubber.add_response('add_tags', {}, {
+        'ResourceId': '12345',
+        'Tags': [
+            {'Key': 'Owner', 'Value': 'foo@bar.com'},
+            {'Key': 'Name', 'Value': 'test-cluster'},
+        ],
+    })
+    stubber.add_response('add_job_flow_steps', {'StepIds': ['s-1']}, {
+        'JobFlowId': '12345',
+        'Steps': [{
+            'Name': 'claim-cluster',
+            'ActionOnFailure': 'TERMINATE_JOB_FLOW',
+            'HadoopJarStep': {
+                'Jar': 'command-runner.jar',
+                'Args': ['bash', '-c', CLAIM_COMMAND, 'public-key'],
+            },
+        }],
+    })
+
+    with stubber:
+        cluster_provisioner.claim(
+            jobflow_id='12345',
+            user_email='foo@bar.com',
+            identifier='test-cluster',
+            public_key='public-key',
+        )
+
+
+def test_spark_job_notebook_step_logical_date(spark_job_provisioner):
+    step = spark_job_provisioner.notebook_step(
+        name='RunNotebookStep',
+        identifier='test-flow',
+        notebook_key='notebook.ipynb',
+        is_public=False,
+        logical_date=datetime(2017, 3, 4, 2, 15),
+    )
+    assert step['HadoopJarStep']['Args'][-2:] == ['--date', '20170304']
+    step = spark_job_provisioner.notebook_step(
+        name='RunNotebookStep',
+        identifier='test-flow',
+        notebook_key='notebook.ipynb',
+        is_public=False,
+    )
+    assert '--date' not in step['HadoopJarStep']['Args']
+
+
+def test_job_flow_params_use_spot(cluster_provisioner):
+    constance.config.AWS_USE_SPOT_INSTANCES = True
+    assert cluster_provisioner.uses_spot_instances(10)
+    assert not cluster_provisioner.uses_spot_instances(1)
+    params = cluster_provisioner.job_flow_params(
+        user_email='foo@bar.com',
+        identifier='test-flow',
+        emr_release='1.0',
+        size=10,
+        use_spot=False,
+    )
+    core_group = params['Instances']['InstanceGroups'][1]
+    assert core_group['Market'] == 'ON_DEMAND'
+    assert 'BidPrice' not in core_group
+
+
+def test_job_flow_params_instance_fleets(mocker, cluster_provisioner):
+    mocker.patch.dict(cluster_provisioner.config, {
+        'WORKER_INSTANCE_FLEETS': [
+            {
+                'MIN_SIZE': 5,
+                'INSTANCE_TYPES': [('c3.4xlarge', 1), ('c3.8xlarge', 2)],
+            },
+            {
+                'MIN_SIZE': 20,
+                'INSTANCE_TYPES': [('c3.8xlarge', 2)],
+                'SPOT_TIMEOUT_MINUTES': 10,
+            },
+        ],
+    })
+    constance.config.AWS_USE_SPOT_INSTANCES = True
+
+    def instances(size, use_spot=None):
+        return cluster_provisioner.job_flow_params(
+            user_email='foo@bar.com',
+            identifier='test-flow',
+            emr_release='1.0',
+            size=size,
+            use_spot=use_spot,
+        )['Instances']
+
+    # small clusters still use instance groups
+    assert 'InstanceFleets' not in instances(4)
+    assert len(instances(4)['InstanceGroups']) == 2
+    # larger ones the fleet for their size
+    params = instances(10)
+    assert 'InstanceGroups' not in params
+    assert params['KeepJobFlowAliveWhenNoSteps']
+    master_fleet, core_fleet = params['InstanceFleets']
+    assert master_fleet == {
+        'Name': 'Master',
+        'InstanceFleetType': 'MASTER',
+        'TargetOnDemandCapacity': 1,
+        'InstanceTypeConfigs': [
+            {'InstanceType': cluster_provisioner.config['MASTER_INSTANCE_TYPE']},
+        ],
+    }
+    bid = settings.CONSTANCE_CONFIG['AWS_SPOT_BID_CORE'][0]
+    assert core_fleet == {
+        'Name': 'Worker Instances',
+        'InstanceFleetType': 'CORE',
+        'TargetSpotCapacity': 10,
+        'InstanceTypeConfigs': [
+            {'InstanceType': 'c3.4xlarge', 'WeightedCapacity': 1, 'BidPrice': str(bid)},
+            {'InstanceType': 'c3.8xlarge', 'WeightedCapacity': 2, 'BidPrice': str(bid * 2)},
+        ],
+        'LaunchSpecifications': {
+            'SpotSpecification': {
+                'TimeoutDurationMinutes': 20,
+                'TimeoutAction': 'SWITCH_TO_ON_DEMAND',
+            },
+        },
+    }
+    core_fleet = instances(20)['InstanceFleets'][1]
+    assert core_fleet['InstanceTypeConfigs'][0]['InstanceType'] == 'c3.8xlarge'
+    assert core_fleet['LaunchSpecifications']['SpotSpecification']['TimeoutDurationMinutes'] == 10
+    # on-demand fleets don't need a bid or timeout
+    core_fleet = instances(10, use_spot=False)['InstanceFleets'][1]
+    assert core_fleet['TargetOnDemandCapacity'] == 10
+    assert 'TargetSpotCapacity' not in core_fleet
+    assert 'LaunchSpecifications' not in core_fleet
+    assert 'BidPrice' not in core_fleet['InstanceTypeConfigs'][0]
+
+
+@pytest.mark.django_db
+def test_job_flow_params_auto_scaling(mocker, cluster_provisioner):
+    mocker.patch.dict(cluster_provisioner.config, {
+        'WORKER_INSTANCE_FLEETS': [
+            {'MIN_SIZE': 1, 'INSTANCE_TYPES': [('c3.4xlarge', 1)]},
+        ],
+    })
+    params = cluster_provisioner.job_flow_params(
+        user_email='foo@bar.com',
+        identifier='test-flow',
+        emr_release='1.0',
+        size=4,
+        max_size=20,
+    )
+    assert params['AutoScalingRole'] == cluster_provisioner.config['AUTO_SCALING_ROLE']
+    # auto-scaling needs instance groups, even if there is a fleet
+    assert 'InstanceFleets' not in params['Instances']
+    master_group, core_group = params['Instances']['InstanceGroups']
+    assert 'AutoScalingPolicy' not in master_group
+    policy = core_group['AutoScalingPolicy']
+    assert policy['Constraints'] == {'MinCapacity': 4, 'MaxCapacity': 20}
+    scale_out, scale_in = policy['Rules']
+    assert scale_out['Action']['SimpleScalingPolicyConfiguration']['ScalingAdjustment'] == 4
+    assert scale_in['Action']['SimpleScalingPolicyConfiguration']['ScalingAdjustment'] == -4
+    alarm = scale_out['Trigger']['CloudWatchAlarmDefinition']
+    assert alarm['MetricName'] == 'YARNMemoryAvailablePercentage'
+    assert alarm['ComparisonOperator'] == 'LESS_THAN'
+
+    # clusters without a larger maximum size don't auto-scale
+    params = cluster_provisioner.job_flow_params(
+        user_email='foo@bar.com',
+        identifier='test-flow',
+        emr_release='1.0',
+        size=4,
+        max_size=4,
+    )
+    assert 'AutoScalingRole' not in params
+    assert 'InstanceFleets' in params['Instances']
+
+    # the parameters are valid for the EMR API
+    stubber = Stubber(cluster_provisioner.emr)
+    stubber.add_response('run_job_flow', {'JobFlowId': 'job-flow-id'})
+    with stubber:
+        jobflow_id = cluster_provisioner.start(
+            user_email='user@example.com',
+            identifier='cluster',
+            emr_release=settings.AWS_CONFIG['EMR_RELEASES'][0],
+            size=2,
+            public_key='public-key',
+            max_size=3,
+        )
+    assert jobflow_id == 'job-flow-id'
+
+
+def test_cluster_node_count(cluster_provisioner):
+    stubber = Stubber(cluster_provisioner.emr)
+    response = {
+        'InstanceGroups': [
+            {'InstanceGroupType': 'MASTER', 'RunningInstanceCount': 1},
+            {'InstanceGroupType': 'CORE', 'RunningInstanceCount': 7},
+            {'InstanceGroupType': 'TASK', 'RunningInstanceCount': 2},
+        ],
+    }
+    stubber.add_response('list_instance_groups', response, {'ClusterId': '12345'})
+    with stubber:
+        assert cluster_provisioner.node_count('12345') == 9